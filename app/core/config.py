@@ -13,7 +13,52 @@ CONFIG_MAPPING = {
     "moncash_client_id": "MONCASH_CLIENT_ID",
     "moncash_client_secret": "MONCASH_CLIENT_SECRET", 
     "moncash_env": "MONCASH_ENV",
-    "ai_middleware_database_url": "DATABASE_URL" 
+    "ai_middleware_database_url": "DATABASE_URL",
+    "ai_middleware_llm_timeout_seconds": "LLM_TIMEOUT_SECONDS",
+    "ai_middleware_genai_client_cache_size": "GENAI_CLIENT_CACHE_SIZE",
+    "ai_middleware_genai_client_idle_seconds": "GENAI_CLIENT_IDLE_SECONDS",
+    "ai_middleware_llm_hedge_default": "LLM_HEDGE_DEFAULT",
+    "ai_middleware_llm_hedge_quantile": "LLM_HEDGE_QUANTILE",
+    "ai_middleware_llm_hedge_delay_ms": "LLM_HEDGE_DELAY_MS",
+    "ai_middleware_llm_hedge_min_delay_ms": "LLM_HEDGE_MIN_DELAY_MS",
+    "ai_middleware_llm_hedge_max_per_second": "LLM_HEDGE_MAX_PER_SECOND",
+    "ai_middleware_response_cache_enabled": "RESPONSE_CACHE_ENABLED",
+    "ai_middleware_response_cache_ttl": "RESPONSE_CACHE_TTL",
+    "ai_middleware_response_cache_max_chars": "RESPONSE_CACHE_MAX_CHARS",
+    "ai_middleware_tool_max_turns": "TOOL_MAX_TURNS",
+    "ai_middleware_tool_timeout_seconds": "TOOL_TIMEOUT_SECONDS",
+    "ai_middleware_plan_prices": "PLAN_PRICES",
+    "ai_middleware_prompt_history_tokens": "PROMPT_HISTORY_TOKENS",
+    "ai_middleware_history_max_messages": "HISTORY_MAX_MESSAGES",
+    "ai_middleware_summary_enabled": "SUMMARY_ENABLED",
+    "ai_middleware_summary_model": "SUMMARY_MODEL",
+    "ai_middleware_llm_fallback_models": "LLM_FALLBACK_MODELS",
+    "ai_middleware_llm_breaker_rate_limit_seconds": "LLM_BREAKER_RATE_LIMIT_SECONDS",
+    "ai_middleware_llm_breaker_overload_seconds": "LLM_BREAKER_OVERLOAD_SECONDS",
+    "ai_middleware_llm_breaker_max_seconds": "LLM_BREAKER_MAX_SECONDS",
+    "ai_middleware_singleflight_enabled": "SINGLEFLIGHT_ENABLED",
+    "ai_middleware_singleflight_lock_seconds": "SINGLEFLIGHT_LOCK_SECONDS",
+    "ai_middleware_singleflight_result_ttl": "SINGLEFLIGHT_RESULT_TTL",
+    "ai_middleware_mailbox_enabled": "MAILBOX_ENABLED",
+    "ai_middleware_mailbox_debounce_ms": "MAILBOX_DEBOUNCE_MS",
+    "ai_middleware_mailbox_max_wait_ms": "MAILBOX_MAX_WAIT_MS",
+    "ai_middleware_admission_enabled": "ADMISSION_ENABLED",
+    "ai_middleware_admission_max_concurrency": "ADMISSION_MAX_CONCURRENCY",
+    "ai_middleware_admission_weights": "ADMISSION_WEIGHTS",
+    "ai_middleware_admission_deadlines": "ADMISSION_DEADLINES",
+    "ai_middleware_admission_premium_groups": "ADMISSION_PREMIUM_GROUPS",
+    "ai_middleware_admission_busy_reply": "ADMISSION_BUSY_REPLY",
+    "ai_middleware_llm_backend": "LLM_BACKEND",
+    "ai_middleware_broadcast_secret": "BROADCAST_SECRET",
+    "ai_middleware_broadcast_key_rpm": "BROADCAST_KEY_RPM",
+    "ai_middleware_broadcast_per_key_concurrency": "BROADCAST_PER_KEY_CONCURRENCY",
+    "ai_middleware_broadcast_max_concurrency": "BROADCAST_MAX_CONCURRENCY",
+    "ai_middleware_usage_ledger_enabled": "USAGE_LEDGER_ENABLED",
+    "ai_middleware_db_pool_min_size": "DB_POOL_MIN_SIZE",
+    "ai_middleware_db_pool_max_size": "DB_POOL_MAX_SIZE",
+    "ai_middleware_db_statement_cache_size": "DB_STATEMENT_CACHE_SIZE",
+    "ai_middleware_chat_write_behind": "CHAT_WRITE_BEHIND",
+    "ai_middleware_chat_partition_check_seconds": "CHAT_PARTITION_CHECK_SECONDS"
 }
 
 def load_config():
@@ -48,6 +93,10 @@ def get_api_keys(user_token_record=None):
     if user_token_record:
         keys.append(user_token_record['access_token'])
         
-    system_keys = os.getenv("GOOGLE_API_KEY", "").split(",")
-    keys.extend([k.strip() for k in system_keys if k.strip()])
+    keys.extend(get_system_api_keys())
     return keys
+
+def get_system_api_keys():
+    """The shared GOOGLE_API_KEY pool (comma separated)."""
+    system_keys = os.getenv("GOOGLE_API_KEY", "").split(",")
+    return [k.strip() for k in system_keys if k.strip()]
@@ -0,0 +1,19 @@
+"""
+In-process counters, exposed as JSON on GET /metrics.
+Per worker: aggregate across uvicorn workers in the scraper.
+"""
+from collections import defaultdict
+
+_counters = defaultdict(float)
+
+def incr(name: str, value: float = 1):
+    _counters[name] += value
+
+def get(name: str) -> float:
+    return _counters.get(name, 0)
+
+def snapshot() -> dict:
+    return dict(sorted(_counters.items()))
+
+def reset():
+    _counters.clear()
@@ -0,0 +1,29 @@
+"""
+Small in-process rate limiting helpers (per worker).
+"""
+import time
+import asyncio
+
+
+class TokenBucket:
+    """`rate` tokens per second, bursting up to `burst`."""
+
+    def __init__(self, rate: float, burst: float = None):
+        self.rate = rate
+        self.burst = burst if burst is not None else max(rate, 1)
+        self._tokens = self.burst
+        self._updated = time.monotonic()
+
+    def try_acquire(self, tokens: float = 1) -> bool:
+        now = time.monotonic()
+        self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+        if self._tokens >= tokens:
+            self._tokens -= tokens
+            return True
+        return False
+
+    async def acquire(self, tokens: float = 1):
+        """Waits until `tokens` are available and takes them."""
+        while not self.try_acquire(tokens):
+            await asyncio.sleep(max((tokens - self._tokens) / self.rate, 0.001))
@@ -0,0 +1,411 @@
+"""
+Versioned schema migrations.
+
+Each migration runs once and is recorded in `schema_version`. Startup does a
+single cheap query (current version + "is next month's chat partition there?")
+and only when something is pending takes a Postgres advisory lock, so workers
+booting together don't all hammer the catalog: the first one migrates, the
+others wait on the lock, re-check and find nothing to do.
+
+Add a migration by appending to MIGRATIONS with the next version number.
+Never edit or renumber a migration that has shipped.
+Index builds on live tables should use create_index_concurrently() in a
+migration with transactional=False (CONCURRENTLY can't run in a transaction).
+"""
+import asyncio
+import logging
+from dataclasses import dataclass
+from datetime import date
+from typing import Awaitable, Callable
+import asyncpg
+from app.database.connection import acquire
+from app.database.schema import (
+    CHAT_PARTITION_MONTHS_AHEAD, CHAT_PARTITION_CHECK_SECONDS, _month_start, chat_partition_name,
+    is_partitioned, index_table, create_chat_sessions_table, ensure_chat_partitions
+)
+
+logger = logging.getLogger(__name__)
+
+# pg_advisory_lock key shared by every worker of this app
+MIGRATION_LOCK_ID = 7_244_210_001
+MIGRATION_LOCK_POLL_SECONDS = 0.5
+
+
+@dataclass
+class Migration:
+    version: int
+    name: str
+    apply: Callable[..., Awaitable[None]]
+    transactional: bool = True
+
+
+async def create_index_concurrently(conn, name: str, table: str, columns: str):
+    """CREATE INDEX CONCURRENTLY, replacing a leftover INVALID index from an interrupted build."""
+    valid = await conn.fetchval(
+        "SELECT indisvalid FROM pg_index WHERE indexrelid = to_regclass($1)", name
+    )
+    if valid is False:
+        logger.warning(f"⚠️ Dropping invalid index {name} from an interrupted build")
+        await conn.execute(f"DROP INDEX CONCURRENTLY IF EXISTS {name};")
+    await conn.execute(f"CREATE INDEX CONCURRENTLY IF NOT EXISTS {name} ON {table} ({columns});")
+
+
+async def create_partitioned_index_concurrently(conn, name: str, table: str, columns: str):
+    """
+    Index on a partitioned table without blocking writers: the parent index is
+    created ON ONLY the parent (invalid), each partition's index is built
+    CONCURRENTLY and attached, and the parent turns valid once all are.
+    Partitions that already have theirs attached are skipped, so it can resume.
+    """
+    await conn.execute(f"CREATE INDEX IF NOT EXISTS {name} ON ONLY {table} ({columns});")
+    partitions = await conn.fetch(
+        "SELECT inhrelid::regclass::text AS name FROM pg_inherits WHERE inhparent = to_regclass($1)", table
+    )
+    attached = {r["name"] for r in await conn.fetch("""
+        SELECT i.indrelid::regclass::text AS name
+        FROM pg_inherits h JOIN pg_index i ON i.indexrelid = h.inhrelid
+        WHERE h.inhparent = to_regclass($1)
+    """, name)}
+    for p in partitions:
+        if p["name"] in attached:
+            continue
+        part_index = f"{p['name']}_{name}"
+        await create_index_concurrently(conn, part_index, p["name"], columns)
+        await conn.execute(f"ALTER INDEX {name} ATTACH PARTITION {part_index};")
+
+
+# --- Migrations ---
+
+async def _v1_baseline(conn):
+    # Everything init_db used to create on each start. IF NOT EXISTS so that
+    # installs predating schema_version adopt it without changes.
+
+    # Enable Vector Extension (Future Proofing)
+    await conn.execute("CREATE EXTENSION IF NOT EXISTS vector;")
+
+    # AI Tokens (OAuth)
+    await conn.execute("""
+        CREATE TABLE IF NOT EXISTS ai_tokens (
+            phone_number TEXT PRIMARY KEY,
+            access_token TEXT,
+            refresh_token TEXT,
+            client_id TEXT,
+            client_secret TEXT,
+            token_uri TEXT,
+            scopes TEXT,
+            created_at TIMESTAMP DEFAULT NOW(),
+            updated_at TIMESTAMP DEFAULT NOW()
+        );
+    """)
+
+    # Chat History (monthly partitions)
+    # Pre-partitioning installs keep working until converted online with
+    # scripts/chat_partitions.py migrate
+    if await is_partitioned(conn, "chat_sessions") is False:
+        logger.warning("⚠️ chat_sessions is not partitioned. Run: python scripts/chat_partitions.py migrate")
+    else:
+        await create_chat_sessions_table(conn)
+
+    # User Profiles (Semantic Memory)
+    await conn.execute("""
+        CREATE TABLE IF NOT EXISTS user_profile (
+            user_id TEXT PRIMARY KEY,
+            profile_data JSONB DEFAULT '{}'::jsonb,
+            updated_at TIMESTAMP DEFAULT NOW()
+        );
+    """)
+
+    # Payments
+    await conn.execute("""
+        CREATE TABLE IF NOT EXISTS payments (
+            code TEXT PRIMARY KEY,
+            amount DECIMAL,
+            currency TEXT,
+            sender_phone TEXT,
+            status TEXT DEFAULT 'PENDING',
+            claimed_by TEXT,
+            raw_message TEXT,
+            created_at TIMESTAMP DEFAULT NOW(),
+            updated_at TIMESTAMP DEFAULT NOW()
+        );
+    """)
+
+    # Personas
+    await conn.execute("""
+        CREATE TABLE IF NOT EXISTS personas (
+            id SERIAL PRIMARY KEY,
+            name TEXT NOT NULL,
+            description TEXT,
+            system_prompt TEXT NOT NULL,
+            allowed_tools JSONB DEFAULT '[]'::jsonb,
+            model_config JSONB DEFAULT '{}'::jsonb,
+            owner_phone TEXT,
+            is_default BOOLEAN DEFAULT FALSE,
+            created_at TIMESTAMP DEFAULT NOW(),
+            updated_at TIMESTAMP DEFAULT NOW()
+        );
+    """)
+
+
+async def _v2_jsonb_deep_merge(conn):
+    # Recursive JSONB merge used by merge_profile(deep=True)
+    await conn.execute("""
+        CREATE OR REPLACE FUNCTION jsonb_deep_merge(a jsonb, b jsonb) RETURNS jsonb
+        LANGUAGE plpgsql IMMUTABLE AS $$
+        BEGIN
+            IF jsonb_typeof(a) = 'object' AND jsonb_typeof(b) = 'object' THEN
+                RETURN (
+                    SELECT COALESCE(jsonb_object_agg(k,
+                        CASE WHEN a ? k AND b ? k THEN jsonb_deep_merge(a -> k, b -> k)
+                             WHEN b ? k THEN b -> k
+                             ELSE a -> k END), '{}'::jsonb)
+                    FROM (SELECT jsonb_object_keys(a) AS k UNION SELECT jsonb_object_keys(b)) keys
+                );
+            END IF;
+            RETURN b;
+        END
+        $$;
+    """)
+
+
+async def _v3_personas_notify(conn):
+    # Persona edits are pushed to every worker's registry (LISTEN personas_changed)
+    await conn.execute("""
+        CREATE OR REPLACE FUNCTION notify_personas_changed() RETURNS trigger
+        LANGUAGE plpgsql AS $$
+        BEGIN
+            PERFORM pg_notify('personas_changed', COALESCE(NEW.id, OLD.id)::text);
+            RETURN NULL;
+        END
+        $$;
+    """)
+    await conn.execute("""
+        DROP TRIGGER IF EXISTS personas_changed ON personas;
+        CREATE TRIGGER personas_changed
+            AFTER INSERT OR UPDATE OR DELETE ON personas
+            FOR EACH ROW EXECUTE FUNCTION notify_personas_changed();
+    """)
+
+
+async def _v4_legacy_chat_keyset_index(conn):
+    # Installs still on the flat chat_sessions get the same top-N index the
+    # partitioned layout has, built online. (Partitioned parents can't use
+    # CONCURRENTLY and already have it.)
+    if await is_partitioned(conn, "chat_sessions") is False:
+        await create_index_concurrently(
+            conn, "idx_chat_sessions_user_recent", "chat_sessions", "user_id, created_at DESC"
+        )
+
+
+async def _v5_chat_summaries(conn):
+    # Rolling summary of turns that no longer fit the prompt's history budget.
+    # covered_until = created_at of the newest message folded into it.
+    await conn.execute("""
+        CREATE TABLE IF NOT EXISTS chat_summaries (
+            user_id TEXT PRIMARY KEY,
+            summary TEXT NOT NULL,
+            covered_until TIMESTAMP NOT NULL,
+            updated_at TIMESTAMP DEFAULT NOW()
+        );
+    """)
+
+
+async def _v6_llm_usage(conn):
+    # Append-only ledger of Gemini calls, COPY'd in batches by usage_writer.
+    # key_id is the md5 of the API key (same id as key_fail:*), never the key.
+    await conn.execute("""
+        CREATE TABLE IF NOT EXISTS llm_usage (
+            created_at TIMESTAMP NOT NULL DEFAULT NOW(),
+            user_id TEXT,
+            persona_id INT,
+            kind TEXT NOT NULL DEFAULT 'chat',
+            model TEXT,
+            key_id TEXT,
+            prompt_tokens INT NOT NULL DEFAULT 0,
+            output_tokens INT NOT NULL DEFAULT 0,
+            thoughts_tokens INT NOT NULL DEFAULT 0,
+            cached_tokens INT NOT NULL DEFAULT 0,
+            latency_ms INT
+        );
+        CREATE INDEX IF NOT EXISTS idx_llm_usage_created ON llm_usage (created_at);
+        CREATE INDEX IF NOT EXISTS idx_llm_usage_user ON llm_usage (user_id, created_at);
+    """)
+    # Daily rollups: who is eating throughput, and how close each key runs to its quota
+    await conn.execute("""
+        CREATE OR REPLACE VIEW llm_usage_daily_users AS
+        SELECT date_trunc('day', created_at)::date AS day, user_id,
+               count(*) AS calls,
+               sum(prompt_tokens) AS prompt_tokens,
+               sum(output_tokens + thoughts_tokens) AS output_tokens,
+               sum(prompt_tokens + output_tokens + thoughts_tokens) AS total_tokens,
+               round(avg(latency_ms)) AS avg_latency_ms
+        FROM llm_usage GROUP BY 1, 2;
+
+        CREATE OR REPLACE VIEW llm_usage_daily_keys AS
+        SELECT date_trunc('day', created_at)::date AS day, key_id, model,
+               count(*) AS calls,
+               sum(prompt_tokens + output_tokens + thoughts_tokens) AS total_tokens,
+               max(prompt_tokens + output_tokens + thoughts_tokens) AS max_call_tokens,
+               percentile_cont(0.95) WITHIN GROUP (ORDER BY latency_ms) AS p95_latency_ms
+        FROM llm_usage GROUP BY 1, 2, 3;
+
+        CREATE OR REPLACE VIEW llm_usage_daily_personas AS
+        SELECT date_trunc('day', created_at)::date AS day, persona_id, kind,
+               count(*) AS calls,
+               count(DISTINCT user_id) AS users,
+               sum(prompt_tokens + output_tokens + thoughts_tokens) AS total_tokens
+        FROM llm_usage GROUP BY 1, 2, 3;
+    """)
+
+
+async def _v7_broadcast_items(conn):
+    # One row per finished broadcast item, so a re-POST of the job skips them.
+    await conn.execute("""
+        CREATE TABLE IF NOT EXISTS broadcast_items (
+            job_id TEXT NOT NULL,
+            item_index INT NOT NULL,
+            user_urn TEXT NOT NULL,
+            status TEXT NOT NULL,
+            reply TEXT,
+            error TEXT,
+            attempts INT NOT NULL DEFAULT 1,
+            updated_at TIMESTAMP DEFAULT NOW(),
+            PRIMARY KEY (job_id, item_index)
+        );
+    """)
+
+
+async def _v8_chat_keyset_index_name(conn):
+    # v4 gave the flat table's index the name the partitioned layout uses, so
+    # `chat_partitions.py migrate` found it taken (CREATE INDEX IF NOT EXISTS)
+    # and the converted chat_sessions ended up without one, the old index
+    # moving to chat_sessions_legacy with the swap. The flat/legacy index gets
+    # its own name; a partitioned chat_sessions missing its index gets it.
+    owner = await index_table(conn, "idx_chat_sessions_user_recent")
+    partitioned = await is_partitioned(conn, "chat_sessions")
+    if owner is not None and (owner != "chat_sessions" or not partitioned):
+        await conn.execute(
+            "ALTER INDEX idx_chat_sessions_user_recent RENAME TO idx_chat_sessions_legacy_user_recent;"
+        )
+    if partitioned:
+        await create_partitioned_index_concurrently(
+            conn, "idx_chat_sessions_user_recent", "chat_sessions", "user_id, created_at DESC"
+        )
+
+
+async def _v9_broadcast_items_saved(conn):
+    # Whether the item's campaign text is already in the user's history, so a
+    # resumed job retries a failed item without saving it a second time.
+    await conn.execute("""
+        ALTER TABLE broadcast_items ADD COLUMN IF NOT EXISTS user_message_saved BOOLEAN NOT NULL DEFAULT FALSE;
+    """)
+
+
+MIGRATIONS = [
+    Migration(1, "baseline", _v1_baseline),
+    Migration(2, "jsonb_deep_merge", _v2_jsonb_deep_merge),
+    Migration(3, "personas_notify", _v3_personas_notify),
+    Migration(4, "legacy_chat_keyset_index", _v4_legacy_chat_keyset_index, transactional=False),
+    Migration(5, "chat_summaries", _v5_chat_summaries),
+    Migration(6, "llm_usage", _v6_llm_usage),
+    Migration(7, "broadcast_items", _v7_broadcast_items),
+    Migration(8, "chat_keyset_index_name", _v8_chat_keyset_index_name, transactional=False),
+    Migration(9, "broadcast_items_saved", _v9_broadcast_items_saved),
+]
+LATEST_VERSION = max(m.version for m in MIGRATIONS)
+
+
+# --- Runner ---
+
+async def _check(conn):
+    """(current version, partitions ok) in one round trip. Version 0 = no schema_version yet."""
+    horizon = chat_partition_name(_month_start(date.today(), CHAT_PARTITION_MONTHS_AHEAD))
+    try:
+        row = await conn.fetchrow("""
+            SELECT
+                (SELECT MAX(version) FROM schema_version) AS version,
+                -- Nothing to pre-create for a missing or legacy (flat) chat_sessions
+                (SELECT relkind::text FROM pg_class WHERE oid = to_regclass('chat_sessions'))
+                    IS DISTINCT FROM 'p' OR to_regclass($1) IS NOT NULL AS partitions_ok
+        """, horizon)
+    except asyncpg.UndefinedTableError:
+        return 0, False
+    return row["version"] or 0, row["partitions_ok"]
+
+
+async def run_migrations(conn):
+    """Brings the schema to LATEST_VERSION. Returns the list of versions applied."""
+    version, partitions_ok = await _check(conn)
+    if version >= LATEST_VERSION and partitions_ok:
+        logger.info(f"✅ Schema up to date (v{version})")
+        return []
+
+    # Poll instead of blocking in pg_advisory_lock: a worker blocked inside that
+    # statement holds a snapshot, and CREATE INDEX CONCURRENTLY in the worker
+    # that owns the lock waits for every snapshot -> deadlock.
+    while not await conn.fetchval("SELECT pg_try_advisory_lock($1)", MIGRATION_LOCK_ID):
+        await asyncio.sleep(MIGRATION_LOCK_POLL_SECONDS)
+    try:
+        await conn.execute("""
+            CREATE TABLE IF NOT EXISTS schema_version (
+                version INT PRIMARY KEY,
+                name TEXT NOT NULL,
+                applied_at TIMESTAMP DEFAULT NOW()
+            );
+        """)
+        # Another worker may have finished while we waited for the lock
+        version = await conn.fetchval("SELECT COALESCE(MAX(version), 0) FROM schema_version")
+        applied = []
+        for m in MIGRATIONS:
+            if m.version <= version:
+                continue
+            logger.info(f"🛠️ Applying migration v{m.version} {m.name}")
+            if m.transactional:
+                async with conn.transaction():
+                    await m.apply(conn)
+                    await conn.execute("INSERT INTO schema_version (version, name) VALUES ($1, $2)", m.version, m.name)
+            else:
+                # Must be idempotent: a crash before the INSERT re-runs it
+                await m.apply(conn)
+                await conn.execute("INSERT INTO schema_version (version, name) VALUES ($1, $2)", m.version, m.name)
+            applied.append(m.version)
+
+        if await is_partitioned(conn, "chat_sessions"):
+            await ensure_chat_partitions(conn)
+        return applied
+    finally:
+        await conn.execute("SELECT pg_advisory_unlock($1)", MIGRATION_LOCK_ID)
+
+
+async def migrate():
+    async with acquire() as conn:
+        return await run_migrations(conn)
+
+
+async def ensure_partitions_now() -> bool:
+    """One in-process partition check. False if another worker holds the lock (it's on it)."""
+    async with acquire() as conn:
+        if not await conn.fetchval("SELECT pg_try_advisory_lock($1)", MIGRATION_LOCK_ID):
+            return False
+        try:
+            if await is_partitioned(conn, "chat_sessions"):
+                await ensure_chat_partitions(conn)
+            return True
+        finally:
+            await conn.execute("SELECT pg_advisory_unlock($1)", MIGRATION_LOCK_ID)
+
+
+async def maintain_partitions():
+    """
+    Background loop: re-runs the partition check every CHAT_PARTITION_CHECK_SECONDS,
+    so a long-running worker creates next month's partition even when the cron
+    `maintain` job was missed (otherwise its rows pile up in chat_sessions_default).
+    """
+    while True:
+        await asyncio.sleep(CHAT_PARTITION_CHECK_SECONDS)
+        try:
+            await ensure_partitions_now()
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.warning(f"⚠️ Partition maintenance failed, retry in {CHAT_PARTITION_CHECK_SECONDS:.0f}s: {e}")
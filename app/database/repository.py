@@ -1,58 +1,174 @@
 import json
-from app.database.connection import get_db_connection
+from datetime import datetime
+from dataclasses import dataclass, field
+from typing import Optional
+from app.database.connection import acquire
+from app.database.write_behind import chat_writer
+from app.services.cache import get_cached_history, warm_history, push_history, HISTORY_CACHE_SIZE
+
+def _json(value):
+    # asyncpg hands json/jsonb back as text unless a codec is registered
+    return json.loads(value) if isinstance(value, str) else value
 
 # --- User Tokens Repository ---
 async def get_token(phone_number: str):
-    conn = await get_db_connection()
-    try:
+    async with acquire() as conn:
         row = await conn.fetchrow("SELECT * FROM ai_tokens WHERE phone_number = $1", phone_number)
         return dict(row) if row else None
-    finally:
-        await conn.close()
 
 # --- Chat History Repository ---
 async def get_history(user_id: str, limit: int = 10):
-    conn = await get_db_connection()
-    try:
-        # Fetch last N messages
-        # Note: We likely want them in chronological order for the LLM
+    # Hot path: the per-user ring buffer in Valkey
+    cached = await get_cached_history(user_id, limit)
+    if cached is not None:
+        return cached
+
+    # Miss: read enough from Postgres to warm the whole ring, not just `limit`
+    fetch = max(limit, HISTORY_CACHE_SIZE)
+    # Snapshot unflushed writes BEFORE reading, see ChatHistoryWriter.merge
+    pending = chat_writer.pending_for(user_id)
+    async with acquire() as conn:
+        # Fetch last N messages: a top-N walk of the (user_id, created_at DESC)
+        # index, no sort over the user's whole history.
         rows = await conn.fetch("""
-            SELECT role, content FROM (
-                SELECT role, content, created_at FROM chat_sessions 
-                WHERE user_id = $1 
-                ORDER BY created_at DESC 
-                LIMIT $2
-            ) sub ORDER BY created_at ASC
-        """, user_id, limit)
-        return [dict(role=r["role"], content=r["content"]) for r in rows]
-    finally:
-        await conn.close()
+            SELECT role, content, created_at FROM chat_sessions
+            WHERE user_id = $1
+            ORDER BY created_at DESC
+            LIMIT $2
+        """, user_id, fetch)
+    # We want them in chronological order for the LLM
+    history = [dict(role=r["role"], content=r["content"]) for r in reversed(rows)]
+    if pending:
+        history = chat_writer.merge(history, rows[0]["created_at"] if rows else None, pending, fetch)
+    await warm_history(user_id, history)
+    return history[-limit:] if limit else []
 
 async def save_message(user_id: str, role: str, content: str):
-    conn = await get_db_connection()
-    try:
-        await conn.execute(
-            "INSERT INTO chat_sessions (user_id, role, content) VALUES ($1, $2, $3)",
-            user_id, role, content
+    # Write-behind: queued and COPY'd in batches, the caller does not wait on a commit
+    if chat_writer.running:
+        await chat_writer.save(user_id, role, content)
+    else:
+        async with acquire() as conn:
+            await conn.execute(
+                "INSERT INTO chat_sessions (user_id, role, content) VALUES ($1, $2, $3)",
+                user_id, role, content
+            )
+    await push_history(user_id, role, content)
+    return True
+
+# --- Conversation Context (single round trip) ---
+@dataclass
+class ConversationContext:
+    """Everything process_chat_request needs before calling the LLM."""
+    profile: dict = field(default_factory=dict)
+    token: Optional[dict] = None
+    history: list = field(default_factory=list)
+    persona: Optional[dict] = None
+    summary: Optional[str] = None  # rolling summary of turns older than the history budget
+
+async def load_conversation_context(user_id: str, phone_number: str, user_message: str = None,
+                                    history_limit: int = 10, persona_id: int = None):
+    """
+    Loads profile, OAuth token, last-N history and (optionally) a persona in ONE
+    statement, and inserts the incoming user message in the same round trip.
+    The history subquery runs on the statement snapshot, so it does not include
+    the message being inserted.
+    With write-behind enabled the user message is queued instead of inserted.
+    """
+    # History from the Valkey ring when warm; then the statement skips it (LIMIT 0)
+    cached = await get_cached_history(user_id, history_limit)
+    fetch = 0 if cached is not None else max(history_limit, HISTORY_CACHE_SIZE)
+    pending = chat_writer.pending_for(user_id)
+    inline_message = None if chat_writer.running else user_message
+    async with acquire() as conn:
+        row = await conn.fetchrow("""
+            WITH inserted AS (
+                INSERT INTO chat_sessions (user_id, role, content)
+                SELECT $1, 'user', $4::text WHERE $4::text IS NOT NULL
+                RETURNING 1
+            ), h AS (
+                SELECT role, content, created_at FROM chat_sessions
+                WHERE user_id = $1
+                ORDER BY created_at DESC
+                LIMIT $3
+            )
+            SELECT
+                (SELECT profile_data FROM user_profile WHERE user_id = $1) AS profile,
+                (SELECT row_to_json(t) FROM ai_tokens t WHERE t.phone_number = $2) AS token,
+                (SELECT COALESCE(json_agg(json_build_object('role', h.role, 'content', h.content)
+                                          ORDER BY h.created_at), '[]'::json)
+                   FROM h) AS history,
+                (SELECT MAX(created_at) FROM h) AS history_last_at,
+                (SELECT row_to_json(p) FROM personas p WHERE p.id = $5::int) AS persona,
+                (SELECT summary FROM chat_summaries WHERE user_id = $1) AS summary,
+                (SELECT count(*) FROM inserted) AS inserted
+        """, user_id, phone_number, fetch, inline_message, persona_id)
+
+    if cached is not None:
+        history = cached
+    else:
+        history = _json(row["history"]) or []
+        if pending:
+            history = chat_writer.merge(history, row["history_last_at"], pending, fetch)
+        await warm_history(user_id, history)
+        history = history[-history_limit:] if history_limit else []
+
+    if user_message is not None:
+        if inline_message is None:
+            await chat_writer.save(user_id, "user", user_message)
+        await push_history(user_id, "user", user_message)
+
+    return ConversationContext(
+        profile=_json(row["profile"]) or {},
+        token=_json(row["token"]),
+        history=history,
+        persona=_json(row["persona"]),
+        summary=row["summary"],
+    )
+
+# --- Rolling Conversation Summary ---
+async def get_unsummarized_messages(user_id: str, limit: int):
+    """
+    Current summary plus the newest `limit` messages it doesn't cover yet
+    (chronological, with created_at).
+    """
+    async with acquire() as conn:
+        summary = await conn.fetchrow(
+            "SELECT summary, covered_until FROM chat_summaries WHERE user_id = $1", user_id
         )
-        return True
-    finally:
-        await conn.close()
+        rows = await conn.fetch("""
+            SELECT role, content, created_at FROM chat_sessions
+            WHERE user_id = $1 AND created_at > $2
+            ORDER BY created_at DESC
+            LIMIT $3
+        """, user_id, summary["covered_until"] if summary else datetime.min, limit)
+    messages = [dict(role=r["role"], content=r["content"], created_at=r["created_at"]) for r in reversed(rows)]
+    return (summary["summary"] if summary else None), messages
+
+async def save_summary(user_id: str, summary: str, covered_until):
+    async with acquire() as conn:
+        await conn.execute("""
+            INSERT INTO chat_summaries (user_id, summary, covered_until, updated_at)
+            VALUES ($1, $2, $3, NOW())
+            ON CONFLICT (user_id) DO UPDATE SET
+                summary = EXCLUDED.summary,
+                covered_until = EXCLUDED.covered_until,
+                updated_at = NOW()
+            WHERE chat_summaries.covered_until < EXCLUDED.covered_until
+        """, user_id, summary, covered_until)
 
 # --- Semantic Profile Repository ---
 async def get_profile(user_id: str):
-    conn = await get_db_connection()
-    try:
-        row = await conn.fetchrow("SELECT profile_data FROM user_profile WHERE user_id = $1", user_id)
-        return dict(row["profile_data"]) if row and row["profile_data"] else {}
-    except Exception:
-        return {} 
-    finally:
-        await conn.close()
+    async with acquire() as conn:
+        try:
+            row = await conn.fetchrow("SELECT profile_data FROM user_profile WHERE user_id = $1", user_id)
+            profile = _json(row["profile_data"]) if row else None
+            return dict(profile) if profile else {}
+        except Exception:
+            return {}
 
 async def save_profile(user_id: str, profile_data: dict):
-    conn = await get_db_connection()
-    try:
+    async with acquire() as conn:
         json_data = json.dumps(profile_data)
         await conn.execute("""
             INSERT INTO user_profile (user_id, profile_data, updated_at)
@@ -61,96 +177,199 @@ async def save_profile(user_id: str, profile_data: dict):
                 profile_data = $2,
                 updated_at = NOW();
         """, user_id, json_data)
-    finally:
-        await conn.close()
+
+async def merge_profile(user_id: str, patch: dict, deep: bool = False, remove_keys: list = None):
+    """
+    Atomically merges `patch` into the stored profile (profile_data || patch) and
+    returns the new document. One statement, only the patch on the wire, and
+    concurrent merges for the same user cannot drop each other's keys.
+    deep=True merges nested objects key by key (jsonb_deep_merge) instead of
+    replacing them; `remove_keys` deletes top-level keys in the same statement.
+    """
+    async with acquire() as conn:
+        merged = await conn.fetchval("""
+            INSERT INTO user_profile (user_id, profile_data, updated_at)
+            VALUES ($1, $2::jsonb - $4::text[], NOW())
+            ON CONFLICT (user_id) DO UPDATE SET
+                profile_data = (
+                    CASE WHEN $3::boolean
+                        THEN jsonb_deep_merge(COALESCE(user_profile.profile_data, '{}'::jsonb), $2::jsonb)
+                        ELSE COALESCE(user_profile.profile_data, '{}'::jsonb) || $2::jsonb
+                    END
+                ) - $4::text[],
+                updated_at = NOW()
+            RETURNING profile_data
+        """, user_id, json.dumps(patch), deep, list(remove_keys or []))
+        return _json(merged) or {}
 
 # --- Personas Repository (New) ---
-async def get_persona(persona_id: str):
-    conn = await get_db_connection()
-    try:
-        row = await conn.fetchrow("SELECT * FROM personas WHERE id = $1", persona_id)
-        return dict(row) if row else None
-    finally:
-        await conn.close()
-        
+def _persona(row):
+    if not row:
+        return None
+    persona = dict(row)
+    persona["allowed_tools"] = _json(persona.get("allowed_tools")) or []
+    persona["model_config"] = _json(persona.get("model_config")) or {}
+    return persona
+
+async def load_personas():
+    """All personas, for the in-memory registry (app/personas/registry.py)."""
+    async with acquire() as conn:
+        rows = await conn.fetch("SELECT * FROM personas ORDER BY id")
+        return [_persona(r) for r in rows]
+
+async def get_persona(persona_id: int):
+    async with acquire() as conn:
+        row = await conn.fetchrow("SELECT * FROM personas WHERE id = $1", int(persona_id))
+        return _persona(row)
+
 async def get_default_persona():
     # Returns the "Master Bot" or default config
     # For now, if no table exists or no row, we return a hardcoded fallback or None
     # Ideally we fetch the row marked 'is_default'
-    conn = await get_db_connection()
-    try:
-        row = await conn.fetchrow("SELECT * FROM personas WHERE is_default = TRUE LIMIT 1")
-        if row: return dict(row)
-        
-        # Fallback if DB empty (bootstrapping)
-        return {
-            "name": "Sarah",
-            "system_prompt": "You are Sarah, the KonexPro AI Specialist...",
-            "tools": ["generate_payment_link", "update_profile"],
-            "model": "gemini-2.0-flash"
-        }
-    except Exception:
-        # DB Table might not exist yet
-        return None
-    finally:
-        await conn.close()
+    async with acquire() as conn:
+        try:
+            row = await conn.fetchrow("SELECT * FROM personas WHERE is_default = TRUE LIMIT 1")
+            if row: return _persona(row)
+
+            # Fallback if DB empty (bootstrapping)
+            return {
+                "name": "Sarah",
+                "system_prompt": "You are Sarah, the KonexPro AI Specialist...",
+                "tools": ["generate_payment_link", "update_profile"],
+                "model": "gemini-2.0-flash"
+            }
+        except Exception:
+            # DB Table might not exist yet
+            return None
+
+# --- Broadcast Jobs Repository ---
+async def get_broadcast_results(job_id: str) -> dict:
+    """Finished items of a broadcast job: {item_index: row}."""
+    async with acquire() as conn:
+        rows = await conn.fetch("""
+            SELECT item_index, user_urn, status, reply, error, attempts, user_message_saved
+            FROM broadcast_items WHERE job_id = $1
+        """, job_id)
+        return {r["item_index"]: dict(r) for r in rows}
+
+async def save_broadcast_result(job_id: str, item_index: int, user_urn: str, status: str,
+                                reply: str = None, error: str = None, attempts: int = 1,
+                                user_message_saved: bool = False):
+    """`user_message_saved`: the item's text is in the user's history (sticky for the same user)."""
+    async with acquire() as conn:
+        await conn.execute("""
+            INSERT INTO broadcast_items (job_id, item_index, user_urn, status, reply, error, attempts,
+                                         user_message_saved)
+            VALUES ($1, $2, $3, $4, $5, $6, $7, $8)
+            ON CONFLICT (job_id, item_index) DO UPDATE
+            SET user_urn = EXCLUDED.user_urn, status = EXCLUDED.status, reply = EXCLUDED.reply,
+                error = EXCLUDED.error, attempts = broadcast_items.attempts + EXCLUDED.attempts,
+                user_message_saved = EXCLUDED.user_message_saved OR (
+                    broadcast_items.user_message_saved AND broadcast_items.user_urn = EXCLUDED.user_urn),
+                updated_at = NOW()
+        """, job_id, item_index, user_urn, status, reply, error, attempts, user_message_saved)
+
+async def get_broadcast_summary(job_id: str) -> dict:
+    async with acquire() as conn:
+        rows = await conn.fetch("""
+            SELECT status, count(*) AS n FROM broadcast_items WHERE job_id = $1 GROUP BY status
+        """, job_id)
+        return {r["status"]: r["n"] for r in rows}
 
 # --- Payments Repository ---
 async def record_payment(code: str, amount: float, currency: str, sender: str, raw_message: str):
-    conn = await get_db_connection()
-    try:
-        await conn.execute("""
-            INSERT INTO payments (code, amount, currency, sender_phone, raw_message, status)
-            VALUES ($1, $2, $3, $4, $5, 'PENDING')
-            ON CONFLICT (code) DO NOTHING
-        """, code, amount, currency, sender, raw_message)
-        return True
-    except Exception as e:
-        # print(f"DB Error record_payment: {e}") # Use logger in real app
-        return False
-    finally:
-        await conn.close()
+    async with acquire() as conn:
+        try:
+            await conn.execute("""
+                INSERT INTO payments (code, amount, currency, sender_phone, raw_message, status)
+                VALUES ($1, $2, $3, $4, $5, 'PENDING')
+                ON CONFLICT (code) DO NOTHING
+            """, code, amount, currency, sender, raw_message)
+            return True
+        except Exception as e:
+            # print(f"DB Error record_payment: {e}") # Use logger in real app
+            return False
+
+def _claim_result(row, user_id: str):
+    """Maps one claim row (claimed, claimed_amount, status, claimed_by) to (success, message, amount)."""
+    if row is not None and row['claimed']:
+        # Decided by the UPDATE itself; the amount may well be NULL
+        return True, "Payment verified successfully!", float(row['claimed_amount'] or 0)
+    if row is None or row['status'] is None:
+        return False, "Payment code not found.", 0.0
+    if row['status'] == 'CLAIMED':
+        if row['claimed_by'] == user_id:
+            return False, "You have already used this code.", 0.0
+        return False, "This code has already been used by someone else.", 0.0
+    # Still PENDING in our snapshot: a concurrent claim won the row lock
+    return False, "Could not claim payment (technical conflict).", 0.0
 
 async def claim_payment(code: str, user_id: str):
-    conn = await get_db_connection()
-    try:
-        row = await conn.fetchrow("SELECT status, amount, currency, claimed_by FROM payments WHERE code = $1", code)
-        
-        if not row:
-            return False, "Payment code not found.", 0.0
-            
-        if row['status'] == 'CLAIMED':
-            if row['claimed_by'] == user_id:
-                return False, "You have already used this code.", 0.0
-            return False, "This code has already been used by someone else.", 0.0
-            
-        # Atomic Update
-        result = await conn.execute("""
-            UPDATE payments 
-            SET status = 'CLAIMED', claimed_by = $2, updated_at = NOW()
-            WHERE code = $1 AND status = 'PENDING'
+    """
+    Claims a PENDING payment in one statement. The UPDATE only matches
+    PENDING rows, so two users racing for the same code cannot both win;
+    the outer SELECT reads the pre-update row to explain a failed claim.
+    """
+    async with acquire() as conn:
+        row = await conn.fetchrow("""
+            WITH claimed AS (
+                UPDATE payments
+                SET status = 'CLAIMED', claimed_by = $2, updated_at = NOW()
+                WHERE code = $1 AND status = 'PENDING'
+                RETURNING amount
+            )
+            SELECT (SELECT count(*) FROM claimed) > 0 AS claimed, c.amount AS claimed_amount,
+                   p.status, p.claimed_by
+            FROM (SELECT 1) one
+            LEFT JOIN claimed c ON TRUE
+            LEFT JOIN payments p ON p.code = $1
         """, code, user_id)
-        
-        if result == "UPDATE 1":
-            return True, "Payment verified successfully!", float(row['amount'])
-        else:
-            return False, "Could not claim payment (technical conflict).", 0.0
-            
-    finally:
-        await conn.close()
+        return _claim_result(row, user_id)
+
+async def claim_payments_bulk(claims: list):
+    """
+    Claims many (code, user_id) pairs in one statement via unnest, for
+    reconciliation jobs. Returns {code: (success, message, amount)}.
+    If a code appears more than once, the first pair in `claims` wins.
+    """
+    if not claims:
+        return {}
+    codes = [c for c, _ in claims]
+    users = [u for _, u in claims]
+    async with acquire() as conn:
+        rows = await conn.fetch("""
+            WITH req AS (
+                SELECT DISTINCT ON (code) code, user_id
+                FROM unnest($1::text[], $2::text[]) WITH ORDINALITY AS r(code, user_id, ord)
+                ORDER BY code, ord
+            ),
+            claimed AS (
+                UPDATE payments p
+                SET status = 'CLAIMED', claimed_by = req.user_id, updated_at = NOW()
+                FROM req
+                WHERE p.code = req.code AND p.status = 'PENDING'
+                RETURNING p.code, p.amount
+            )
+            SELECT req.code, req.user_id, c.code IS NOT NULL AS claimed, c.amount AS claimed_amount,
+                   p.status, p.claimed_by
+            FROM req
+            LEFT JOIN claimed c ON c.code = req.code
+            LEFT JOIN payments p ON p.code = req.code
+        """, codes, users)
+        return {row['code']: _claim_result(row, row['user_id']) for row in rows}
+
 async def save_token(phone_number: str, token_info: dict):
     """
     Saves or updates the Google OAuth token for a user.
     """
-    conn = await get_db_connection()
-    try:
+    async with acquire() as conn:
         # We store the entire JSON blob of token info
         # But we also extract the access_token for the primary column if needed
         # Assuming schema has: phone_number, access_token, refresh_token, etc.?
         # Or just a JSONB column?
         # Looking at schema.py earlier, it was:
         # access_token TEXT NOT NULL, refresh_token TEXT, token_uri TEXT, ...
-        
+
         await conn.execute("""
             INSERT INTO ai_tokens (phone_number, access_token, refresh_token, token_uri, client_id, client_secret, scopes, created_at)
             VALUES ($1, $2, $3, $4, $5, $6, $7, NOW())
@@ -159,8 +378,8 @@ async def save_token(phone_number: str, token_info: dict):
                 refresh_token = $3,
                 token_uri = $4,
                 created_at = NOW();
-        """, 
-        phone_number, 
+        """,
+        phone_number,
         token_info.get("token"),
         token_info.get("refresh_token"),
         token_info.get("token_uri"),
@@ -168,5 +387,3 @@ async def save_token(phone_number: str, token_info: dict):
         token_info.get("client_secret"),
         json.dumps(token_info.get("scopes", []))
         )
-    finally:
-        await conn.close()
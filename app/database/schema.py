@@ -1,80 +1,123 @@
-from app.database.connection import get_db_connection
+import os
+import logging
+from datetime import date
 
-async def init_db():
-    conn = await get_db_connection()
-    try:
-        # 0. Enable Vector Extension (Future Proofing)
-        await conn.execute("CREATE EXTENSION IF NOT EXISTS vector;")
+logger = logging.getLogger(__name__)
 
-        # 1. AI Tokens (OAuth)
-        await conn.execute("""
-            CREATE TABLE IF NOT EXISTS ai_tokens (
-                phone_number TEXT PRIMARY KEY,
-                access_token TEXT,
-                refresh_token TEXT,
-                client_id TEXT,
-                client_secret TEXT,
-                token_uri TEXT,
-                scopes TEXT,
-                created_at TIMESTAMP DEFAULT NOW(),
-                updated_at TIMESTAMP DEFAULT NOW()
-            );
-        """)
+# How many future monthly partitions of chat_sessions to keep pre-created
+CHAT_PARTITION_MONTHS_AHEAD = int(os.getenv("CHAT_PARTITION_MONTHS_AHEAD", "2"))
+# Running workers re-check the upcoming partitions this often (not just at startup)
+CHAT_PARTITION_CHECK_SECONDS = float(os.getenv("CHAT_PARTITION_CHECK_SECONDS", "21600"))
 
-        # 2. Chat History
-        await conn.execute("""
-            CREATE TABLE IF NOT EXISTS chat_sessions (
-                user_id TEXT,
-                role TEXT,
-                content TEXT,
-                created_at TIMESTAMP DEFAULT NOW()
-            );
-        """)
-        await conn.execute("CREATE INDEX IF NOT EXISTS idx_chat_user ON chat_sessions(user_id);")
+def _month_start(d: date, offset: int = 0) -> date:
+    m = d.year * 12 + (d.month - 1) + offset
+    return date(m // 12, m % 12 + 1, 1)
 
-        # 3. User Profiles (Semantic Memory)
-        await conn.execute("""
-            CREATE TABLE IF NOT EXISTS user_profile (
-                user_id TEXT PRIMARY KEY,
-                profile_data JSONB DEFAULT '{}'::jsonb,
-                updated_at TIMESTAMP DEFAULT NOW()
-            );
-        """)
+def chat_partition_name(month: date, prefix: str = "chat_sessions") -> str:
+    return f"{prefix}_y{month.year}m{month.month:02d}"
 
-        # 4. Payments
-        await conn.execute("""
-            CREATE TABLE IF NOT EXISTS payments (
-                code TEXT PRIMARY KEY,
-                amount DECIMAL,
-                currency TEXT,
-                sender_phone TEXT,
-                status TEXT DEFAULT 'PENDING',
-                claimed_by TEXT,
-                raw_message TEXT,
-                created_at TIMESTAMP DEFAULT NOW(),
-                updated_at TIMESTAMP DEFAULT NOW()
-            );
-        """)
+async def is_partitioned(conn, table: str = "chat_sessions"):
+    """True/False for partitioned/plain table, None if it does not exist."""
+    kind = await conn.fetchval("SELECT relkind::text FROM pg_class WHERE oid = to_regclass($1)", table)
+    return None if kind is None else kind == "p"
 
-        # 5. Personas (New)
-        await conn.execute("""
-            CREATE TABLE IF NOT EXISTS personas (
-                id SERIAL PRIMARY KEY,
-                name TEXT NOT NULL,
-                description TEXT,
-                system_prompt TEXT NOT NULL,
-                allowed_tools JSONB DEFAULT '[]'::jsonb,
-                model_config JSONB DEFAULT '{}'::jsonb,
-                owner_phone TEXT,
-                is_default BOOLEAN DEFAULT FALSE,
-                created_at TIMESTAMP DEFAULT NOW(),
-                updated_at TIMESTAMP DEFAULT NOW()
-            );
+async def index_table(conn, index: str):
+    """Name of the table an index is on, None if there is no such index."""
+    return await conn.fetchval(
+        "SELECT indrelid::regclass::text FROM pg_index WHERE indexrelid = to_regclass($1)", index
+    )
+
+async def create_chat_sessions_table(conn, table: str = "chat_sessions", prefix: str = None):
+    """
+    Chat history, range-partitioned by month on created_at.
+    The (user_id, created_at DESC) index makes get_history a top-N index scan,
+    and old months can be detached as whole tables instead of DELETEd.
+    """
+    prefix = prefix or table
+    await conn.execute(f"""
+        CREATE TABLE IF NOT EXISTS {table} (
+            id BIGSERIAL,
+            user_id TEXT,
+            role TEXT,
+            content TEXT,
+            created_at TIMESTAMP NOT NULL DEFAULT NOW(),
+            PRIMARY KEY (id, created_at)
+        ) PARTITION BY RANGE (created_at);
+    """)
+    # Safety net for rows outside the pre-created months (clock skew, late maintenance)
+    await conn.execute(f"CREATE TABLE IF NOT EXISTS {prefix}_default PARTITION OF {table} DEFAULT;")
+    await conn.execute(f"CREATE INDEX IF NOT EXISTS idx_{prefix}_user_recent ON {table} (user_id, created_at DESC);")
+
+async def ensure_chat_partitions(conn, table: str = "chat_sessions", prefix: str = None,
+                                 since: date = None, months_ahead: int = None):
+    """
+    Creates monthly partitions from `since` (default: this month) up to N months ahead.
+    If maintenance was missed and the default partition already holds rows of a
+    month, they are moved into that month's new partition (one transaction):
+    Postgres refuses a plain PARTITION OF while the default has matching rows.
+    """
+    prefix = prefix or table
+    months_ahead = CHAT_PARTITION_MONTHS_AHEAD if months_ahead is None else months_ahead
+    today = date.today()
+    month = _month_start(since or today)
+    last = _month_start(today, months_ahead)
+    while month <= last:
+        nxt = _month_start(month, 1)
+        name = chat_partition_name(month, prefix)
+        if await conn.fetchval("SELECT to_regclass($1) IS NULL", name):
+            await _create_chat_partition(conn, table, f"{prefix}_default", name, month, nxt)
+        month = nxt
+
+async def _create_chat_partition(conn, table: str, default: str, name: str, month: date, nxt: date):
+    bounds = f"FROM ('{month}') TO ('{nxt}')"
+    in_month = f"created_at >= '{month}' AND created_at < '{nxt}'"
+    async with conn.transaction():
+        stranded = await conn.fetchval("SELECT to_regclass($1) IS NOT NULL", default) and \
+            await conn.fetchval(f"SELECT EXISTS (SELECT 1 FROM {default} WHERE {in_month})")
+        if not stranded:
+            await conn.execute(f"CREATE TABLE IF NOT EXISTS {name} PARTITION OF {table} FOR VALUES {bounds};")
+            return
+        # Build the month as a plain table, move its rows out of the default,
+        # then attach (the attach re-checks the default, now empty for that range)
+        await conn.execute(f"CREATE TABLE {name} (LIKE {table} INCLUDING DEFAULTS INCLUDING CONSTRAINTS);")
+        moved = await conn.execute(f"""
+            WITH moved AS (DELETE FROM {default} WHERE {in_month} RETURNING *)
+            INSERT INTO {name} SELECT * FROM moved
         """)
-        
-        # Seed Default Persona if needed?
-        # That's usually done in a seed script, but we can do it here for MVP convenience
-        # or leave it to the application logic to handle "No Persona Found".
+        await conn.execute(f"ALTER TABLE {table} ATTACH PARTITION {name} FOR VALUES {bounds};")
+    logger.warning(f"⚠️ {name}: moved {moved.split()[-1]} rows out of {default} (partition maintenance was late)")
 
-    finally:
-        await conn.close()
+async def detach_old_chat_partitions(conn, keep_months: int, table: str = "chat_sessions"):
+    """
+    Detaches monthly partitions that end before the retention window.
+    Detaching is a catalog change (no row deletes); the detached tables can
+    then be archived or dropped at leisure. Returns the detached table names.
+    """
+    cutoff = _month_start(date.today(), -keep_months)
+    rows = await conn.fetch("""
+        SELECT c.relname FROM pg_inherits i
+        JOIN pg_class c ON c.oid = i.inhrelid
+        WHERE i.inhparent = to_regclass($1)
+    """, table)
+    detached = []
+    for r in rows:
+        name = r["relname"]
+        try:
+            year, month = name.rsplit("_y", 1)[1].split("m")
+            month_start = date(int(year), int(month), 1)
+        except (IndexError, ValueError):
+            continue  # default partition or foreign naming
+        if _month_start(month_start, 1) <= cutoff:
+            await conn.execute(f"ALTER TABLE {table} DETACH PARTITION {name};")
+            detached.append(name)
+    return detached
+
+async def init_db():
+    """
+    Startup hook: one version check, migrations only when something is pending.
+    The DDL itself lives in app/database/migrations.py.
+    """
+    from app.database.migrations import migrate
+    applied = await migrate()
+    if applied:
+        logger.info(f"✅ Database migrated (applied {', '.join(f'v{v}' for v in applied)})")
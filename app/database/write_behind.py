@@ -0,0 +1,272 @@
+import os
+import asyncio
+import logging
+from datetime import datetime
+import asyncpg
+from app.database.connection import acquire
+from app.core import metrics
+
+logger = logging.getLogger(__name__)
+
+CHAT_WRITE_BEHIND = os.getenv("CHAT_WRITE_BEHIND", "true").lower() == "true"
+CHAT_FLUSH_INTERVAL_MS = int(os.getenv("CHAT_FLUSH_INTERVAL_MS", "200"))
+CHAT_FLUSH_MAX_ROWS = int(os.getenv("CHAT_FLUSH_MAX_ROWS", "500"))
+CHAT_WRITE_BUFFER_MAX = int(os.getenv("CHAT_WRITE_BUFFER_MAX", "10000"))
+USAGE_LEDGER_ENABLED = os.getenv("USAGE_LEDGER_ENABLED", "true").lower() == "true"
+
+# COPY attempts per batch before falling back to row-by-row INSERTs
+WRITE_BEHIND_COPY_ATTEMPTS = int(os.getenv("WRITE_BEHIND_COPY_ATTEMPTS", "4"))
+# stop() gives up on whatever is still unflushed after this long
+WRITE_BEHIND_STOP_TIMEOUT = float(os.getenv("WRITE_BEHIND_STOP_TIMEOUT", "10"))
+
+_STOP = object()
+# Postgres refused the row itself (e.g. a NUL byte in text): retrying won't help
+_BAD_ROW_ERRORS = (asyncpg.DataError, asyncpg.IntegrityConstraintViolationError)
+
+
+class BatchWriter:
+    """
+    Write-behind buffer for append-only tables.
+
+    Rows are queued in memory and flushed with COPY (copy_records_to_table)
+    every `flush_interval` seconds or `max_batch` rows, whichever comes first.
+    The queue is bounded: when Postgres falls behind, put() waits (backpressure)
+    instead of growing memory, and offer() drops the row instead (for data we
+    can lose). stop() flushes everything still queued, within WRITE_BEHIND_STOP_TIMEOUT.
+
+    A batch whose COPY keeps failing is written row by row after
+    WRITE_BEHIND_COPY_ATTEMPTS, so one bad row can't stall everything behind
+    it: rows Postgres rejects are logged and dropped (write_behind.dropped).
+    """
+
+    def __init__(self, table: str, columns: tuple, max_batch: int = 500,
+                 flush_interval: float = 0.2, max_pending: int = 10000):
+        self.table = table
+        self.columns = columns
+        self.max_batch = max_batch
+        self.flush_interval = flush_interval
+        self.max_pending = max_pending
+        self._queue = None
+        self._batch_ready = None
+        self._stopping = None
+        self._task = None
+        self.running = False
+
+    async def start(self):
+        if self.running:
+            return
+        self._queue = asyncio.Queue(maxsize=self.max_pending)
+        self._batch_ready = asyncio.Event()
+        self._stopping = asyncio.Event()
+        self._task = asyncio.create_task(self._run())
+        self.running = True
+        logger.info(f"📝 Write-behind for {self.table} started "
+                    f"(every {self.flush_interval * 1000:.0f}ms or {self.max_batch} rows)")
+
+    async def stop(self, timeout: float = None):
+        """Stops accepting rows and flushes what is queued; gives up after `timeout` seconds."""
+        if not self.running:
+            return
+        self.running = False
+        self._stopping.set()  # cuts retry back-offs short
+        try:
+            self._queue.put_nowait(_STOP)
+        except asyncio.QueueFull:
+            pass  # _run drains the queue and returns once it is empty
+        self._batch_ready.set()
+        timeout = WRITE_BEHIND_STOP_TIMEOUT if timeout is None else timeout
+        try:
+            await asyncio.wait_for(asyncio.shield(self._task), timeout)
+        except asyncio.TimeoutError:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            logger.error(f"❌ Write-behind {self.table}: gave up after {timeout}s on shutdown, "
+                         f"~{self._queue.qsize()} queued rows lost")
+        self._task = None
+        logger.info(f"📝 Write-behind for {self.table} stopped")
+
+    async def put(self, record: tuple):
+        await self._queue.put(record)  # waits while the buffer is full
+        if self._batch_full():
+            self._batch_ready.set()
+
+    def offer(self, record: tuple) -> bool:
+        """Queues without waiting; False (row not queued) when the buffer is full."""
+        try:
+            self._queue.put_nowait(record)
+        except asyncio.QueueFull:
+            return False
+        if self._batch_full():
+            self._batch_ready.set()
+        return True
+
+    def _batch_full(self):
+        # The flusher already holds the first row of the batch it is waiting on
+        return self._queue.qsize() >= self.max_batch - 1
+
+    async def _run(self):
+        while True:
+            if self._stopping.is_set() and self._queue.empty():
+                return  # stop() couldn't queue _STOP (buffer was full): drained now
+            first = await self._queue.get()
+            if first is _STOP:
+                return
+            # Give the batch a chance to fill up, unless it already has
+            if not self._batch_full() and not self._stopping.is_set():
+                try:
+                    await asyncio.wait_for(self._batch_ready.wait(), timeout=self.flush_interval)
+                except asyncio.TimeoutError:
+                    pass
+            self._batch_ready.clear()
+
+            batch, stopping = [first], False
+            while len(batch) < self.max_batch and not self._queue.empty():
+                item = self._queue.get_nowait()
+                if item is _STOP:
+                    stopping = True
+                    break
+                batch.append(item)
+
+            await self._flush(batch)
+            if stopping:
+                # _STOP is queued last, so nothing can be behind it
+                return
+
+    async def _flush(self, batch: list):
+        delay = 0.5
+        attempts = 0
+        remaining = list(batch)  # row-by-row mode removes rows as they are written
+        while True:
+            try:
+                if attempts < WRITE_BEHIND_COPY_ATTEMPTS:
+                    async with acquire() as conn:
+                        await conn.copy_records_to_table(self.table, records=remaining, columns=self.columns)
+                else:
+                    await self._insert_rows(remaining)
+                self._on_flushed(batch)
+                return
+            except Exception as e:
+                attempts += 1
+                if self._stopping.is_set() and attempts > WRITE_BEHIND_COPY_ATTEMPTS:
+                    # Shutting down and even row by row fails (Postgres down): can't wait forever
+                    logger.error(f"❌ Write-behind {self.table}: dropping {len(remaining)} rows on shutdown: {e}")
+                    metrics.incr("write_behind.dropped", len(remaining))
+                    self._on_flushed(batch)
+                    return
+                if self._stopping.is_set():
+                    attempts = max(attempts, WRITE_BEHIND_COPY_ATTEMPTS)  # straight to row by row
+                    continue
+                # Keep the rows and retry; the bounded queue pushes back on producers meanwhile
+                logger.warning(f"⚠️ Write-behind {self.table} flush failed ({len(remaining)} rows), "
+                               f"retry in {delay}s: {e}")
+                try:
+                    await asyncio.wait_for(self._stopping.wait(), timeout=delay)
+                except asyncio.TimeoutError:
+                    pass
+                delay = min(delay * 2, 10)
+
+    async def _insert_rows(self, rows: list):
+        """
+        Writes `rows` one INSERT at a time, removing each from the list once it
+        is written or rejected. Connection errors propagate (rows left are retried).
+        """
+        columns = ", ".join(self.columns)
+        params = ", ".join(f"${i + 1}" for i in range(len(self.columns)))
+        query = f"INSERT INTO {self.table} ({columns}) VALUES ({params})"
+        async with acquire() as conn:
+            while rows:
+                try:
+                    await conn.execute(query, *rows[0])
+                except _BAD_ROW_ERRORS as e:
+                    logger.error(f"❌ Write-behind {self.table}: dropping a row Postgres rejects: {e}")
+                    metrics.incr("write_behind.dropped")
+                rows.pop(0)
+
+    def _on_flushed(self, batch: list):
+        """Hook for subclasses; called once a batch is committed (or given up)."""
+        pass
+
+
+class ChatHistoryWriter(BatchWriter):
+    """
+    Write-behind for chat_sessions with read-your-writes.
+
+    Messages stay visible in `_pending` until their COPY commits, and
+    get_history merges them after the rows read from Postgres. created_at is
+    stamped here (app clock) so the merged order matches the committed order.
+    """
+
+    def __init__(self):
+        super().__init__(
+            "chat_sessions", ("user_id", "role", "content", "created_at"),
+            max_batch=CHAT_FLUSH_MAX_ROWS,
+            flush_interval=CHAT_FLUSH_INTERVAL_MS / 1000,
+            max_pending=CHAT_WRITE_BUFFER_MAX,
+        )
+        self._pending = {}  # user_id -> records not yet committed, oldest first
+
+    async def save(self, user_id: str, role: str, content: str):
+        record = (user_id, role, content, datetime.now())
+        self._pending.setdefault(user_id, []).append(record)
+        await self.put(record)
+
+    def pending_for(self, user_id: str) -> list:
+        return list(self._pending.get(user_id, ()))
+
+    def _on_flushed(self, batch: list):
+        # Batches are flushed in queue order, so each committed record is at
+        # the head of its user's pending list.
+        for record in batch:
+            pending = self._pending.get(record[0])
+            if pending and pending[0] is record:
+                pending.pop(0)
+                if not pending:
+                    del self._pending[record[0]]
+
+    @staticmethod
+    def merge(history: list, last_committed_at, pending: list, limit: int) -> list:
+        """
+        Appends pending messages newer than the last row read from Postgres.
+        `pending` must be snapshotted BEFORE the read: anything that committed
+        in between is then in `history` and filtered out by timestamp.
+        """
+        extra = [
+            dict(role=r[1], content=r[2]) for r in pending
+            if last_committed_at is None or r[3] > last_committed_at
+        ]
+        merged = history + extra
+        return merged[-limit:] if limit else merged
+
+
+chat_writer = ChatHistoryWriter()
+
+
+class UsageWriter(BatchWriter):
+    """
+    Write-behind for the llm_usage ledger. Nothing reads it back, so no
+    read-your-writes, and it is analytics: when Postgres falls behind and the
+    buffer is full, rows are dropped (usage.dropped) rather than making replies wait.
+    """
+
+    def __init__(self):
+        super().__init__(
+            "llm_usage",
+            ("created_at", "user_id", "persona_id", "kind", "model", "key_id",
+             "prompt_tokens", "output_tokens", "thoughts_tokens", "cached_tokens", "latency_ms"),
+            max_batch=CHAT_FLUSH_MAX_ROWS,
+            flush_interval=1.0,
+            max_pending=CHAT_WRITE_BUFFER_MAX,
+        )
+
+    async def record(self, user_id: str, persona_id, usage: list, kind: str = "chat"):
+        """Queues one row per LLMUsage without waiting. A no-op when the ledger isn't running."""
+        if not self.running:
+            return
+        now = datetime.now()
+        for u in usage:
+            if not self.offer((now, user_id, persona_id, kind, u.model, u.key_id,
+                               u.prompt_tokens, u.output_tokens, u.thoughts_tokens, u.cached_tokens, u.latency_ms)):
+                metrics.incr("usage.dropped")
+
+
+usage_writer = UsageWriter()
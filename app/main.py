@@ -1,6 +1,17 @@
 import app.core.config # Load IIAB Config (local_vars.yml) first
 from fastapi import FastAPI, BackgroundTasks, Request
 from app.database.schema import init_db
+from app.database.migrations import maintain_partitions
+from app.database.connection import init_pool, close_pool
+from app.database.write_behind import chat_writer, CHAT_WRITE_BEHIND, usage_writer, USAGE_LEDGER_ENABLED
+from app.personas.registry import persona_registry
+from app.services.genai_clients import client_cache
+from app.services.key_scheduler import key_scheduler
+from app.services.summarizer import summary_updater
+from app.services.mailbox import chat_mailboxes
+from app.services.admission import admission
+from app.services import tokens
+import asyncio
 from app.routers import webhooks
 import logging
 
@@ -11,7 +22,33 @@ app = FastAPI(title="KonexPro AI Middleware", version="2.0")
 @app.on_event("startup")
 async def on_startup():
     logger.info("🚀 Middleware Starting...")
+    await init_pool()
     await init_db()
+    app.state.partition_task = asyncio.create_task(maintain_partitions())
+    await persona_registry.start()
+    await key_scheduler.start()
+    await summary_updater.start()
+    # tiktoken may fetch its encoding file on first use: not in a request
+    await asyncio.to_thread(tokens.warm)
+    if CHAT_WRITE_BEHIND:
+        await chat_writer.start()
+    if USAGE_LEDGER_ENABLED:
+        await usage_writer.start()
+
+@app.on_event("shutdown")
+async def on_shutdown():
+    logger.info("🛑 Middleware Stopping...")
+    partition_task = getattr(app.state, "partition_task", None)
+    if partition_task:
+        partition_task.cancel()
+    # Flush buffered chat messages before the pool goes away
+    await chat_writer.stop()
+    await usage_writer.stop()
+    await persona_registry.stop()
+    await key_scheduler.stop()
+    await summary_updater.stop()
+    await client_cache.close_all()
+    await close_pool()
 
 @app.get("/health")
 async def health_check():
@@ -26,12 +63,25 @@ async def health_check():
         }
     }
 
-from app.routers import webhooks, moncash, auth, openai_compat
+@app.get("/metrics")
+async def metrics_endpoint():
+    from app.core import metrics
+    from app.services.cache import history_cache_memory
+    return {
+        "counters": metrics.snapshot(),
+        "history_cache": await history_cache_memory(),
+        "keys": key_scheduler.snapshot(),
+        "mailboxes": len(chat_mailboxes),
+        "admission": admission.snapshot()
+    }
+
+from app.routers import webhooks, moncash, auth, openai_compat, broadcast
 # ...
 app.include_router(webhooks.router)
 app.include_router(moncash.router)
 app.include_router(auth.router)
 app.include_router(openai_compat.router)
+app.include_router(broadcast.router)
 
 from fastapi.staticfiles import StaticFiles
 app.mount("/static", StaticFiles(directory="static"), name="static")
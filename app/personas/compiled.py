@@ -0,0 +1,123 @@
+"""
+Precompiled persona artifacts: system prompt template + tool list.
+
+Everything in a turn's prompt and tools except a few slots depends only on the
+persona row, the access tier (Premium/Beta groups) and the admin flag, so we
+build it once per (persona, tier, admin) instead of on every message:
+
+  * the types.Tool objects (pydantic models, not cheap to construct)
+  * the system prompt, split around the per-user slots
+    (subscriber status, groups, profile, summary)
+
+Entries remember the persona dict they were built from; the registry swaps in
+a new dict when a row changes, so a stale entry is rebuilt on next use. The
+registry also calls invalidate() on reload, which drops them right away.
+"""
+import json
+import logging
+from google.genai import types
+from app.personas.tools import tool_registry
+
+logger = logging.getLogger(__name__)
+
+# Hardcoded "Master Persona" System Prompt (Legacy), used when no persona row matched
+DEFAULT_PROMPT = """
+    You are Sarah, the AI Specialist at KonexPro.
+    Your goal is to help businesses automate their customer service.
+    """
+
+ADMIN_PROMPT = """
+        You are in GOD MODE.
+        You have access to valid system tools.
+        Use 'get_system_status' when asked for status.
+        """
+
+
+class PersonaArtifact:
+    """Prompt template and tools of one (persona, tier, admin) combination."""
+
+    def __init__(self, persona, is_premium: bool, is_admin: bool):
+        self.source = persona
+        self.is_admin = is_admin
+
+        # 1. Tools (Dynamic Gating)
+        # Handlers + declarations live in app/personas/tools.py
+        tool_names = ["update_profile"]
+
+        # Condition: Only show payment link generator to non-subscribers or specific groups?
+        # Or maybe only Premium users can generate links for others?
+        # For now, we allow it for everyone, but note how we *could* restrict it
+        # (group rules other than the access tier would have to join the cache key):
+        if True: # or is_premium:
+            tool_names.append("generate_payment_link")
+
+        # Persona tool allow-list; an empty list means "no restriction"
+        allowed_tools = persona.get("allowed_tools") if persona else None
+        if allowed_tools:
+            tool_names = [n for n in tool_names if n in allowed_tools]
+        declarations = tool_registry.declarations(tool_names)
+        # What the response cache fingerprint varies on
+        self.tool_names = sorted(d.name for d in declarations)
+
+        # Shared by every turn using this artifact: read-only
+        self.tools = [
+            types.Tool(function_declarations=declarations),
+            types.Tool(google_search=types.GoogleSearch())
+        ]
+        if is_admin:
+            self.tools.append(
+                types.Tool(function_declarations=tool_registry.declarations(["get_system_status"]))
+            )
+
+        # 2. Prompt, cut around the per-user slots
+        persona_prompt = persona["system_prompt"] if persona else DEFAULT_PROMPT
+        self._head = persona_prompt + "\n    ### 👤 USER CONTEXT\n    * Status: "
+        self._access = ("\n    * Access Level: " + ("⭐ PREMIUM" if is_premium else "STANDARD")
+                        + "\n    * Known Profile: ")
+
+    def render(self, is_subscriber: bool, groups: list, profile, summary: str = None) -> str:
+        """System prompt with this user's slots filled in."""
+        if self.is_admin:
+            # Admins get God Mode, no user context
+            return ADMIN_PROMPT
+        prompt = "".join((
+            self._head,
+            "✅ SUBSCRIBER" if is_subscriber else "❌ LEAD",
+            "\n    * Groups: ", ", ".join(groups) if groups else "None",
+            self._access,
+            json.dumps(profile, ensure_ascii=False) if profile else "None",
+            "\n    ",
+        ))
+        if summary:
+            prompt += f"""
+    ### 🧾 EARLIER IN THIS CONVERSATION
+    {summary}
+    """
+        return prompt
+
+
+class PersonaArtifacts:
+    """Per-worker cache of compiled artifacts, keyed by (persona id, premium, admin)."""
+
+    def __init__(self):
+        self._entries = {}
+
+    def get(self, persona, is_premium: bool, is_admin: bool) -> PersonaArtifact:
+        key = ((persona or {}).get("id"), is_premium, is_admin)
+        artifact = self._entries.get(key)
+        if artifact is None or artifact.source is not persona:
+            artifact = PersonaArtifact(persona, is_premium, is_admin)
+            logger.debug(f"🧩 Compiled persona artifact {key}")
+            self._entries[key] = artifact
+        return artifact
+
+    def invalidate(self, persona_id=None):
+        """Drops one persona's artifacts, or all of them."""
+        if persona_id is None:
+            self._entries.clear()
+            return
+        for key in [k for k in self._entries if k[0] == persona_id]:
+            del self._entries[key]
+
+
+persona_artifacts = PersonaArtifacts()
@@ -1,168 +1,395 @@
+import os
 import json
+import asyncio
+import hashlib
 import logging
+from dataclasses import dataclass
 from google.genai import types
-from app.services.llm_engine import generate_response_core
-from app.database.repository import get_token, get_history, save_message, get_profile, save_profile
+from app.services.llm_engine import generate_response_core, generate_response_stream
+from app.database.repository import load_conversation_context, save_message
 from app.core.config import get_api_keys
+from app.personas.registry import persona_registry
+from app.personas.compiled import persona_artifacts
+from app.personas.tools import tool_registry, ToolContext
+from app.services import cache
+from app.services.tokens import fit_history, history_budget, HISTORY_MAX_MESSAGES
+from app.services.summarizer import summary_updater
+from app.services.singleflight import chat_flight
+from app.services.mailbox import chat_mailboxes
+from app.services.admission import admission, priority_for, NORMAL
+from app.database.write_behind import usage_writer
+from app.core import metrics
 
 logger = logging.getLogger(__name__)
 
-async def process_chat_request(db, phone_number, message, user_urn, groups):
+DEFAULT_MODEL = "gemini-3-flash-preview"
+# Model calls per reply when tools are involved; the last one gets no tools,
+# so the model has to answer with text.
+TOOL_MAX_TURNS = int(os.getenv("TOOL_MAX_TURNS", "4"))
+
+@dataclass
+class ChatTurn:
+    """Everything the engine needs for one reply."""
+    system_prompt: str
+    tools: list
+    history: list
+    candidate_keys: list
+    model: str
+    hedge: bool = None  # None -> LLM_HEDGE_DEFAULT
+    cache_key: str = None  # None -> don't use the response cache
+    cache_ttl: int = None
+    tool_context: ToolContext = None
+    persona_id: int = None
+    fallback_models: list = None  # None -> LLM_FALLBACK_MODELS
+    priority: str = NORMAL  # admission class of the Gemini calls
+
+    def declared_tools(self) -> set:
+        return {f.name for t in self.tools for f in (t.function_declarations or [])}
+
+
+def _response_cache_key(persona, model_config, message, fingerprint: dict, history: list):
     """
-    Coordinator function that:
-    1. Loads the Persona (Prompt + Tools)
-    2. Loads Context (History + Profile)
-    3. Calls Engine
-    4. Executes Tools
-    5. Saves State
+    Response cache key for this turn, or None to bypass.
+    model_config["response_cache"] is `true` or
+    {"ttl": s, "vary_on_profile": ["language", ...], "history_turns": n}.
+    By default the key covers the whole profile and no history.
     """
-    
+    settings = model_config.get("response_cache")
+    if not settings or not cache.RESPONSE_CACHE_ENABLED:
+        return None
+    settings = settings if isinstance(settings, dict) else {}
+
+    normalized = cache.normalize_message(message)
+    if not normalized or len(normalized) > cache.RESPONSE_CACHE_MAX_CHARS:
+        return None
+    # "wi" / "2" answering the bot's own question is not a repeated question
+    last = history[-1] if history else None
+    if last and last["role"] == "assistant" and last["content"].rstrip().endswith("?"):
+        metrics.incr("response_cache.bypass")
+        return None
+
+    vary_on = settings.get("vary_on_profile")
+    profile = fingerprint.pop("profile") or {}
+    if vary_on is not None:
+        profile = {k: profile.get(k) for k in vary_on}
+    turns = int(settings.get("history_turns", 0))
+    fingerprint.update(
+        profile=profile,
+        history=history[-turns:] if turns else [],
+        prompt=hashlib.sha1((persona or {}).get("system_prompt", "").encode()).hexdigest(),
+        model=model_config.get("model", DEFAULT_MODEL),
+    )
+    return cache.response_cache_key(
+        (persona or {}).get("id", "default"),
+        normalized,
+        json.dumps(fingerprint, sort_keys=True, default=str)
+    )
+
+
+def _is_admin(phone_number) -> bool:
+    admin_phones = os.getenv("ADMIN_PHONES", "").split(",")
+    return phone_number in admin_phones
+
+
+async def _reserve_first_call(phone_number, groups, priority=None):
+    """
+    Takes the slot of the turn's first Gemini call BEFORE the user message is
+    persisted: a shed request (Overloaded) is turned away without a DB round
+    trip and leaves no orphan user turn in history.
+    Returns (priority, reservation).
+    """
+    priority = priority or priority_for(groups, _is_admin(phone_number))
+    return priority, await admission.reserve(priority, admission.deadline(priority))
+
+
+async def reserve_chat_turn(phone_number, groups):
+    """
+    The first-call slot of a turn, taken up front by a caller that has to
+    answer before the turn starts (the SSE endpoint's 200). Raises Overloaded;
+    pass the result to stream_chat_request(reservation=...).
+    """
+    return (await _reserve_first_call(phone_number, groups))[1]
+
+
+async def _prepare_turn(phone_number, message, user_urn, groups, persona_id=None, priority=None,
+                        save_user_message=True) -> ChatTurn:
     # 1. Load Persona
-    # For now, we only have the Default/Hardcoded Logic from the old llm.py
-    # We will reconstruct it here as the "System Persona"
-    
-    repo_profile = await get_profile(user_urn)
-    repo_token = await get_token(phone_number)
+    # From the in-memory registry (no DB query): explicit id, then the persona
+    # owned by this phone, then the is_default row. None -> hardcoded Sarah below.
+    persona = persona_registry.resolve(phone_number, persona_id)
     
-    # Construct System Prompt (Dynamic based on Persona)
-    # TODO: Fetch from DB 'personas' table based on phone_number owner?
-    # For the migration, we use the "KonexPro Master" logic if no specific persona found.
+    # Profile, token and history in one round trip; the user message is
+    # persisted by the same statement.
+    context = await load_conversation_context(user_urn, phone_number,
+                                              user_message=message if save_user_message else None,
+                                              history_limit=HISTORY_MAX_MESSAGES)
+    history = context.history
+    if not save_user_message and history and history[-1] == {"role": "user", "content": message}:
+        # Retry of a message an earlier attempt already saved: it is `message`, not history
+        history = history[:-1]
+    repo_profile = context.profile
+    repo_token = context.token
     
     is_subscriber = True if repo_token else False
-    profile_str = json.dumps(repo_profile, indent=2) if repo_profile else "None"
-    
-    # Hardcoded "Master Persona" System Prompt (Legacy)
     # Logic: Usage of RapidPro Groups for conditions/restrictions
     # Example: "Premium" group gets checking tools, "Banned" gets nothing.
-    group_list = ", ".join(groups) if groups else "None"
     is_premium = "Premium" in groups or "Beta" in groups
-    
-    # Construct System Prompt
-    base_prompt = f"""
-    You are Sarah, the AI Specialist at KonexPro.
-    Your goal is to help businesses automate their customer service.
-    
-    ### 👤 USER CONTEXT
-    * Status: {"✅ SUBSCRIBER" if is_subscriber else "❌ LEAD"}
-    * Groups: {group_list}
-    * Access Level: {"⭐ PREMIUM" if is_premium else "STANDARD"}
-    * Known Profile: {profile_str}
-    """
-    
-    # 2. Prepare Tools (Dynamic Gating)
-    # We define the list of available tools.
-    # We can restrict tools based on groups here.
-    
-    tool_declarations = [
-        types.FunctionDeclaration(
-            name="update_profile",
-            description="Save user details to memory.",
-            parameters=types.Schema(
-                type=types.Type.OBJECT,
-                properties={"data": types.Schema(type=types.Type.OBJECT)},
-                required=["data"]
-            )
-        )
-    ]
-
-    # Condition: Only show payment link generator to non-subscribers or specific groups?
-    # Or maybe only Premium users can generate links for others?
-    # For now, we allow it for everyone, but note how we *could* restrict it:
-    if True: # or "Sales" in groups:
-        tool_declarations.append(
-            types.FunctionDeclaration(
-                name="generate_payment_link",
-                description="create payment link",
-                parameters=types.Schema(
-                    type=types.Type.OBJECT,
-                    properties={"plan_type": types.Schema(type=types.Type.STRING)},
-                    required=["plan_type"]
-                )
-            )
-        )
 
-    tools = [
-        types.Tool(function_declarations=tool_declarations),
-        types.Tool(google_search=types.GoogleSearch())
-    ]
-    
-    # 3. Check for Admin Mode
-    # If the user is an admin, we override the persona and tools
-    import os
-    admin_phones = os.getenv("ADMIN_PHONES", "").split(",")
-    is_admin = phone_number in admin_phones
-    
+    # Check for Admin Mode: admins get God Mode prompt and tools instead of the persona
+    is_admin = _is_admin(phone_number)
     if is_admin:
         logger.warning(f"👑 Admin Mode Active for {phone_number}")
-        base_prompt = """
-        You are in GOD MODE.
-        You have access to valid system tools.
-        Use 'get_system_status' when asked for status.
-        """
-        tools.append(
-            types.Tool(function_declarations=[
-                types.FunctionDeclaration(
-                    name="get_system_status",
-                    description="Check database and cache health",
-                    parameters=types.Schema(
-                        type=types.Type.OBJECT,
-                        properties={}
-                    )
-                )
-            ])
-        )
 
-    # 4. Call Engine
-    chat_history = await get_history(user_urn)
+    # 2. Prompt + Tools
+    # Compiled once per (persona, access tier, admin) in app/personas/compiled.py;
+    # only the user's slots are filled in here.
+    artifact = persona_artifacts.get(persona, is_premium, is_admin)
+    base_prompt = artifact.render(is_subscriber, groups, repo_profile, context.summary)
+
+    # Newest turns that fit the token budget; older ones live in the summary
+    chat_history, dropped = fit_history(history, history_budget(context.summary))
+    # A full fetch means there are older turns we don't send either
+    if dropped or len(context.history) >= HISTORY_MAX_MESSAGES:
+        summary_updater.request(user_urn)
     candidate_keys = get_api_keys(repo_token)
-    
-    # Save User Message first
-    await save_message(user_urn, "user", message)
-    
-    response = await generate_response_core(
-        base_prompt,
-        chat_history,
-        message,
-        tools,
-        candidate_keys
+    model_config = (persona or {}).get("model_config") or {}
+    model = model_config.get("model", DEFAULT_MODEL)
+
+    # Admins get live answers (and God Mode tools), never cached ones
+    cache_key = None if is_admin else _response_cache_key(
+        persona, model_config, message,
+        {"subscriber": is_subscriber, "groups": sorted(groups or []), "profile": repo_profile,
+         "tools": artifact.tool_names},
+        chat_history
     )
+    cache_settings = model_config.get("response_cache")
+    cache_ttl = cache_settings.get("ttl") if isinstance(cache_settings, dict) else None
     
-    # 4. Handle Response & Tools
-    reply_text = ""
-    start_tool_exec = False
-    
-    if response.candidates and response.candidates[0].content.parts:
-        for part in response.candidates[0].content.parts:
-            if part.function_call:
-                fname = part.function_call.name
-                fargs = part.function_call.args
-                logger.info(f"Using Tool: {fname}")
-                
-                if fname == "update_profile":
-                    new_data = fargs.get("data", {})
-                    repo_profile.update(new_data)
-                    await save_profile(user_urn, repo_profile)
-                    # Implicit acknowledgment or 2nd turn?
-                    # For MVP refactor, we just accept it.
-                    
-                elif fname == "generate_payment_link":
-                    # Logic...
-                    pass
-
-                elif fname == "get_system_status":
-                     from app.database.connection import check_health as db_health
-                     db_ok = await db_health()
-                     reply_text = f"DB Status: {'OK' if db_ok else 'FAIL'}"
-                     # In a real 2-turn ReAct, we would feed this back to LLM.
-                     # For now, we append it to the reply.
-
-            if part.text:
-                reply_text += part.text
-                
+    return ChatTurn(base_prompt, artifact.tools, chat_history, candidate_keys, model,
+                    model_config.get("hedge"), cache_key, cache_ttl,
+                    ToolContext(user_urn, phone_number, is_admin), (persona or {}).get("id"),
+                    model_config.get("fallback_models"), priority or priority_for(groups, is_admin))
+
+
+def _model_parts(response):
+    if not (response.candidates and response.candidates[0].content and response.candidates[0].content.parts):
+        return []
+    return response.candidates[0].content.parts
+
+
+async def _buffered_parts(slot, stream):
+    """
+    Yields the model parts of one streamed Gemini call. The call runs in its
+    own task and holds the admission `slot` only until Gemini is done: parts
+    wait in memory for a slow client instead of keeping the slot. If the
+    reader goes away, the call is cancelled.
+    """
+    queue = asyncio.Queue()
+    done = object()
+
+    async def produce():
+        try:
+            async with slot:
+                async for chunk in stream:
+                    for part in _model_parts(chunk):
+                        queue.put_nowait(part)
+        except Exception as e:
+            queue.put_nowait(e)
+        finally:
+            queue.put_nowait(done)
+
+    task = asyncio.create_task(produce())
+    try:
+        while (part := await queue.get()) is not done:
+            if isinstance(part, Exception):
+                raise part
+            yield part
+    finally:
+        task.cancel()
+        await asyncio.gather(task, return_exceptions=True)
+
+
+async def _run_tools(turn: ChatTurn, model_parts: list) -> list:
+    """
+    Runs every function call of one model turn concurrently and returns the
+    two contents to append: the model's turn as-is (keeps thought signatures)
+    and the tool results.
+    """
+    calls = [p.function_call for p in model_parts if p.function_call]
+    results = await tool_registry.run_all(calls, turn.tool_context, turn.declared_tools())
+    return [types.Content(role="model", parts=model_parts), types.Content(role="user", parts=results)]
+
+
+async def _record_usage(turn: ChatTurn, user_urn, calls: list, usage: list = None):
+    # Ledger rows are batched by usage_writer; the reply doesn't wait on Postgres
+    await usage_writer.record(user_urn, turn.persona_id, calls)
+    if usage is not None:
+        usage.extend(calls)
+
+
+def _flight_key(user_urn, persona_id, message) -> str:
+    return hashlib.sha1(f"{user_urn}\0{persona_id}\0{message}".encode()).hexdigest()
+
+
+async def process_chat_request(db, phone_number, message, user_urn, groups, persona_id=None, usage=None,
+                               priority=None, save_user_message=True):
+    """
+    Webhook retries of a message still being answered (same user, persona and
+    text) wait for the first request's reply instead of generating their own;
+    see app/services/singleflight.py. Only the request that did the work gets `usage`.
+    `priority` overrides the admission class derived from `groups`.
+    `save_user_message=False` is for retrying a turn whose user message an
+    earlier attempt already saved.
+    """
+    return await chat_flight.do(
+        _flight_key(user_urn, persona_id, message),
+        lambda: _process_chat_request(db, phone_number, message, user_urn, groups, persona_id, usage, priority,
+                                      save_user_message)
+    )
+
+
+async def submit_chat_message(db, phone_number, message, user_urn, groups, persona_id=None):
+    """
+    Webhook entry point: queues the message in the user's mailbox so a burst
+    of messages is answered in order, as one turn (app/services/mailbox.py).
+    Returns the reply, or None if the message was merged into a later one.
+    """
+    return await chat_mailboxes.submit(
+        f"{user_urn}:{persona_id}", message,
+        lambda merged: process_chat_request(db, phone_number, merged, user_urn, groups, persona_id=persona_id)
+    )
+
+
+async def _process_chat_request(db, phone_number, message, user_urn, groups, persona_id=None, usage=None,
+                                priority=None, save_user_message=True):
+    """
+    Coordinator function that:
+    1. Loads the Persona (Prompt + Tools)
+    2. Loads Context (History + Profile)
+    3. Calls Engine
+    4. Executes Tools (concurrently) and feeds the results back
+    5. Saves State
+    Pass a list as `usage` to get the LLMUsage of every Gemini call made.
+    """
+    priority, reservation = await _reserve_first_call(phone_number, groups, priority)
+    try:
+        turn = await _prepare_turn(phone_number, message, user_urn, groups, persona_id, priority,
+                                   save_user_message)
+
+        if turn.cache_key:
+            cached = await cache.get_cached_reply(turn.cache_key)
+            if cached is not None:
+                await save_message(user_urn, "assistant", cached)
+                return cached
+
+        # 4. Call Engine, 5. Execute Tools and hand the results back, until the
+        # model answers with text (or we run out of turns)
+        texts = []
+        followup = []
+        used_tools = False
+        calls = []
+        for n in range(TOOL_MAX_TURNS):
+            # Only the first call can be shed (reserved above); a reply under way gets finished
+            async with (reservation if n == 0 else admission.slot(turn.priority)):
+                response = await generate_response_core(
+                    turn.system_prompt,
+                    turn.history,
+                    message,
+                    turn.tools,
+                    turn.candidate_keys,
+                    model=turn.model,
+                    hedge=turn.hedge,
+                    followup=followup,
+                    allow_tools=n < TOOL_MAX_TURNS - 1,
+                    usage=calls,
+                    fallback_models=turn.fallback_models
+                )
+            parts = _model_parts(response)
+            text = "".join(p.text for p in parts if p.text)
+            if text:
+                texts.append(text)
+            if not any(p.function_call for p in parts):
+                break
+            used_tools = True
+            followup += await _run_tools(turn, parts)
+    finally:
+        reservation.release()  # no-op once the first call has used it
+
+    reply_text = "\n".join(texts)
+    await _record_usage(turn, user_urn, calls, usage)
+
     if not reply_text:
         reply_text = "..." # Fallback
+    elif turn.cache_key and not used_tools:
+        # Tool calls have side effects (profile, payments): only plain answers are reusable
+        await cache.store_reply(turn.cache_key, reply_text, turn.cache_ttl)
         
-    # 5. Save Reply
+    # 6. Save Reply
     await save_message(user_urn, "assistant", reply_text)
     
     return reply_text
+
+
+async def stream_chat_request(db, phone_number, message, user_urn, groups, persona_id=None, usage=None,
+                              reservation=None):
+    """
+    Streaming variant of process_chat_request: yields reply text as Gemini
+    produces it. Tool calls run between model turns, like process_chat_request;
+    the assembled reply is saved to history when the stream completes.
+    `reservation` is a slot already taken with reserve_chat_turn().
+    """
+    if reservation is None:
+        priority, reservation = await _reserve_first_call(phone_number, groups)
+    else:
+        priority = priority_for(groups, _is_admin(phone_number))
+    try:
+        turn = await _prepare_turn(phone_number, message, user_urn, groups, persona_id, priority)
+
+        if turn.cache_key:
+            cached = await cache.get_cached_reply(turn.cache_key)
+            if cached is not None:
+                reservation.release()  # don't hold a slot while the client reads
+                yield cached
+                await save_message(user_urn, "assistant", cached)
+                return
+
+        reply_text = ""
+        followup = []
+        used_tools = False
+        calls = []
+        for n in range(TOOL_MAX_TURNS):
+            parts = []
+            sep = "\n" if reply_text else ""
+            stream = generate_response_stream(
+                turn.system_prompt,
+                turn.history,
+                message,
+                turn.tools,
+                turn.candidate_keys,
+                model=turn.model,
+                followup=followup,
+                allow_tools=n < TOOL_MAX_TURNS - 1,
+                usage=calls,
+                fallback_models=turn.fallback_models
+            )
+            async for part in _buffered_parts(reservation if n == 0 else admission.slot(turn.priority), stream):
+                parts.append(part)
+                if part.text:
+                    reply_text += sep + part.text
+                    yield sep + part.text
+                    sep = ""
+            if not any(p.function_call for p in parts):
+                break
+            used_tools = True
+            followup += await _run_tools(turn, parts)
+    finally:
+        reservation.release()
+    await _record_usage(turn, user_urn, calls, usage)
+    
+    if not reply_text:
+        reply_text = "..." # Fallback
+        yield reply_text
+    elif turn.cache_key and not used_tools:
+        await cache.store_reply(turn.cache_key, reply_text, turn.cache_ttl)
+    
+    await save_message(user_urn, "assistant", reply_text)
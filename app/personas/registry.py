@@ -0,0 +1,153 @@
+import asyncio
+import logging
+from app.database.connection import get_db_connection
+from app.database.repository import load_personas, get_persona
+from app.personas.compiled import persona_artifacts
+
+logger = logging.getLogger(__name__)
+
+CHANNEL = "personas_changed"
+
+
+class PersonaRegistry:
+    """
+    In-memory copy of the `personas` table.
+
+    Loaded once at startup; lookups by id / owner_phone never touch Postgres.
+    A trigger on `personas` sends NOTIFY personas_changed with the row id, and
+    each worker reloads just that row on its own LISTEN connection. If the
+    listener connection drops we reconnect and reload everything, since
+    notifications sent meanwhile are lost.
+    """
+
+    def __init__(self):
+        self._by_id = {}
+        self._by_owner = {}
+        self._default = None
+        self._conn = None
+        self._reconnect_task = None
+        self._reload_tasks = set()  # strong refs: the loop only keeps weak ones
+        self.loaded = False
+        self.running = False
+
+    # --- Lookups (sync, memory only) ---
+
+    def get(self, persona_id):
+        if persona_id is None:
+            return None
+        try:
+            return self._by_id.get(int(persona_id))
+        except (TypeError, ValueError):
+            return None
+
+    def for_owner(self, phone_number: str):
+        return self._by_owner.get(phone_number)
+
+    def default(self):
+        return self._default
+
+    def resolve(self, phone_number: str = None, persona_id=None):
+        """Explicit id first, then the persona owned by this phone, then the default."""
+        return self.get(persona_id) or self.for_owner(phone_number) or self._default
+
+    # --- Loading ---
+
+    async def reload(self):
+        personas = await load_personas()
+        self._by_id = {p["id"]: p for p in personas}
+        self._reindex()
+        persona_artifacts.invalidate()
+        self.loaded = True
+        logger.info(f"🎭 Persona registry loaded ({len(self._by_id)} personas)")
+
+    async def reload_one(self, persona_id: int):
+        persona = await get_persona(persona_id)
+        if persona:
+            self._by_id[persona["id"]] = persona
+        else:
+            self._by_id.pop(persona_id, None)  # deleted
+        self._reindex()
+        persona_artifacts.invalidate(persona_id)
+        logger.info(f"🎭 Persona {persona_id} {'reloaded' if persona else 'removed'}")
+
+    def _reindex(self):
+        # Rebuilt from scratch: owner_phone / is_default may have moved between rows
+        by_owner, default = {}, None
+        for p in sorted(self._by_id.values(), key=lambda p: p["id"]):
+            if p.get("owner_phone"):
+                by_owner.setdefault(p["owner_phone"], p)
+            if p.get("is_default") and default is None:
+                default = p
+        self._by_owner, self._default = by_owner, default
+
+    # --- LISTEN / NOTIFY ---
+
+    async def start(self):
+        if self.running:
+            return
+        self.running = True
+        try:
+            await self._listen()
+            await self.reload()
+        except Exception as e:
+            # Serve the hardcoded fallback persona until the DB comes back
+            logger.error(f"❌ Persona registry start failed: {e}")
+            self._schedule_reconnect()
+
+    async def stop(self):
+        self.running = False
+        if self._reconnect_task:
+            self._reconnect_task.cancel()
+            self._reconnect_task = None
+        if self._conn and not self._conn.is_closed():
+            await self._conn.close()
+        self._conn = None
+
+    async def _listen(self):
+        # Dedicated connection: LISTEN state must not leak into the pool
+        conn = await get_db_connection()
+        conn.add_termination_listener(self._on_terminated)
+        await conn.add_listener(CHANNEL, self._on_notify)
+        self._conn = conn
+
+    def _on_notify(self, conn, pid, channel, payload):
+        try:
+            persona_id = int(payload)
+        except ValueError:
+            return
+        task = asyncio.create_task(self._safe_reload_one(persona_id))
+        self._reload_tasks.add(task)
+        task.add_done_callback(self._reload_tasks.discard)
+
+    async def _safe_reload_one(self, persona_id: int):
+        try:
+            await self.reload_one(persona_id)
+        except Exception as e:
+            logger.warning(f"⚠️ Persona {persona_id} reload failed, reloading all: {e}")
+            self._schedule_reconnect()
+
+    def _on_terminated(self, conn):
+        if self.running:
+            logger.warning("⚠️ Persona listener connection lost, reconnecting...")
+            self._schedule_reconnect()
+
+    def _schedule_reconnect(self):
+        if self.running and not (self._reconnect_task and not self._reconnect_task.done()):
+            self._reconnect_task = asyncio.create_task(self._reconnect())
+
+    async def _reconnect(self):
+        delay = 1
+        while self.running:
+            try:
+                if self._conn and not self._conn.is_closed():
+                    self._conn.terminate()
+                await self._listen()
+                await self.reload()
+                return
+            except Exception as e:
+                logger.warning(f"⚠️ Persona registry reconnect failed, retry in {delay}s: {e}")
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, 30)
+
+
+persona_registry = PersonaRegistry()
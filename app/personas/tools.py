@@ -0,0 +1,146 @@
+"""
+Tools the model can call, and how they run.
+
+Each tool is an async handler registered with its Gemini declaration:
+
+    @tool_registry.register("get_weather", "Weather for a city", {"city": STRING}, required=["city"])
+    async def get_weather(args, ctx): return {"forecast": ...}
+
+Handlers receive the call arguments and a ToolContext, and return a dict that
+goes back to the model as the function response. All calls from one model
+turn run concurrently, each under its own timeout; errors and timeouts are
+reported to the model as {"error": ...} instead of failing the chat.
+"""
+import os
+import uuid
+import asyncio
+import logging
+from dataclasses import dataclass
+from google.genai import types
+from app.core import metrics
+from app.database.repository import merge_profile
+
+logger = logging.getLogger(__name__)
+
+TOOL_TIMEOUT_SECONDS = float(os.getenv("TOOL_TIMEOUT_SECONDS", "10"))
+# Plan prices in HTG for generate_payment_link, "plan:amount,..."
+PLAN_PRICES = os.getenv("PLAN_PRICES", "basic:500,premium:1500")
+
+
+@dataclass
+class ToolContext:
+    user_urn: str
+    phone_number: str
+    is_admin: bool = False
+
+
+@dataclass
+class Tool:
+    declaration: types.FunctionDeclaration
+    handler: object
+    timeout: float = None
+
+
+class ToolRegistry:
+    def __init__(self):
+        self._tools = {}
+
+    def register(self, name: str, description: str, properties: dict = None,
+                 required: list = None, timeout: float = None):
+        """Decorator: registers `async def handler(args: dict, ctx: ToolContext) -> dict`."""
+        declaration = types.FunctionDeclaration(
+            name=name,
+            description=description,
+            parameters=types.Schema(
+                type=types.Type.OBJECT,
+                properties=properties or {},
+                required=required
+            )
+        )
+
+        def decorator(handler):
+            self._tools[name] = Tool(declaration, handler, timeout)
+            return handler
+        return decorator
+
+    def declarations(self, names) -> list:
+        return [self._tools[n].declaration for n in names if n in self._tools]
+
+    async def run_all(self, function_calls: list, ctx: ToolContext, allowed: set) -> list:
+        """Runs one turn's calls concurrently; returns function_response Parts in call order."""
+        results = await asyncio.gather(*(self._run(fc, ctx, allowed) for fc in function_calls))
+        return [
+            types.Part.from_function_response(name=fc.name, response=result)
+            for fc, result in zip(function_calls, results)
+        ]
+
+    async def _run(self, function_call, ctx: ToolContext, allowed: set) -> dict:
+        name = function_call.name
+        tool = self._tools.get(name)
+        # Only what this turn declared: a non-admin can't get God Mode tools by asking nicely
+        if tool is None or name not in allowed:
+            return {"error": f"Unknown tool: {name}"}
+        timeout = tool.timeout or TOOL_TIMEOUT_SECONDS
+        metrics.incr(f"tool.calls.{name}")
+        logger.info(f"Using Tool: {name}")
+        try:
+            result = await asyncio.wait_for(tool.handler(dict(function_call.args or {}), ctx), timeout)
+            return result if isinstance(result, dict) else {"result": result}
+        except asyncio.TimeoutError:
+            metrics.incr("tool.timeout")
+            logger.warning(f"⏱️ Tool {name} timed out after {timeout}s")
+            return {"error": f"{name} timed out"}
+        except Exception as e:
+            metrics.incr("tool.error")
+            logger.error(f"Tool {name} failed: {e}")
+            return {"error": str(e)}
+
+
+tool_registry = ToolRegistry()
+
+
+# --- Built-in tools ---
+
+@tool_registry.register(
+    "update_profile", "Save user details to memory.",
+    {"data": types.Schema(type=types.Type.OBJECT)}, required=["data"]
+)
+async def update_profile(args, ctx):
+    # Server-side merge: no read-modify-write, no lost updates
+    profile = await merge_profile(ctx.user_urn, dict(args.get("data") or {}))
+    return {"status": "saved", "profile": profile}
+
+
+def _plan_prices() -> dict:
+    prices = {}
+    for item in PLAN_PRICES.split(","):
+        plan, _, amount = item.partition(":")
+        if plan.strip() and amount.strip():
+            prices[plan.strip().lower()] = float(amount)
+    return prices
+
+
+@tool_registry.register(
+    "generate_payment_link", "create payment link",
+    {"plan_type": types.Schema(type=types.Type.STRING)}, required=["plan_type"]
+)
+async def generate_payment_link(args, ctx):
+    from app.services.moncash import MonCashClient
+    prices = _plan_prices()
+    plan = str(args.get("plan_type", "")).strip().lower()
+    if plan not in prices:
+        return {"error": f"Unknown plan '{plan}'", "plans": prices}
+    order_id = f"KP-{uuid.uuid4().hex[:12]}"
+    # MonCashClient uses blocking requests: keep it off the event loop
+    url = await asyncio.to_thread(MonCashClient().create_payment, order_id, prices[plan])
+    if not url:
+        return {"error": "Payment provider unavailable"}
+    return {"plan": plan, "amount": prices[plan], "currency": "HTG", "order_id": order_id, "url": url}
+
+
+@tool_registry.register("get_system_status", "Check database and cache health")
+async def get_system_status(args, ctx):
+    from app.database.connection import check_health as db_health
+    from app.services.cache import check_health as cache_health
+    db_ok, cache_ok = await asyncio.gather(db_health(), cache_health())
+    return {"database": "OK" if db_ok else "FAIL", "cache": "OK" if cache_ok else "FAIL"}
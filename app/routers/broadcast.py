@@ -0,0 +1,69 @@
+from fastapi import APIRouter, Request
+from fastapi.responses import JSONResponse, StreamingResponse
+from app.database.repository import get_broadcast_summary
+from app.services.broadcast import run_broadcast, BroadcastItem, BROADCAST_MAX_ITEMS, OK, FAILED
+import hmac
+import json
+import logging
+import os
+import uuid
+
+logger = logging.getLogger(__name__)
+
+router = APIRouter()
+
+
+def _authorized(request: Request) -> bool:
+    # Broadcasts spend quota in bulk: off unless a secret is configured
+    expected = os.getenv("BROADCAST_SECRET")
+    given = request.headers.get("X-Broadcast-Secret", "")
+    # Constant time: the comparison must not leak how much of the secret matched
+    return bool(expected) and hmac.compare_digest(given.encode(), expected.encode())
+
+
+@router.post("/v1/broadcasts")
+async def create_broadcast(request: Request):
+    """
+    Runs a broadcast job and streams one NDJSON line per item as it finishes,
+    then a summary line. Payload:
+    { "job_id": "...", "persona_id": 3, "groups": [...], "items": [{"user": "tel:+509...", "text": "..."}] }
+    POST the same job_id (and items) again to resume: finished items are not re-generated.
+    """
+    if not _authorized(request):
+        return JSONResponse(status_code=403, content={"error": "Invalid Secret"})
+
+    data = await request.json()
+    raw_items = data.get("items") or []
+    if not raw_items:
+        return JSONResponse(status_code=400, content={"error": "No items provided"})
+    if len(raw_items) > BROADCAST_MAX_ITEMS:
+        return JSONResponse(status_code=413, content={"error": f"At most {BROADCAST_MAX_ITEMS} items per job"})
+    items = []
+    for i, item in enumerate(raw_items):
+        if not item.get("user") or not item.get("text"):
+            return JSONResponse(status_code=400, content={"error": f"Item {i} needs 'user' and 'text'"})
+        items.append(BroadcastItem(i, item["user"], item["text"]))
+
+    job_id = str(data.get("job_id") or uuid.uuid4())
+    logger.info(f"📣 Broadcast job {job_id}: {len(items)} items")
+    return StreamingResponse(
+        _ndjson(job_id, items, data.get("persona_id"), data.get("groups") or []),
+        media_type="application/x-ndjson",
+        headers={"X-Job-Id": job_id, "Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+
+async def _ndjson(job_id, items, persona_id, groups):
+    counts = {OK: 0, FAILED: 0}
+    async for result in run_broadcast(job_id, items, persona_id, groups):
+        counts[result["status"]] += 1
+        yield json.dumps(result, ensure_ascii=False) + "\n"
+    yield json.dumps({"job_id": job_id, "done": True, "total": len(items), **counts}) + "\n"
+
+
+@router.get("/v1/broadcasts/{job_id}")
+async def broadcast_status(job_id: str, request: Request):
+    if not _authorized(request):
+        return JSONResponse(status_code=403, content={"error": "Invalid Secret"})
+    counts = await get_broadcast_summary(job_id)
+    return {"job_id": job_id, OK: counts.get(OK, 0), FAILED: counts.get(FAILED, 0)}
@@ -1,5 +1,8 @@
 from fastapi import APIRouter, Request, HTTPException
-from app.personas.manager import process_chat_request
+from fastapi.responses import StreamingResponse, JSONResponse
+from app.personas.manager import process_chat_request, stream_chat_request, reserve_chat_turn
+from app.services.admission import Overloaded
+import json
 import logging
 import time
 import uuid
@@ -47,8 +50,22 @@ async def openai_chat_completions(request: Request):
 
         logger.info(f"OpenAI Compat Request from {user_id}: {content}")
 
+        if data.get("stream"):
+            include_usage = bool((data.get("stream_options") or {}).get("include_usage"))
+            # Shed (429 below) before the 200 goes out, not in-stream
+            reservation = await reserve_chat_turn(phone_number, groups)
+            return _ReservedStreamingResponse(
+                _sse_completion(data.get("model", "konex-ai"), phone_number, content, user_id, groups,
+                                include_usage, reservation),
+                reservation,
+                media_type="text/event-stream",
+                # nginx (IIAB) buffers proxied responses unless told otherwise
+                headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+            )
+
         # Call Internal Logic
-        reply_text = await process_chat_request(None, phone_number, content, user_id, groups)
+        usage = []
+        reply_text = await process_chat_request(None, phone_number, content, user_id, groups, usage=usage)
         
         # Format Response as OpenAI Object
         return {
@@ -66,13 +83,88 @@ async def openai_chat_completions(request: Request):
                     "finish_reason": "stop"
                 }
             ],
-            "usage": {
-                "prompt_tokens": len(content), 
-                "completion_tokens": len(reply_text),
-                "total_tokens": len(content) + len(reply_text)
-            }
+            "usage": _openai_usage(usage)
         }
         
+    except Overloaded as e:
+        # Shed before any Gemini call: tell the client when to come back
+        logger.warning(f"🚦 OpenAI Compat shed: {e}")
+        return JSONResponse(
+            status_code=429,
+            headers={"Retry-After": str(e.retry_after)},
+            content={"error": {"message": str(e), "type": "rate_limit_error", "code": "overloaded"}}
+        )
     except Exception as e:
         logger.error(f"OpenAI Compat Error: {e}")
         raise HTTPException(status_code=500, detail=str(e))
+
+
+class _ReservedStreamingResponse(StreamingResponse):
+    """Frees the stream's admission slot however the response ends, even if the body never started."""
+
+    def __init__(self, content, reservation, **kwargs):
+        super().__init__(content, **kwargs)
+        self.reservation = reservation
+
+    async def __call__(self, scope, receive, send):
+        try:
+            await super().__call__(scope, receive, send)
+        finally:
+            self.reservation.release()
+
+
+def _openai_usage(usage: list) -> dict:
+    """Gemini usage_metadata of every call behind this reply (tool turns included), OpenAI-shaped."""
+    prompt = sum(u.prompt_tokens for u in usage)
+    # OpenAI counts reasoning tokens as completion tokens
+    completion = sum(u.output_tokens + u.thoughts_tokens for u in usage)
+    return {
+        "prompt_tokens": prompt,
+        "completion_tokens": completion,
+        "total_tokens": prompt + completion,
+        "prompt_tokens_details": {"cached_tokens": sum(u.cached_tokens for u in usage)},
+        "completion_tokens_details": {"reasoning_tokens": sum(u.thoughts_tokens for u in usage)}
+    }
+
+
+def _sse(payload) -> str:
+    return f"data: {payload if isinstance(payload, str) else json.dumps(payload)}\n\n"
+
+
+async def _sse_completion(model, phone_number, content, user_id, groups, include_usage=False, reservation=None):
+    """OpenAI `chat.completion.chunk` frames, terminated by `data: [DONE]`."""
+    completion_id = f"chatcmpl-{uuid.uuid4()}"
+    created = int(time.time())
+
+    def chunk(delta, finish_reason=None):
+        return {
+            "id": completion_id,
+            "object": "chat.completion.chunk",
+            "created": created,
+            "model": model,
+            "choices": [{"index": 0, "delta": delta, "finish_reason": finish_reason}]
+        }
+
+    # First byte goes out before we touch the DB or Gemini (slow mobile links)
+    yield _sse(chunk({"role": "assistant", "content": ""}))
+
+    usage = []
+    try:
+        async for text in stream_chat_request(None, phone_number, content, user_id, groups, usage=usage,
+                                              reservation=reservation):
+            yield _sse(chunk({"content": text}))
+    except Exception as e:
+        # Headers are already sent: report the error in-stream, like OpenAI does
+        logger.error(f"OpenAI Compat Stream Error: {e}")
+        kind = "rate_limit_error" if isinstance(e, Overloaded) else "server_error"
+        yield _sse({"error": {"message": str(e), "type": kind}})
+        yield _sse("[DONE]")
+        return
+
+    yield _sse(chunk({}, finish_reason="stop"))
+    if include_usage:
+        final = chunk({})
+        final["choices"] = []
+        final["usage"] = _openai_usage(usage)
+        yield _sse(final)
+    yield _sse("[DONE]")
@@ -1,7 +1,8 @@
 from fastapi import APIRouter, Request, BackgroundTasks
 from fastapi.responses import JSONResponse
-from app.personas.manager import process_chat_request
+from app.personas.manager import submit_chat_message
 from app.database.repository import record_payment
+from app.services.admission import Overloaded, ADMISSION_BUSY_REPLY
 import logging
 import os
 
@@ -15,6 +16,7 @@ async def chat_endpoint(request: Request, background_tasks: BackgroundTasks):
     message = data.get("text", "")
     user_urn = data.get("user") # e.g. telegram:12345
     groups = data.get("groups", [])
+    persona_id = data.get("persona_id") # Optional: flow-selected persona
     
     # RapidPro might send us URNs like tel:+509...
     # We extract the clean phone number for Owner Logic
@@ -27,7 +29,21 @@ async def chat_endpoint(request: Request, background_tasks: BackgroundTasks):
     # Mock DB dependency via "from app.database.connection..." inside sub-functions for now
     # Ideally use FastAPI Dependency Injection
     
-    reply = await process_chat_request(None, phone_number, message, user_urn, groups)
+    # A burst from the same user is answered once, on its last message
+    try:
+        reply = await submit_chat_message(None, phone_number, message, user_urn, groups, persona_id=persona_id)
+    except Overloaded as e:
+        # RapidPro needs text to send: a polite "busy" beats a webhook timeout
+        logger.warning(f"🚦 Busy reply to {user_urn}: {e}")
+        return {
+            "text": ADMISSION_BUSY_REPLY,
+            "intent": "BUSY"
+        }
+    if reply is None:
+        return {
+            "text": "",
+            "intent": "MERGED" # Answered with a later message: the flow should send nothing
+        }
     
     return {
         "text": reply,
@@ -0,0 +1,216 @@
+"""
+Admission control for Gemini calls: a global concurrency cap with priority queues.
+
+At most ADMISSION_MAX_CONCURRENCY calls run at once in a worker. Callers over
+the cap wait in one queue per priority class; when a slot frees up, the next
+queue is picked by smooth weighted round-robin (ADMISSION_WEIGHTS), so
+premium traffic goes first without starving the rest.
+
+Each class has a queue deadline (ADMISSION_DEADLINES, seconds). A call whose
+expected wait already exceeds it is refused right away, and one still queued
+at its deadline gives up: both raise Overloaded, which the routers turn into a
+429 or a canned reply instead of a request that times out anyway.
+
+    async with admission.slot("premium", admission.deadline("premium")):
+        response = await generate_response_core(...)
+
+A chat turn takes its first slot with reserve() before anything is persisted,
+so a shed message leaves no orphan user turn in history.
+"""
+import os
+import math
+import time
+import asyncio
+import logging
+from collections import deque
+from contextlib import asynccontextmanager
+from app.core import metrics
+
+logger = logging.getLogger(__name__)
+
+PREMIUM = "premium"
+NORMAL = "normal"
+LOW = "low"  # background work (summaries, broadcasts)
+
+ADMISSION_ENABLED = os.getenv("ADMISSION_ENABLED", "true").lower() == "true"
+ADMISSION_MAX_CONCURRENCY = int(os.getenv("ADMISSION_MAX_CONCURRENCY", "32"))
+# "class:value,..."
+ADMISSION_WEIGHTS = os.getenv("ADMISSION_WEIGHTS", "premium:6,normal:3,low:1")
+ADMISSION_DEADLINES = os.getenv("ADMISSION_DEADLINES", "premium:20,normal:10,low:5")
+# RapidPro groups that get the premium class
+ADMISSION_PREMIUM_GROUPS = os.getenv("ADMISSION_PREMIUM_GROUPS", "Premium,Beta")
+ADMISSION_BUSY_REPLY = os.getenv(
+    "ADMISSION_BUSY_REPLY",
+    "Nou gen twòp demann kounye a. Tanpri eseye ankò nan kèk minit. 🙏"
+)
+HOLD_EWMA_ALPHA = 0.2
+
+
+class Overloaded(Exception):
+    """No slot within the queue deadline. `retry_after` is a hint in seconds."""
+
+    def __init__(self, priority: str, retry_after: float):
+        super().__init__(f"Overloaded: no LLM slot for {priority} within its deadline")
+        self.priority = priority
+        self.retry_after = retry_after
+
+
+def _parse_classes(spec: str) -> dict:
+    values = {}
+    for item in spec.split(","):
+        name, _, value = item.partition(":")
+        if name.strip() and value.strip():
+            values[name.strip().lower()] = float(value)
+    return values
+
+
+def priority_for(groups, is_admin: bool = False) -> str:
+    premium = {g.strip() for g in ADMISSION_PREMIUM_GROUPS.split(",") if g.strip()}
+    if is_admin or premium.intersection(groups or []):
+        return PREMIUM
+    return NORMAL
+
+
+class Reservation:
+    """
+    A slot taken ahead of the call that uses it (see AdmissionController.reserve).
+    `async with reservation:` runs the call and frees the slot; release() frees
+    it without a call (cache hit, error). Releasing twice is a no-op.
+    """
+
+    def __init__(self, controller=None):
+        self._controller = controller  # None: admission disabled
+        self._started = None
+
+    async def __aenter__(self):
+        self._started = time.monotonic()
+        return self
+
+    async def __aexit__(self, *exc):
+        self.release()
+
+    def release(self):
+        if self._controller is None:
+            return
+        controller, self._controller = self._controller, None
+        # Only time spent in a call counts towards the hold estimate
+        controller.release(time.monotonic() - self._started if self._started is not None else None)
+
+
+class AdmissionController:
+    def __init__(self, limit: int = None, weights: dict = None, deadlines: dict = None):
+        self.limit = limit or ADMISSION_MAX_CONCURRENCY
+        self.weights = weights or _parse_classes(ADMISSION_WEIGHTS)
+        self.deadlines = deadlines if deadlines is not None else _parse_classes(ADMISSION_DEADLINES)
+        self.active = 0
+        self._queues = {p: deque() for p in self.weights}  # priority -> waiting futures
+        self._current = {p: 0.0 for p in self.weights}     # smooth weighted round-robin state
+        self._hold = 2.0  # EWMA of how long a call keeps its slot (s), for wait estimates
+
+    def deadline(self, priority: str):
+        """Absolute (monotonic) queue deadline for a call of this class starting now."""
+        seconds = self.deadlines.get(priority)
+        return time.monotonic() + seconds if seconds else None
+
+    def queued(self) -> int:
+        return sum(len(q) for q in self._queues.values())
+
+    def expected_wait(self) -> float:
+        return (self.queued() + 1) * self._hold / self.limit
+
+    @asynccontextmanager
+    async def slot(self, priority: str = NORMAL, deadline: float = None):
+        """Holds one slot for the block. `deadline=None` waits as long as it takes."""
+        if not ADMISSION_ENABLED:
+            yield
+            return
+        await self.acquire(priority, deadline)
+        started = time.monotonic()
+        try:
+            yield
+        finally:
+            self.release(time.monotonic() - started)
+
+    async def reserve(self, priority: str = NORMAL, deadline: float = None) -> Reservation:
+        """Like slot(), but the slot is taken now and used (or released) later."""
+        if not ADMISSION_ENABLED:
+            return Reservation()
+        await self.acquire(priority, deadline)
+        return Reservation(self)
+
+    async def acquire(self, priority: str = NORMAL, deadline: float = None):
+        if priority not in self._queues:
+            priority = NORMAL
+        if self.active < self.limit and not self.queued():
+            self.active += 1
+            metrics.incr(f"admission.admitted.{priority}")
+            return
+
+        remaining = None if deadline is None else deadline - time.monotonic()
+        if remaining is not None and self.expected_wait() > remaining:
+            # Would time out in the queue anyway: say so now
+            self._shed(priority)
+
+        waiter = asyncio.get_running_loop().create_future()
+        self._queues[priority].append(waiter)
+        metrics.incr(f"admission.queued.{priority}")
+        queued_at = time.monotonic()
+        try:
+            await asyncio.wait_for(waiter, remaining)
+        except asyncio.TimeoutError:
+            self._forget(priority, waiter)
+            self._shed(priority)
+        except asyncio.CancelledError:
+            if waiter.done() and not waiter.cancelled():
+                self.release()  # granted just as the caller went away: pass it on
+            else:
+                self._forget(priority, waiter)
+            raise
+        metrics.incr(f"admission.admitted.{priority}")
+        metrics.incr("admission.wait_ms", (time.monotonic() - queued_at) * 1000)
+
+    def _forget(self, priority: str, waiter):
+        try:
+            self._queues[priority].remove(waiter)
+        except ValueError:
+            pass
+
+    def _shed(self, priority: str):
+        metrics.incr(f"admission.shed.{priority}")
+        raise Overloaded(priority, max(math.ceil(self.expected_wait()), 1))
+
+    def release(self, held: float = None):
+        if held is not None:
+            self._hold += HOLD_EWMA_ALPHA * (held - self._hold)
+        # Hand the slot straight to the next waiter (active stays the same)
+        while True:
+            waiter = self._next_waiter()
+            if waiter is None:
+                self.active -= 1
+                return
+            if not waiter.done():  # timed out / cancelled waiters are skipped
+                waiter.set_result(None)
+                return
+
+    def _next_waiter(self):
+        ready = [p for p, q in self._queues.items() if q]
+        if not ready:
+            return None
+        # Smooth weighted round-robin (as in nginx upstreams)
+        total = sum(self.weights[p] for p in ready)
+        for p in ready:
+            self._current[p] += self.weights[p]
+        chosen = max(ready, key=lambda p: self._current[p])
+        self._current[chosen] -= total
+        return self._queues[chosen].popleft()
+
+    def snapshot(self) -> dict:
+        return {
+            "active": self.active,
+            "limit": self.limit,
+            "queued": {p: len(q) for p, q in self._queues.items()},
+            "hold_s": round(self._hold, 3)
+        }
+
+
+admission = AdmissionController()
@@ -0,0 +1,169 @@
+"""
+Bulk broadcast generation: many (user_urn, message) items through the persona pipeline.
+
+Campaigns used to be RapidPro calling /chat once per contact, so our pace was
+whatever its webhook concurrency happened to be. A broadcast job instead fans
+out here, sized to the system key pool:
+
+  * concurrency: BROADCAST_PER_KEY_CONCURRENCY per key, capped at BROADCAST_MAX_CONCURRENCY
+  * pace: BROADCAST_KEY_RPM requests per minute per key with a closed breaker
+    for the persona's model (or one of its fallbacks), so the job slows down by
+    itself while keys are rate-limited
+  * admission class `low`: interactive chats go first; a shed item waits
+    (Retry-After) and is tried again, up to BROADCAST_MAX_ATTEMPTS
+
+Every finished item is stored in broadcast_items, so re-sending the same job
+(same job_id) only runs what is left. A retried item doesn't save its campaign
+text again: shed attempts never got that far, and a failed one already did
+(broadcast_items.user_message_saved carries that over to a resumed job).
+"""
+import os
+import asyncio
+import logging
+from dataclasses import dataclass
+from app.core import metrics
+from app.core.config import get_system_api_keys
+from app.core.ratelimit import TokenBucket
+from app.database.repository import get_broadcast_results, save_broadcast_result
+from app.personas.manager import process_chat_request, DEFAULT_MODEL
+from app.personas.registry import persona_registry
+from app.services.admission import Overloaded, LOW
+from app.services.key_scheduler import key_scheduler
+from app.services.llm_engine import LLMUnavailable, _model_chain
+
+logger = logging.getLogger(__name__)
+
+BROADCAST_PER_KEY_CONCURRENCY = int(os.getenv("BROADCAST_PER_KEY_CONCURRENCY", "4"))
+BROADCAST_MAX_CONCURRENCY = int(os.getenv("BROADCAST_MAX_CONCURRENCY", "64"))
+BROADCAST_KEY_RPM = float(os.getenv("BROADCAST_KEY_RPM", "60"))
+BROADCAST_MAX_ATTEMPTS = int(os.getenv("BROADCAST_MAX_ATTEMPTS", "3"))
+BROADCAST_RETRY_SECONDS = float(os.getenv("BROADCAST_RETRY_SECONDS", "10"))
+BROADCAST_MAX_ITEMS = int(os.getenv("BROADCAST_MAX_ITEMS", "10000"))
+
+OK = "ok"
+FAILED = "failed"
+
+
+@dataclass
+class BroadcastItem:
+    index: int
+    user_urn: str
+    text: str
+
+
+def _job_models(persona_id) -> list:
+    """The model chain the job's turns will use (429/overload breakers are per key and model)."""
+    persona = persona_registry.resolve(None, persona_id)
+    model_config = (persona or {}).get("model_config") or {}
+    return _model_chain(model_config.get("model", DEFAULT_MODEL), model_config.get("fallback_models"))
+
+
+def _ready_keys(keys: list, models: list) -> int:
+    # A key counts while any model of the chain can still be called on it
+    return sum(1 for k in keys if any(key_scheduler.is_ready(k, m) for m in models))
+
+
+async def run_broadcast(job_id: str, items: list, persona_id=None, groups: list = None):
+    """
+    Runs a job and yields one result dict per item as it finishes (items done by
+    an earlier run of the same job first, with "resumed": true).
+    """
+    done = await get_broadcast_results(job_id)
+    todo = []
+    saved = set()  # indexes whose text an earlier run already put in history
+    for item in items:
+        previous = done.get(item.index)
+        if previous and previous["user_urn"] != item.user_urn:
+            previous = None  # slot reused for another user: nothing carries over
+        if previous and previous["status"] == OK:
+            metrics.incr("broadcast.resumed")
+            yield {"index": item.index, "user": item.user_urn, "status": OK,
+                   "text": previous["reply"], "resumed": True}
+            continue
+        if previous and previous["user_message_saved"]:
+            saved.add(item.index)
+        todo.append(item)
+    if not todo:
+        return
+
+    keys = get_system_api_keys()
+    capacity = max(len(keys), 1)
+    concurrency = max(min(capacity * BROADCAST_PER_KEY_CONCURRENCY, BROADCAST_MAX_CONCURRENCY, len(todo)), 1)
+    pace = TokenBucket(capacity * BROADCAST_KEY_RPM / 60, burst=concurrency)
+    models = _job_models(persona_id)
+    logger.info(f"📣 Broadcast {job_id}: {len(todo)} items ({len(items) - len(todo)} already done), "
+                f"{concurrency} at a time over {capacity} keys")
+
+    pending = iter(todo)
+    results = asyncio.Queue()
+
+    async def worker():
+        for item in pending:  # shared iterator: each item goes to one worker
+            try:
+                result = await _run_item(job_id, item, persona_id, groups, pace, keys, models,
+                                         saved=item.index in saved)
+            except Exception as e:
+                # e.g. Postgres down while saving: report it, the item runs again on resume
+                logger.error(f"Broadcast {job_id} item {item.index}: {e}")
+                result = {"index": item.index, "user": item.user_urn, "status": FAILED, "error": str(e)}
+            await results.put(result)
+
+    workers = [asyncio.create_task(worker()) for _ in range(concurrency)]
+    try:
+        for _ in range(len(todo)):
+            yield await results.get()
+    finally:
+        # Client went away: stop; finished items are saved, a re-POST resumes
+        for task in workers:
+            task.cancel()
+        await asyncio.gather(*workers, return_exceptions=True)
+
+
+async def _run_item(job_id, item: BroadcastItem, persona_id, groups, pace: TokenBucket, keys: list,
+                    models: list, saved: bool = False) -> dict:
+    """`saved`: the campaign text is already in the user's history (earlier run of the job)."""
+    phone_number = item.user_urn.split(":")[-1]
+    error = None
+    attempt = 0
+    try:
+        while attempt < BROADCAST_MAX_ATTEMPTS:
+            attempt += 1
+            # Follow the capacity we actually have: rate-limited keys don't count
+            pace.rate = max(_ready_keys(keys, models), 1) * BROADCAST_KEY_RPM / 60
+            await pace.acquire()
+            try:
+                reply = await process_chat_request(None, phone_number, item.text, item.user_urn, groups or [],
+                                                   persona_id=persona_id, priority=LOW,
+                                                   save_user_message=not saved)
+            except Overloaded as e:
+                # Interactive traffic has the slots: back off and try again.
+                # Shed before anything was saved.
+                error, delay = str(e), e.retry_after
+            except LLMUnavailable as e:
+                # The message was saved before the Gemini calls failed
+                saved = True
+                error, delay = str(e), BROADCAST_RETRY_SECONDS * attempt
+            except Exception as e:
+                error = str(e)
+                break
+            else:
+                await save_broadcast_result(job_id, item.index, item.user_urn, OK, reply=reply, attempts=attempt,
+                                            user_message_saved=True)
+                metrics.incr("broadcast.ok")
+                return {"index": item.index, "user": item.user_urn, "status": OK, "text": reply}
+            metrics.incr("broadcast.retry")
+            if attempt < BROADCAST_MAX_ATTEMPTS:
+                await asyncio.sleep(delay)
+    except asyncio.CancelledError:
+        # Job dropped while backing off: the resumed job must still know the text is saved
+        if saved:
+            await asyncio.shield(save_broadcast_result(job_id, item.index, item.user_urn, FAILED,
+                                                       error="interrupted", attempts=attempt,
+                                                       user_message_saved=True))
+        raise
+
+    await save_broadcast_result(job_id, item.index, item.user_urn, FAILED, error=error, attempts=attempt,
+                                user_message_saved=saved)
+    metrics.incr("broadcast.failed")
+    logger.warning(f"⚠️ Broadcast {job_id} item {item.index} failed after {attempt} attempts: {error}")
+    return {"index": item.index, "user": item.user_urn, "status": FAILED, "error": error}
@@ -1,6 +1,13 @@
 import redis.asyncio as redis
+from redis.exceptions import WatchError
 import os
+import json
 import time
+import math
+import hashlib
+import re
+import unicodedata
+from app.core import metrics
 
 # Configuration
 VALKEY_URL = os.getenv("VALKEY_URL", "redis://127.0.0.1:6379/1") # DB 1 (RapidPro usually uses 0/1, let's use 2 to be safe? Or 1 if unused. RapidPro uses 1 for cache usually. Let's use 5 for AI safety)
@@ -18,20 +25,26 @@ async def check_health():
     except Exception:
         return False
 
-async def mark_key_failure(api_key: str, cooldown_seconds: int):
+def key_id(api_key: str) -> str:
+    """Stable id for an API key that doesn't expose the secret."""
+    return hashlib.md5(api_key.encode()).hexdigest()
+
+async def mark_key_failure(api_key: str, cooldown_seconds: float, model: str = None):
     """
-    Marks an API key as failed for a specific duration.
+    Marks an API key (or just one model on it) as failed for a specific duration.
     """
     r = await get_redis()
     # We store the 'ready_at' timestamp
     ready_at = time.time() + cooldown_seconds
+    cooldown_seconds = max(math.ceil(cooldown_seconds), 1)  # SETEX wants whole seconds
+    if model:
+        await r.setex(f"key_fail:{key_id(api_key)}:{model}", cooldown_seconds, str(ready_at))
+        return
     await r.setex(f"key_fail:{api_key[-6:]}", cooldown_seconds, str(ready_at))
     # Note: We use last 6 chars as ID to avoid storing full secret. 
     # Actually, we need unique ID. Let's hash it or assume last 6 is unique enough for this pool.
     # For safety, let's hash it.
-    import hashlib
-    key_hash = hashlib.md5(api_key.encode()).hexdigest()
-    await r.setex(f"key_fail:{key_hash}", cooldown_seconds, str(ready_at))
+    await r.setex(f"key_fail:{key_id(api_key)}", cooldown_seconds, str(ready_at))
 
 async def get_key_readiness(api_key: str) -> float:
     """
@@ -39,10 +52,164 @@ async def get_key_readiness(api_key: str) -> float:
     0 if ready now.
     """
     r = await get_redis()
-    import hashlib
-    key_hash = hashlib.md5(api_key.encode()).hexdigest()
-    
-    val = await r.get(f"key_fail:{key_hash}")
+    val = await r.get(f"key_fail:{key_id(api_key)}")
     if val:
         return float(val)
     return 0.0
+
+# --- Hot Conversation History (per-user ring buffer) ---
+# hist:{user_id} is a Valkey list, newest message first, capped at HISTORY_CACHE_SIZE.
+# Warm lists end with a sentinel so "warm but short/empty" is distinguishable
+# from "not cached"; once the list is full the sentinel is trimmed away.
+# histw:{user_id} marks a write in the last HISTORY_WARM_GRACE_SECONDS: a cold
+# read racing with a save (or with a row still in some worker's write-behind
+# buffer) must not warm the list with a snapshot that misses that message.
+HISTORY_CACHE_ENABLED = os.getenv("HISTORY_CACHE_ENABLED", "true").lower() == "true"
+HISTORY_CACHE_SIZE = int(os.getenv("HISTORY_CACHE_SIZE", "20"))
+HISTORY_CACHE_TTL = int(os.getenv("HISTORY_CACHE_TTL", "86400"))  # idle users expire
+HISTORY_CACHE_MAX_MESSAGE_BYTES = int(os.getenv("HISTORY_CACHE_MAX_MESSAGE_BYTES", "8192"))
+# > write-behind flush latency: a save this recent may not be readable from Postgres yet
+HISTORY_WARM_GRACE_SECONDS = int(os.getenv("HISTORY_WARM_GRACE_SECONDS", "5"))
+_HISTORY_SENTINEL = b"~"
+
+def _history_key(user_id: str) -> str:
+    return f"hist:{user_id}"
+
+def _history_write_key(user_id: str) -> str:
+    return f"histw:{user_id}"
+
+async def get_cached_history(user_id: str, limit: int):
+    """
+    Returns the last `limit` messages (chronological) or None on a miss.
+    Reading slides the idle TTL.
+    """
+    if not HISTORY_CACHE_ENABLED or limit > HISTORY_CACHE_SIZE:
+        return None
+    key = _history_key(user_id)
+    try:
+        r = await get_redis()
+        async with r.pipeline(transaction=False) as pipe:
+            pipe.lrange(key, 0, limit)  # one extra slot for the sentinel
+            pipe.expire(key, HISTORY_CACHE_TTL)
+            entries, _ = await pipe.execute()
+    except Exception:
+        return None
+    if not entries:
+        metrics.incr("history_cache.miss")
+        return None
+    metrics.incr("history_cache.hit")
+    messages = [json.loads(e) for e in entries if e != _HISTORY_SENTINEL][:limit]
+    return list(reversed(messages))
+
+async def warm_history(user_id: str, messages: list):
+    """
+    Replaces the cached list with `messages` (chronological, as read from Postgres),
+    unless a message was saved recently or while we read: then this snapshot
+    may miss it, and the next read after the grace period warms instead.
+    """
+    if not HISTORY_CACHE_ENABLED:
+        return
+    entries = [json.dumps(m) for m in messages[-HISTORY_CACHE_SIZE:]]
+    if any(len(e) > HISTORY_CACHE_MAX_MESSAGE_BYTES for e in entries):
+        return  # oversized conversations are served from Postgres only
+    key = _history_key(user_id)
+    try:
+        r = await get_redis()
+        async with r.pipeline(transaction=True) as pipe:
+            # WATCH: a push_history between the check and EXEC aborts the warm
+            await pipe.watch(_history_write_key(user_id))
+            if await pipe.exists(_history_write_key(user_id)):
+                metrics.incr("history_cache.warm_skipped")
+                return
+            pipe.multi()
+            pipe.delete(key)
+            pipe.lpush(key, _HISTORY_SENTINEL, *entries)  # ends up newest first
+            pipe.ltrim(key, 0, HISTORY_CACHE_SIZE)
+            pipe.expire(key, HISTORY_CACHE_TTL)
+            await pipe.execute()
+        metrics.incr("history_cache.warm")
+    except WatchError:
+        metrics.incr("history_cache.warm_skipped")
+    except Exception:
+        pass
+
+async def push_history(user_id: str, role: str, content: str):
+    """
+    Write-through on save. LPUSHX only extends lists that are already warm, so a
+    lone new message is never mistaken for the user's whole history.
+    """
+    if not HISTORY_CACHE_ENABLED:
+        return
+    entry = json.dumps({"role": role, "content": content})
+    key = _history_key(user_id)
+    try:
+        r = await get_redis()
+        oversized = len(entry) > HISTORY_CACHE_MAX_MESSAGE_BYTES
+        async with r.pipeline(transaction=True) as pipe:
+            # Cold list or not: a warm running right now must not miss this message
+            pipe.set(_history_write_key(user_id), 1, ex=HISTORY_WARM_GRACE_SECONDS)
+            if oversized:
+                pipe.delete(key)
+            else:
+                pipe.lpushx(key, entry)
+                pipe.ltrim(key, 0, HISTORY_CACHE_SIZE)
+                pipe.expire(key, HISTORY_CACHE_TTL)
+            await pipe.execute()
+        if oversized:
+            metrics.incr("history_cache.evict_oversized")
+    except Exception:
+        pass
+
+async def history_cache_memory(sample: int = 200) -> dict:
+    """
+    Memory accounting for the history cache: counts hist:* keys and
+    extrapolates MEMORY USAGE from a sample of them.
+    """
+    try:
+        r = await get_redis()
+        keys, sampled_bytes, sampled = 0, 0, 0
+        async for key in r.scan_iter(match="hist:*", count=500):
+            keys += 1
+            if sampled < sample:
+                sampled_bytes += await r.memory_usage(key) or 0
+                sampled += 1
+        approx = int(sampled_bytes / sampled * keys) if sampled else 0
+        return {"keys": keys, "approx_bytes": approx}
+    except Exception:
+        return {"keys": None, "approx_bytes": None}
+
+
+# --- Response Cache (repeated questions) ---
+# resp:{persona}:{sha1} -> reply text. The key is built by the persona manager
+# from the normalized message + a fingerprint of the context the reply depends on;
+# personas opt in through model_config["response_cache"].
+RESPONSE_CACHE_ENABLED = os.getenv("RESPONSE_CACHE_ENABLED", "true").lower() == "true"
+RESPONSE_CACHE_TTL = int(os.getenv("RESPONSE_CACHE_TTL", "3600"))
+RESPONSE_CACHE_MAX_CHARS = int(os.getenv("RESPONSE_CACHE_MAX_CHARS", "120"))  # longer messages are never FAQs
+
+def normalize_message(text: str) -> str:
+    """'  Kijan pou m PEYE ?? ' -> 'kijan pou m peye'; accents dropped ('Prix' == 'prìx')."""
+    text = unicodedata.normalize("NFKD", text or "")
+    text = "".join(c for c in text if not unicodedata.combining(c)).lower()
+    return " ".join(re.sub(r"[\W_]+", " ", text).split())
+
+def response_cache_key(persona_key, normalized: str, fingerprint: str) -> str:
+    digest = hashlib.sha1(f"{normalized}\x00{fingerprint}".encode()).hexdigest()
+    return f"resp:{persona_key}:{digest}"
+
+async def get_cached_reply(key: str):
+    try:
+        r = await get_redis()
+        value = await r.get(key)
+    except Exception:
+        return None
+    metrics.incr("response_cache.hit" if value is not None else "response_cache.miss")
+    return value.decode() if value is not None else None
+
+async def store_reply(key: str, reply: str, ttl: int = None):
+    try:
+        r = await get_redis()
+        await r.setex(key, ttl or RESPONSE_CACHE_TTL, reply)
+        metrics.incr("response_cache.store")
+    except Exception:
+        pass
@@ -0,0 +1,214 @@
+"""
+Fake Gemini backend for load tests (LLM_BACKEND=fake).
+
+Clients look like google.genai.Client to the engine and return real
+google.genai types, so everything above them (rotation, breakers, hedging,
+tools, usage ledger) runs for real. Behaviour comes from FAKE_LLM_* settings:
+
+  * latency: time to first token is lognormal around FAKE_LLM_LATENCY_MS
+    (spread FAKE_LLM_LATENCY_SIGMA), plus a FAKE_LLM_TAIL_RATE chance of a
+    FAKE_LLM_TAIL_MS stall; each further chunk takes FAKE_LLM_CHUNK_MS
+  * replies: FAKE_LLM_REPLY_TOKENS tokens in chunks of FAKE_LLM_CHUNK_TOKENS,
+    starting with an echo of the user message (easy to check in a test)
+  * tools: with FAKE_LLM_TOOL_RATE, a turn that may call tools calls one of
+    the declared ones; the turn after a tool result answers with text
+  * errors: FAKE_LLM_429_RATE / FAKE_LLM_503_RATE raise the same APIError
+    Gemini does (429 with a RetryInfo delay)
+
+FAKE_LLM_SEED makes the random draws repeatable.
+"""
+import os
+import math
+import random
+import asyncio
+from dataclasses import dataclass
+from google.genai import errors, types
+from app.services.llm_backends import LLMBackend
+
+_WORDS = ("mwen", "ka", "ede", "ou", "ak", "sa", "tanpri", "mèsi", "wi", "byen", "konsa", "kounye")
+
+
+@dataclass
+class FakeProfile:
+    latency_ms: float = 800
+    latency_sigma: float = 0.5
+    tail_rate: float = 0.0
+    tail_ms: float = 5000
+    chunk_ms: float = 30
+    reply_tokens: int = 60
+    chunk_tokens: int = 8
+    tool_rate: float = 0.0
+    rate_429: float = 0.0
+    rate_503: float = 0.0
+    retry_delay_s: float = 5
+    seed: int = None
+
+    @classmethod
+    def from_env(cls):
+        seed = os.getenv("FAKE_LLM_SEED")
+        return cls(
+            latency_ms=float(os.getenv("FAKE_LLM_LATENCY_MS", "800")),
+            latency_sigma=float(os.getenv("FAKE_LLM_LATENCY_SIGMA", "0.5")),
+            tail_rate=float(os.getenv("FAKE_LLM_TAIL_RATE", "0")),
+            tail_ms=float(os.getenv("FAKE_LLM_TAIL_MS", "5000")),
+            chunk_ms=float(os.getenv("FAKE_LLM_CHUNK_MS", "30")),
+            reply_tokens=int(os.getenv("FAKE_LLM_REPLY_TOKENS", "60")),
+            chunk_tokens=int(os.getenv("FAKE_LLM_CHUNK_TOKENS", "8")),
+            tool_rate=float(os.getenv("FAKE_LLM_TOOL_RATE", "0")),
+            rate_429=float(os.getenv("FAKE_LLM_429_RATE", "0")),
+            rate_503=float(os.getenv("FAKE_LLM_503_RATE", "0")),
+            retry_delay_s=float(os.getenv("FAKE_LLM_RETRY_DELAY_SECONDS", "5")),
+            seed=int(seed) if seed else None,
+        )
+
+
+class FakeBackend(LLMBackend):
+    name = "fake"
+
+    def __init__(self, profile: FakeProfile = None):
+        self.profile = profile or FakeProfile()
+        self.rng = random.Random(self.profile.seed)
+        self.calls = 0
+
+    def create_client(self, api_key: str):
+        return _FakeClient(self, api_key)
+
+    # --- Behaviour ---
+
+    def first_token_delay(self) -> float:
+        p = self.profile
+        delay = p.latency_ms * math.exp(self.rng.gauss(0, p.latency_sigma)) if p.latency_ms else 0
+        if p.tail_rate and self.rng.random() < p.tail_rate:
+            delay += p.tail_ms
+        return delay / 1000
+
+    def maybe_fail(self, model: str):
+        roll = self.rng.random()
+        if roll < self.profile.rate_429:
+            raise errors.APIError(429, {"error": {
+                "code": 429, "status": "RESOURCE_EXHAUSTED",
+                "message": f"Fake quota exceeded for {model}",
+                "details": [{"@type": "type.googleapis.com/google.rpc.RetryInfo",
+                             "retryDelay": f"{self.profile.retry_delay_s:g}s"}]
+            }})
+        if roll < self.profile.rate_429 + self.profile.rate_503:
+            raise errors.APIError(503, {"error": {
+                "code": 503, "status": "UNAVAILABLE", "message": "Fake model overloaded"
+            }})
+
+    def plan(self, model: str, contents: list, config) -> list:
+        """The reply as a list of chunks, each a list of Parts."""
+        last = contents[-1] if contents else None
+        last_parts = (last.parts or []) if last is not None else []
+        tool_results = [p.function_response.name for p in last_parts if p.function_response]
+        declarations = _declarations(config)
+        if declarations and not tool_results and self.rng.random() < self.profile.tool_rate:
+            declaration = self.rng.choice(declarations)
+            call = types.FunctionCall(name=declaration.name, args=_fake_args(declaration))
+            return [[types.Part(function_call=call)]]
+
+        if tool_results:
+            lead = f"Done: {', '.join(tool_results)}."
+        else:
+            said = " ".join(p.text for p in last_parts if p.text).strip()
+            lead = f"[fake {model}] {said[:80]}"
+        words = lead.split()
+        while len(words) < self.profile.reply_tokens:
+            words.append(self.rng.choice(_WORDS))
+        size = max(self.profile.chunk_tokens, 1)
+        pieces = [" ".join(words[i:i + size]) for i in range(0, len(words), size)]
+        return [[types.Part(text=(" " if i else "") + piece)] for i, piece in enumerate(pieces)]
+
+
+class _FakeModels:
+    def __init__(self, backend: FakeBackend):
+        self._backend = backend
+
+    async def generate_content(self, model, contents, config=None):
+        chunks = await self._start(model, contents, config)
+        await asyncio.sleep(self._backend.profile.chunk_ms / 1000 * (len(chunks) - 1))
+        parts = [part for chunk in chunks for part in chunk]
+        if all(p.text for p in parts):
+            parts = [types.Part(text="".join(p.text for p in parts))]
+        return _response(parts, _usage(contents, chunks))
+
+    async def generate_content_stream(self, model, contents, config=None):
+        chunks = await self._start(model, contents, config)
+        return self._stream(contents, chunks)
+
+    async def _start(self, model, contents, config):
+        backend = self._backend
+        backend.calls += 1
+        await asyncio.sleep(backend.first_token_delay())
+        backend.maybe_fail(model)
+        return backend.plan(model, contents, config)
+
+    async def _stream(self, contents, chunks):
+        for i, parts in enumerate(chunks):
+            if i:
+                await asyncio.sleep(self._backend.profile.chunk_ms / 1000)
+            last = i == len(chunks) - 1
+            # Like Gemini: usage totals ride on the last chunk
+            yield _response(parts, _usage(contents, chunks) if last else None)
+
+
+class _FakeAio:
+    def __init__(self, backend: FakeBackend):
+        self.models = _FakeModels(backend)
+
+    async def aclose(self):
+        pass
+
+
+class _FakeClient:
+    def __init__(self, backend: FakeBackend, api_key: str):
+        self.api_key = api_key
+        self.aio = _FakeAio(backend)
+
+    def close(self):
+        pass
+
+
+def _declarations(config) -> list:
+    if config is None or not config.tools:
+        return []
+    calling = config.tool_config and config.tool_config.function_calling_config
+    if calling and calling.mode == types.FunctionCallingConfigMode.NONE:
+        return []
+    return [d for tool in config.tools for d in (tool.function_declarations or [])]
+
+
+def _fake_args(declaration) -> dict:
+    schema = declaration.parameters
+    args = {}
+    for name in (schema.required or []) if schema else []:
+        kind = schema.properties[name].type if name in (schema.properties or {}) else None
+        if kind == types.Type.OBJECT:
+            args[name] = {"source": "fake"}
+        elif kind in (types.Type.NUMBER, types.Type.INTEGER):
+            args[name] = 1
+        elif kind == types.Type.BOOLEAN:
+            args[name] = True
+        else:
+            args[name] = "basic"
+    return args
+
+
+def _tokens(text: str) -> int:
+    return (len(text) + 3) // 4
+
+
+def _usage(contents, chunks):
+    prompt = sum(_tokens(p.text or "") for c in contents for p in (c.parts or []))
+    output = sum(_tokens(p.text or "") + (8 if p.function_call else 0) for chunk in chunks for p in chunk)
+    return types.GenerateContentResponseUsageMetadata(
+        prompt_token_count=prompt, candidates_token_count=output, total_token_count=prompt + output
+    )
+
+
+def _response(parts, usage=None):
+    return types.GenerateContentResponse(
+        candidates=[types.Candidate(content=types.Content(role="model", parts=parts),
+                                    finish_reason=types.FinishReason.STOP)],
+        usage_metadata=usage
+    )
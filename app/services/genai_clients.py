@@ -0,0 +1,141 @@
+"""
+One genai.Client per API key, reused across requests.
+(Or a fake client: the LLM backend builds them, see llm_backends.py.)
+
+Building a Client costs ~100ms of CPU (SSL context), and a fresh client also
+means a fresh TCP + TLS handshake to Gemini on its first call. Reusing the
+client keeps its HTTP connection pool (and keep-alive connections) warm.
+
+System keys (GOOGLE_API_KEY) are kept for the life of the process. Per-user
+OAuth keys go into an LRU of GENAI_CLIENT_CACHE_SIZE entries and are dropped
+after GENAI_CLIENT_IDLE_SECONDS without use. A client evicted while a request
+is still using it is closed when that request releases it.
+"""
+import os
+import time
+import asyncio
+import logging
+from collections import OrderedDict
+from contextlib import asynccontextmanager
+from app.core import metrics
+from app.core.config import get_system_api_keys
+from app.services.llm_backends import LLMBackend, get_backend
+
+logger = logging.getLogger(__name__)
+
+GENAI_CLIENT_CACHE_SIZE = int(os.getenv("GENAI_CLIENT_CACHE_SIZE", "256"))
+GENAI_CLIENT_IDLE_SECONDS = float(os.getenv("GENAI_CLIENT_IDLE_SECONDS", "900"))
+
+
+class _Entry:
+    __slots__ = ("client", "last_used", "leases", "evicted")
+
+    def __init__(self, client):
+        self.client = client
+        self.last_used = time.monotonic()
+        self.leases = 0
+        self.evicted = False
+
+
+class ClientCache:
+    def __init__(self, max_user_clients: int = None, idle_seconds: float = None, backend: LLMBackend = None):
+        self.backend = backend or get_backend()
+        self.max_user_clients = GENAI_CLIENT_CACHE_SIZE if max_user_clients is None else max_user_clients
+        self.idle_seconds = GENAI_CLIENT_IDLE_SECONDS if idle_seconds is None else idle_seconds
+        self._system = {}            # api_key -> _Entry, never evicted
+        self._users = OrderedDict()  # api_key -> _Entry, least recently used first
+        self._locks = {}             # api_key -> Lock, so one key is only built once
+
+    def __len__(self):
+        return len(self._system) + len(self._users)
+
+    @asynccontextmanager
+    async def lease(self, api_key: str):
+        """Yields the shared client for `api_key`. Don't close it; the cache owns it."""
+        entry = await self._get(api_key)
+        entry.leases += 1
+        try:
+            yield entry.client
+        finally:
+            entry.leases -= 1
+            entry.last_used = time.monotonic()
+            if entry.evicted and entry.leases == 0:
+                await self._close(entry)
+
+    async def _get(self, api_key: str) -> _Entry:
+        await self._expire_idle()
+        entry = self._lookup(api_key)
+        if entry:
+            metrics.incr("genai_client.hit")
+            return entry
+
+        lock = self._locks.setdefault(api_key, asyncio.Lock())
+        async with lock:
+            entry = self._lookup(api_key)  # built while we waited
+            if entry:
+                metrics.incr("genai_client.hit")
+                return entry
+            metrics.incr("genai_client.miss")
+            # Client construction builds an SSL context (~100ms of CPU): keep it off the loop.
+            client = await asyncio.to_thread(self.backend.create_client, api_key)
+            entry = _Entry(client)
+            if api_key in get_system_api_keys():
+                self._system[api_key] = entry
+            else:
+                self._users[api_key] = entry
+                await self._evict_lru()
+        if not lock.locked():
+            self._locks.pop(api_key, None)
+        return entry
+
+    def _lookup(self, api_key: str):
+        entry = self._system.get(api_key)
+        if entry is None:
+            entry = self._users.get(api_key)
+            if entry is not None:
+                self._users.move_to_end(api_key)
+        if entry is not None:
+            entry.last_used = time.monotonic()
+        return entry
+
+    async def _evict_lru(self):
+        while len(self._users) > self.max_user_clients:
+            _, entry = self._users.popitem(last=False)
+            await self._evict(entry)
+
+    async def _expire_idle(self):
+        # LRU order == last-use order, so idle entries are all at the front
+        cutoff = time.monotonic() - self.idle_seconds
+        while self._users:
+            key, entry = next(iter(self._users.items()))
+            if entry.last_used > cutoff or entry.leases:
+                break
+            del self._users[key]
+            await self._evict(entry)
+
+    async def _evict(self, entry: _Entry):
+        metrics.incr("genai_client.evict")
+        entry.evicted = True
+        if entry.leases == 0:
+            await self._close(entry)
+
+    async def _close(self, entry: _Entry):
+        try:
+            await entry.client.aio.aclose()
+            entry.client.close()
+        except Exception as e:
+            logger.warning(f"⚠️ Error closing Gemini client: {e}")
+
+    async def close_all(self):
+        """Shutdown: closes every client, in use or not."""
+        entries = list(self._system.values()) + list(self._users.values())
+        self._system.clear()
+        self._users.clear()
+        self._locks.clear()
+        for entry in entries:
+            await self._close(entry)
+        if entries:
+            logger.info(f"🔌 Closed {len(entries)} Gemini clients")
+
+
+client_cache = ClientCache()
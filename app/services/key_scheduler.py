@@ -0,0 +1,260 @@
+"""
+Readiness-aware ordering of Gemini API keys.
+
+Decides which keys a request tries, and in what order, from memory only:
+  * keys whose circuit breaker is open for the model are skipped
+  * the user's own OAuth key (anything not in GOOGLE_API_KEY) keeps priority
+  * system keys are spread by fewest in-flight calls, then lowest success
+    latency (EWMA), with a rotating tie-break
+
+Circuit breakers are per (key, model), since Gemini quotas are per model;
+auth failures open a key-wide breaker. A breaker opens on a classified
+failure (app/services/llm_errors.py) for an exponentially growing time
+(Retry-After wins if longer), goes half-open when that time is up (one
+probe call is let through) and closes on the first success.
+
+Open breakers are written to Valkey (key_fail:<md5>[:model]) and published
+on `key_cooldown`; every worker subscribes and keeps a local mirror,
+bootstrapped from the key_fail:* keys on start. If Valkey is down each
+worker simply learns cooldowns from its own failures.
+"""
+import time
+import asyncio
+import logging
+from collections import defaultdict, deque
+from contextlib import contextmanager
+from app.services import cache
+from app.core.config import get_system_api_keys
+
+logger = logging.getLogger(__name__)
+
+COOLDOWN_CHANNEL = "key_cooldown"
+LATENCY_EWMA_ALPHA = 0.2
+LATENCY_WINDOW = 500  # recent successful calls (all keys) for percentiles
+BREAKER_RESET_SECONDS = 900  # a failure this long after the last one starts the backoff over
+
+
+def breaker_id(kid: str, model: str = None) -> str:
+    """'<md5>' for the whole key, '<md5>:<model>' for one model on it."""
+    return f"{kid}:{model}" if model else kid
+
+
+class KeyScheduler:
+    def __init__(self):
+        self._ready_at = {}                   # breaker id -> epoch seconds when open ends (local + other workers)
+        self._failures = {}                   # breaker id -> (consecutive failures, last failure) (this worker)
+        self._probing = set()                 # half-open breakers with their probe call in flight
+        self._in_flight = defaultdict(int)    # key id -> calls in progress (this worker)
+        self._latency = {}                    # key id -> EWMA of successful call latency (s)
+        self._samples = deque(maxlen=LATENCY_WINDOW)
+        self._rr = 0
+        self._listener = None
+        self.running = False
+
+    # --- Selection (no I/O) ---
+
+    def order(self, candidate_keys: list, model: str = None) -> list:
+        now = time.time()
+        system = set(get_system_api_keys())
+        ready = [key for key in dict.fromkeys(candidate_keys)  # dedupe, keep order
+                 if self._blocked_until(cache.key_id(key), model, now) <= now]
+
+        own = [k for k in ready if k not in system]
+        pooled = [k for k in ready if k in system]
+        if pooled:
+            self._rr = (self._rr + 1) % len(pooled)
+            pooled = pooled[self._rr:] + pooled[:self._rr]
+            pooled.sort(key=lambda k: (self._in_flight.get(cache.key_id(k), 0),
+                                       self._latency.get(cache.key_id(k), 0.0)))
+        # Everything open: no keys, so the caller fails fast (LLMUnavailable) and
+        # its model fallback takes over instead of calling through an open breaker.
+        # An expired breaker is ready again (half-open) and gets its one probe.
+        return own + pooled
+
+    def _blocked_until(self, kid: str, model: str, now: float) -> float:
+        ready_at = self._ready_at.get(kid, 0)
+        if model:
+            bid = breaker_id(kid, model)
+            ready_at = max(ready_at, self._ready_at.get(bid, 0))
+            if bid in self._probing:
+                ready_at = max(ready_at, now + 1)  # half-open: one probe at a time
+        return ready_at
+
+    def is_ready(self, api_key: str, model: str = None) -> bool:
+        now = time.time()
+        return self._blocked_until(cache.key_id(api_key), model, now) <= now
+
+    def state(self, api_key: str, model: str = None) -> str:
+        """closed / open / half_open, as this worker sees it."""
+        bid = breaker_id(cache.key_id(api_key), model)
+        if not self.is_ready(api_key, model):
+            return "open"
+        return "half_open" if bid in self._failures else "closed"
+
+    @contextmanager
+    def track(self, api_key: str, model: str = None):
+        """
+        Counts the call as in flight; records its latency if it succeeds.
+        A call on a half-open breaker is its probe: success closes the breaker.
+        """
+        kid = cache.key_id(api_key)
+        bid = breaker_id(kid, model)
+        probe = bid in self._failures and bid not in self._probing and self.is_ready(api_key, model)
+        if probe:
+            self._probing.add(bid)
+        self._in_flight[kid] += 1
+        started = time.perf_counter()
+        ok = False
+        try:
+            yield
+            ok = True
+        finally:
+            if probe:
+                self._probing.discard(bid)
+            if ok:
+                self._failures.pop(bid, None)
+                self._failures.pop(kid, None)
+            self._in_flight[kid] -= 1
+            if not self._in_flight[kid]:
+                del self._in_flight[kid]
+            elapsed = time.perf_counter() - started
+            if ok:
+                self._samples.append(elapsed)
+            # Per-key latency only steers the system-key spread; don't keep it per user token
+            if ok and api_key in get_system_api_keys():
+                prev = self._latency.get(kid)
+                self._latency[kid] = elapsed if prev is None else prev + LATENCY_EWMA_ALPHA * (elapsed - prev)
+
+    def latency_quantile(self, q: float, min_samples: int = 20):
+        """q-quantile (seconds) of recent successful calls, None until we have enough."""
+        if len(self._samples) < min_samples:
+            return None
+        ordered = sorted(self._samples)
+        return ordered[min(int(q * len(ordered)), len(ordered) - 1)]
+
+    def expected_latency_beyond(self, t: float) -> float:
+        """Mean recent latency of calls slower than t (seconds); t itself if none were."""
+        slower = [s for s in self._samples if s > t]
+        return sum(slower) / len(slower) if slower else t
+
+    # --- Cooldowns ---
+
+    async def trip(self, api_key: str, model: str, error) -> float:
+        """Opens the breaker for a classified failure (LLMError). Returns seconds open."""
+        bid = breaker_id(cache.key_id(api_key), None if error.key_wide else model)
+        now = time.time()
+        failures, last = self._failures.get(bid, (0, 0))
+        if now - last > BREAKER_RESET_SECONDS:
+            failures = 0
+        failures += 1
+        self._failures[bid] = (failures, now)
+        seconds = error.backoff(failures)
+        await self.mark_failure(api_key, seconds, None if error.key_wide else model)
+        return seconds
+
+    async def mark_failure(self, api_key: str, cooldown_seconds: float, model: str = None):
+        ready_at = time.time() + cooldown_seconds
+        bid = breaker_id(cache.key_id(api_key), model)
+        self._note_cooldown(bid, ready_at)
+        try:
+            await cache.mark_key_failure(api_key, cooldown_seconds, model)
+            r = await cache.get_redis()
+            await r.publish(COOLDOWN_CHANNEL, f"{bid}:{ready_at}")
+        except Exception as e:
+            logger.warning(f"⚠️ Could not share key cooldown via Valkey: {e}")
+
+    def _note_cooldown(self, bid: str, ready_at: float):
+        if ready_at > self._ready_at.get(bid, 0):
+            self._ready_at[bid] = ready_at
+        # Drop expired entries so the mirror doesn't grow with rotated user tokens
+        now = time.time()
+        for k in [k for k, t in self._ready_at.items() if t <= now]:
+            del self._ready_at[k]
+        for k in [k for k, (_, last) in self._failures.items() if now - last > BREAKER_RESET_SECONDS]:
+            del self._failures[k]
+
+    # --- Valkey sync ---
+
+    async def start(self):
+        if self.running:
+            return
+        self.running = True
+        self._listener = asyncio.create_task(self._listen())
+
+    async def stop(self):
+        self.running = False
+        if self._listener:
+            self._listener.cancel()
+            try:
+                await self._listener
+            except asyncio.CancelledError:
+                pass
+            self._listener = None
+
+    async def _bootstrap(self, r):
+        keys = [k async for k in r.scan_iter(match="key_fail:*", count=500)]
+        # md5 ids only ("key_fail:<md5>" or "key_fail:<md5>:<model>"), not legacy suffix keys
+        keys = [k for k in keys if len(k) == len("key_fail:") + 32 or k[len("key_fail:") + 32:][:1] == b":"]
+        if not keys:
+            return
+        for key, value in zip(keys, await r.mget(keys)):
+            if value:
+                self._note_cooldown(key.decode()[len("key_fail:"):], float(value))
+
+    async def _listen(self):
+        delay = 1
+        while self.running:
+            pubsub = None
+            try:
+                r = await cache.get_redis()
+                pubsub = r.pubsub()
+                # Subscribe before reading the snapshot so nothing falls in between
+                await pubsub.subscribe(COOLDOWN_CHANNEL)
+                await self._bootstrap(r)
+                logger.info(f"🔑 Key scheduler synced ({len(self._ready_at)} keys cooling down)")
+                delay = 1
+                async for message in pubsub.listen():
+                    if message.get("type") != "message":
+                        continue
+                    try:
+                        bid, ready_at = message["data"].decode().rsplit(":", 1)
+                        self._note_cooldown(bid, float(ready_at))
+                    except ValueError:
+                        continue
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.warning(f"⚠️ Key cooldown subscription lost, retry in {delay}s: {e}")
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, 30)
+            finally:
+                if pubsub is not None:
+                    try:
+                        await pubsub.aclose()
+                    except Exception:
+                        pass
+
+    def snapshot(self) -> dict:
+        """Per-key state for /metrics (ids are hash prefixes, never the key)."""
+        now = time.time()
+        keys = {}
+        for kid in set(self._in_flight) | set(self._latency) | {b[:32] for b in self._ready_at}:
+            keys[kid[:8]] = {
+                "in_flight": self._in_flight.get(kid, 0),
+                "latency_ms": round(self._latency[kid] * 1000, 1) if kid in self._latency else None,
+                "cooldown_s": max(round(self._ready_at.get(kid, 0) - now, 1), 0),
+            }
+        for bid in set(self._ready_at) | set(self._failures):
+            if ":" not in bid:
+                continue
+            kid, model = bid.split(":", 1)
+            open_s = max(round(self._ready_at.get(bid, 0) - now, 1), 0)
+            keys.setdefault(kid[:8], {}).setdefault("breakers", {})[model] = {
+                "state": "open" if open_s else ("half_open" if bid in self._failures else "closed"),
+                "open_s": open_s,
+                "failures": self._failures.get(bid, (0, 0))[0],
+            }
+        return dict(sorted(keys.items()))
+
+
+key_scheduler = KeyScheduler()
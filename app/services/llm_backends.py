@@ -0,0 +1,50 @@
+"""
+LLM backends: what the engine's clients actually talk to.
+
+The engine only uses the google-genai client surface
+(`client.aio.models.generate_content` / `generate_content_stream`), leased per
+API key from the client cache. A backend decides how those clients are built:
+
+  * gemini (default): real google.genai.Client objects
+  * fake: app/services/fake_llm.py, simulated latency, streaming, tool calls
+    and 429/503 errors, for load tests without quota or network
+
+Pick one with LLM_BACKEND. Key rotation, breakers, hedging and admission
+control run unchanged on top of either, so a benchmark against the fake
+measures the middleware itself.
+"""
+import os
+import logging
+from abc import ABC, abstractmethod
+from google import genai
+
+logger = logging.getLogger(__name__)
+
+LLM_BACKEND = os.getenv("LLM_BACKEND", "gemini").lower()
+
+
+class LLMBackend(ABC):
+    name = "base"
+
+    @abstractmethod
+    def create_client(self, api_key: str):
+        """Builds a client for `api_key` (called off the event loop, once per key)."""
+
+
+class GeminiBackend(LLMBackend):
+    name = "gemini"
+
+    def create_client(self, api_key: str):
+        return genai.Client(api_key=api_key)
+
+
+def get_backend(name: str = None) -> LLMBackend:
+    name = (name or LLM_BACKEND).lower()
+    if name == "gemini":
+        return GeminiBackend()
+    if name == "fake":
+        from app.services.fake_llm import FakeBackend, FakeProfile
+        profile = FakeProfile.from_env()
+        logger.warning(f"🧪 LLM backend is FAKE: no Gemini calls will be made ({profile})")
+        return FakeBackend(profile)
+    raise ValueError(f"Unknown LLM_BACKEND '{name}' (expected gemini or fake)")
@@ -5,49 +5,261 @@ import os
 import traceback
 import asyncio
 import time
+from app.services.genai_clients import client_cache
+from app.services.key_scheduler import key_scheduler
+from app.core import metrics
+from app.core.ratelimit import TokenBucket
+from app.services.cache import key_id
+from app.services.llm_errors import classify, TIMEOUT
+from dataclasses import dataclass
 
 logger = logging.getLogger(__name__)
 
+# Per-attempt deadline for a single Gemini call. A key that does not answer in
+# time is abandoned (the in-flight request is cancelled) and the next key is tried.
+LLM_TIMEOUT_SECONDS = float(os.getenv("LLM_TIMEOUT_SECONDS", "30"))
+
+# Tried in order after the requested model when every key is unavailable for it
+# (quota, overload, model gone). A persona can set its own: model_config["fallback_models"].
+LLM_FALLBACK_MODELS = [m.strip() for m in os.getenv(
+    "LLM_FALLBACK_MODELS", "gemini-2.5-flash,gemini-2.5-flash-lite").split(",") if m.strip()]
+
+
+class LLMUnavailable(Exception):
+    """No key could serve the model (all breakers open or all calls failed retryably)."""
+
+
+def _model_chain(model: str, fallback_models: list = None) -> list:
+    fallbacks = LLM_FALLBACK_MODELS if fallback_models is None else fallback_models
+    return list(dict.fromkeys([model] + list(fallbacks)))
+
+@dataclass
+class LLMUsage:
+    """Tokens and latency of one successful Gemini call (from usage_metadata)."""
+    model: str
+    key_id: str
+    prompt_tokens: int = 0
+    output_tokens: int = 0
+    thoughts_tokens: int = 0
+    cached_tokens: int = 0
+    latency_ms: int = 0
+
+    @classmethod
+    def from_response(cls, response, model, access_token, started):
+        meta = getattr(response, "usage_metadata", None)
+        return cls(
+            model=model,
+            key_id=key_id(access_token),
+            prompt_tokens=getattr(meta, "prompt_token_count", None) or 0,
+            output_tokens=getattr(meta, "candidates_token_count", None) or 0,
+            thoughts_tokens=getattr(meta, "thoughts_token_count", None) or 0,
+            cached_tokens=getattr(meta, "cached_content_token_count", None) or 0,
+            latency_ms=int((time.monotonic() - started) * 1000),
+        )
+
+
+# --- Hedging ---
+# Opt-in (LLM_HEDGE_DEFAULT, or "hedge" in a persona's model_config): if the
+# primary call is still running after the recent p95 latency, the same request
+# is sent on the next healthy key and whichever answers first wins; the other
+# is cancelled. At most one hedge per request, and at most
+# LLM_HEDGE_MAX_PER_SECOND hedges per worker so a slow Gemini can't double our load.
+LLM_HEDGE_DEFAULT = os.getenv("LLM_HEDGE_DEFAULT", "false").lower() == "true"
+LLM_HEDGE_QUANTILE = float(os.getenv("LLM_HEDGE_QUANTILE", "0.95"))
+LLM_HEDGE_DELAY_MS = float(os.getenv("LLM_HEDGE_DELAY_MS", "3000"))          # until we have latency samples
+LLM_HEDGE_MIN_DELAY_MS = float(os.getenv("LLM_HEDGE_MIN_DELAY_MS", "300"))
+LLM_HEDGE_MAX_PER_SECOND = float(os.getenv("LLM_HEDGE_MAX_PER_SECOND", "2"))
+
+_hedge_bucket = TokenBucket(LLM_HEDGE_MAX_PER_SECOND)
+
+
+def _hedge_delay() -> float:
+    """Seconds to wait on the primary before hedging."""
+    p = key_scheduler.latency_quantile(LLM_HEDGE_QUANTILE)
+    delay = p if p is not None else LLM_HEDGE_DELAY_MS / 1000
+    return max(delay, LLM_HEDGE_MIN_DELAY_MS / 1000)
+
+
+async def _generate_once(access_token, model, content_payload, config, timeout):
+    # Clients are cached per key (app/services/genai_clients.py), so
+    # repeat calls reuse the warm connection pool instead of a new TLS handshake.
+    async with client_cache.lease(access_token) as client:
+        with key_scheduler.track(access_token, model):
+            # Use the SDK's native async surface (client.aio) so the event loop
+            # keeps serving other chats while this one waits on Gemini.
+            # wait_for cancels the underlying HTTP request on timeout, and a
+            # cancelled caller (client disconnect) propagates straight through.
+            return await asyncio.wait_for(
+                client.aio.models.generate_content(
+                    model=model,
+                    contents=content_payload,
+                    config=config
+                ),
+                timeout=timeout
+            )
+
+
 # --- Key Rotation Logic ---
-async def _call_llm_safe_rotation(messages, tools, model, candidate_keys, cooldown_seconds=60):
-    # This logic remains the same as verified before, just ensuring imports are correct
-    # We might need to inject the cache/failure marking dependency or keep it self-contained
-    # For refactor, let's keep it here but we need 'mark_key_failure'
-    # We can import it from app.services.cache (if we move it) or keep using cache.py for now
-    
-    # Ideally, cache logic moves to app/services/cache.py
-    # For now, let's assume we import the old one or move it.
-    # Plan: Move cache.py to app/services/cache.py
-    from app.services.cache import mark_key_failure 
+async def _call_llm_safe_rotation(messages, tools, model, candidate_keys, timeout=None, hedge=False,
+                                  allow_tools=True, usage=None):
+    # Circuit breakers live in the key scheduler, which shares open breakers across
+    # workers (Valkey key_fail:* + pub/sub) and skips them without a round trip.
+    # Without hedging this is plain sequential rotation: one attempt at a time.
     
+    config, content_payload = _build_request(messages, tools, allow_tools)
+    timeout = timeout or LLM_TIMEOUT_SECONDS
+
+    queue = list(enumerate(key_scheduler.order(candidate_keys, model)))
+    pending = {}  # task -> (key index, key, is_hedge, started)
+    hedges_left = 1 if hedge else 0
+    hedge_delay = _hedge_delay() if hedge else None
+    primary_started = None
+
+    def launch(is_hedge):
+        i, key = queue.pop(0)
+        task = asyncio.create_task(_generate_once(key, model, content_payload, config, timeout))
+        pending[task] = (i, key, is_hedge, time.monotonic())
+
+    try:
+        while queue or pending:
+            if not pending:
+                launch(is_hedge=False)
+                primary_started = time.monotonic()
+
+            wait = None
+            if hedges_left and queue:
+                wait = max(hedge_delay - (time.monotonic() - primary_started), 0)
+            done, _ = await asyncio.wait(pending, timeout=wait, return_when=asyncio.FIRST_COMPLETED)
+
+            if not done:
+                # Primary is past the p95 budget
+                hedges_left = 0
+                metrics.incr("llm.hedge.eligible")
+                if _hedge_bucket.try_acquire():
+                    metrics.incr("llm.hedge.fired")
+                    logger.info(f"🏁 Hedging after {hedge_delay:.2f}s on key #{queue[0][0]+1}")
+                    launch(is_hedge=True)
+                else:
+                    metrics.incr("llm.hedge.rate_limited")
+                continue
+
+            for task in done:
+                i, access_token, is_hedge, started = pending.pop(task)
+                try:
+                    response = task.result()
+                except Exception as e:
+                    if await _on_failure(i, access_token, model, e):
+                        continue
+                    raise e
+                if is_hedge:
+                    # Saved = how much longer a call this slow usually keeps going
+                    waited = time.monotonic() - primary_started
+                    metrics.incr("llm.hedge.won")
+                    metrics.incr("llm.hedge.saved_ms",
+                                 max(key_scheduler.expected_latency_beyond(waited) - waited, 0) * 1000)
+                if usage is not None:
+                    usage.append(LLMUsage.from_response(response, model, access_token, started))
+                return response
+        raise LLMUnavailable(f"All keys exhausted for {model}")
+    finally:
+        # Loser (or everything, if we were cancelled): stop the HTTP calls
+        for task in pending:
+            task.cancel()
+        if pending:
+            await asyncio.gather(*pending, return_exceptions=True)
+
+
+def _build_request(messages, tools, allow_tools=True):
     config = types.GenerateContentConfig(
         tools=tools,
         system_instruction=messages[0].parts[0].text if messages[0].role == "system" else None,
-        temperature=0.7
+        temperature=0.7,
+        # Tools stay declared (the history may hold calls to them) but can't be called
+        tool_config=None if allow_tools else types.ToolConfig(
+            function_calling_config=types.FunctionCallingConfig(mode=types.FunctionCallingConfigMode.NONE)
+        )
     )
-    
     # Filter out system message from 'contents'
-    content_payload = [m for m in messages if m.role != "system"]
+    return config, [m for m in messages if m.role != "system"]
+
+
+async def _on_failure(i, access_token, model, e) -> bool:
+    """Classifies `e`, opens the breaker if it calls for it; True if another key is worth a try."""
+    error = classify(e)
+    metrics.incr(f"llm.error.{error.kind}")
+    if error.trips_breaker:
+        seconds = await key_scheduler.trip(access_token, model, error)
+        logger.warning(f"⚠️ Key #{i+1} {error.kind} on {model}. Breaker open {seconds:.0f}s.")
+    elif error.kind == TIMEOUT:
+        # Slowness is not a quota problem, so no cooldown; just move on.
+        logger.warning(f"⏱️ Key #{i+1} timed out on {model}.")
+    return error.retryable
 
-    for i, access_token in enumerate(candidate_keys):
+
+async def _stream_llm_safe_rotation(messages, tools, model, candidate_keys, timeout=None,
+                                    allow_tools=True, usage=None):
+    """
+    Streaming twin of _call_llm_safe_rotation: yields GenerateContentResponse chunks.
+    Keys can only be rotated until the first chunk is out; after that an error
+    ends the stream. `timeout` applies to each chunk, not the whole reply.
+    """
+    config, content_payload = _build_request(messages, tools, allow_tools)
+    timeout = timeout or LLM_TIMEOUT_SECONDS
+
+    for i, access_token in enumerate(key_scheduler.order(candidate_keys, model)):
+        started = False
+        stream = None
+        began = time.monotonic()
+        metered = None  # last chunk carrying usage_metadata (Gemini sends totals at the end)
         try:
-            client = genai.Client(api_key=access_token)
-            response = client.models.generate_content(
-                model=model,
-                contents=content_payload,
-                config=config
-            )
-            return response
+            async with client_cache.lease(access_token) as client:
+                # Scheduler latency = time to first chunk
+                with key_scheduler.track(access_token, model):
+                    stream = await asyncio.wait_for(
+                        client.aio.models.generate_content_stream(
+                            model=model,
+                            contents=content_payload,
+                            config=config
+                        ),
+                        timeout=timeout
+                    )
+                    chunk = await asyncio.wait_for(anext(stream), timeout=timeout)
+                started = True
+                while True:
+                    if chunk.usage_metadata is not None:
+                        metered = chunk
+                    yield chunk
+                    chunk = await asyncio.wait_for(anext(stream), timeout=timeout)
+        except StopAsyncIteration:
+            if usage is not None:
+                usage.append(LLMUsage.from_response(metered, model, access_token, began))
+            return
         except Exception as e:
-            error_str = str(e).lower()
-            is_rate_limit = any(x in error_str for x in ["429", "quota", "503", "overloaded"])
-            if is_rate_limit:
-                 cooldown = cooldown_seconds if "503" not in error_str else 2
-                 logger.warning(f"⚠️ Key #{i+1} Failed. Cooldown {cooldown}s.")
-                 await mark_key_failure(access_token, cooldown)
-                 continue 
+            if not started and await _on_failure(i, access_token, model, e):
+                continue
             raise e
-    raise Exception("All keys exhausted")
+        finally:
+            # Release the HTTP response if the consumer went away mid-stream
+            if stream is not None and hasattr(stream, "aclose"):
+                await stream.aclose()
+    raise LLMUnavailable(f"All keys exhausted for {model}")
+
+
+def _build_contents(system_prompt: str, chat_history: list, user_message: str, followup: list = None):
+    # Construct Messages
+    system_message = types.Content(role="system", parts=[types.Part.from_text(text=system_prompt)])
+    
+    formatted_history = []
+    for msg in chat_history:
+        formatted_history.append(types.Content(
+            role="model" if msg["role"] == "assistant" else "user",
+            parts=[types.Part.from_text(text=msg["content"])]
+        ))
+        
+    new_user_message = types.Content(role="user", parts=[types.Part.from_text(text=user_message)])
+    
+    # followup: tool-call turns and their results from this same reply
+    return [system_message] + formatted_history + [new_user_message] + list(followup or [])
 
 
 async def generate_response_core(
@@ -56,35 +268,50 @@ async def generate_response_core(
     user_message: str,
     tools: list,
     candidate_keys: list,
-    model: str = "gemini-3-flash-preview"
+    model: str = "gemini-3-flash-preview",
+    hedge: bool = None,
+    followup: list = None,
+    allow_tools: bool = True,
+    usage: list = None,
+    fallback_models: list = None
 ):
     """
     Pure Engine Function:
     Input: Context, Tools, Configuration
     Output: Reply Text, Intent, Metadata
+    `hedge` None means LLM_HEDGE_DEFAULT. `followup` holds earlier tool-call
+    turns of this reply; allow_tools=False forces a text answer. If `usage`
+    is a list, an LLMUsage for the successful call is appended to it.
+    If no key can serve `model`, the next model of the fallback chain
+    (`fallback_models`, default LLM_FALLBACK_MODELS) is tried.
     """
     
-    # Construct Messages
-    system_message = types.Content(role="system", parts=[types.Part.from_text(text=system_prompt)])
-    
-    formatted_history = []
-    for msg in chat_history:
-        formatted_history.append(types.Content(
-            role="model" if msg["role"] == "assistant" else "user",
-            parts=[types.Part.from_text(text=msg["content"])]
-        ))
-        
-    new_user_message = types.Content(role="user", parts=[types.Part.from_text(text=user_message)])
-    
-    full_contents = [system_message] + formatted_history + [new_user_message]
+    full_contents = _build_contents(system_prompt, chat_history, user_message, followup)
     
     reply_text = ""
     final_intent = None
     final_metadata = {}
     
     try:
-        # Turn 1
-        response = await _call_llm_safe_rotation(full_contents, tools, model, candidate_keys)
+        # Turn 1 (down the fallback chain if the model can't be served right now)
+        chain = _model_chain(model, fallback_models)
+        for n, current in enumerate(chain):
+            try:
+                response = await _call_llm_safe_rotation(
+                    full_contents, tools, current, candidate_keys,
+                    hedge=LLM_HEDGE_DEFAULT if hedge is None else hedge,
+                    allow_tools=allow_tools,
+                    usage=usage
+                )
+            except LLMUnavailable:
+                if n + 1 == len(chain):
+                    raise
+                metrics.incr("llm.fallback")
+                logger.warning(f"🪂 {current} unavailable, falling back to {chain[n + 1]}")
+                continue
+            if n:
+                metrics.incr("llm.fallback.served")
+            break
         
         executed_tool = False
         if response.candidates and response.candidates[0].content.parts:
@@ -119,3 +346,39 @@ async def generate_response_core(
     except Exception as e:
         logger.error(f"Engine Error: {e}")
         raise e
+
+
+async def generate_response_stream(
+    system_prompt: str,
+    chat_history: list,
+    user_message: str,
+    tools: list,
+    candidate_keys: list,
+    model: str = "gemini-3-flash-preview",
+    followup: list = None,
+    allow_tools: bool = True,
+    usage: list = None,
+    fallback_models: list = None
+):
+    """
+    Streaming Engine Function: same inputs as generate_response_core, yields
+    response chunks as Gemini produces them (text parts and/or function calls).
+    Falls back to the next model only before the first chunk went out.
+    """
+    full_contents = _build_contents(system_prompt, chat_history, user_message, followup)
+    chain = _model_chain(model, fallback_models)
+    for n, current in enumerate(chain):
+        try:
+            async for chunk in _stream_llm_safe_rotation(full_contents, tools, current, candidate_keys,
+                                                         allow_tools=allow_tools, usage=usage):
+                yield chunk
+        except LLMUnavailable:
+            # Raised only when no key produced a chunk, so nothing was sent yet
+            if n + 1 == len(chain):
+                raise
+            metrics.incr("llm.fallback")
+            logger.warning(f"🪂 {current} unavailable, falling back to {chain[n + 1]}")
+            continue
+        if n:
+            metrics.incr("llm.fallback.served")
+        return
@@ -0,0 +1,112 @@
+"""
+Classification of Gemini call failures.
+
+Replaces string-matching on str(e): google-genai raises APIError with the
+HTTP code, the google.rpc status and details (429 bodies carry a RetryInfo
+`retryDelay`); the HTTP response may also carry a Retry-After header. Other
+exceptions fall back to the old substring checks.
+
+Each kind says whether another key/model is worth trying, whether the
+failure belongs to the key alone (auth) or to the (key, model) pair (quota,
+overload), and how long its circuit breaker stays open.
+"""
+import os
+import re
+import asyncio
+from dataclasses import dataclass
+from google.genai import errors
+
+RATE_LIMIT = "rate_limit"            # 429 / RESOURCE_EXHAUSTED: this key's quota for this model
+OVERLOADED = "overloaded"            # 500/502/503/504: Gemini side, usually brief
+AUTH = "auth"                        # 401/403: the key itself is bad (revoked, no API enabled)
+MODEL_UNAVAILABLE = "model_unavailable"  # 404: model not served for this key/project
+TIMEOUT = "timeout"
+BAD_REQUEST = "bad_request"          # 400: our request is wrong, another key won't help
+UNKNOWN = "unknown"
+
+# Breaker backoff per kind: base * 2^(failures-1), capped. Retry-After wins if longer.
+LLM_BREAKER_MAX_SECONDS = float(os.getenv("LLM_BREAKER_MAX_SECONDS", "300"))
+_BACKOFF = {
+    RATE_LIMIT: (float(os.getenv("LLM_BREAKER_RATE_LIMIT_SECONDS", "15")), LLM_BREAKER_MAX_SECONDS),
+    OVERLOADED: (float(os.getenv("LLM_BREAKER_OVERLOAD_SECONDS", "2")), 60),
+    AUTH: (600, 3600),
+    MODEL_UNAVAILABLE: (600, 3600),
+}
+
+
+@dataclass
+class LLMError:
+    kind: str
+    status: int = None
+    retry_after: float = None
+
+    @property
+    def retryable(self) -> bool:
+        """Worth trying on another key (or model)."""
+        return self.kind in (RATE_LIMIT, OVERLOADED, AUTH, MODEL_UNAVAILABLE, TIMEOUT)
+
+    @property
+    def trips_breaker(self) -> bool:
+        # A slow answer is not a quota problem
+        return self.kind in _BACKOFF
+
+    @property
+    def key_wide(self) -> bool:
+        return self.kind == AUTH
+
+    def backoff(self, failures: int) -> float:
+        base, cap = _BACKOFF.get(self.kind, (0, 0))
+        seconds = min(base * 2 ** max(failures - 1, 0), cap)
+        return max(seconds, self.retry_after or 0)
+
+
+def _retry_after(e) -> float:
+    # Retry-After header (seconds form)
+    response = getattr(e, "response", None)
+    headers = getattr(response, "headers", None)
+    if headers:
+        value = headers.get("retry-after")
+        if value:
+            try:
+                return float(value)
+            except ValueError:
+                pass
+    # google.rpc.RetryInfo in the error details: {"retryDelay": "27s"}
+    details = getattr(e, "details", None)
+    if isinstance(details, dict):
+        for item in (details.get("error") or {}).get("details") or []:
+            delay = isinstance(item, dict) and item.get("retryDelay")
+            if delay:
+                match = re.match(r"([\d.]+)s$", str(delay))
+                if match:
+                    return float(match.group(1))
+    return None
+
+
+def classify(e: BaseException) -> LLMError:
+    if isinstance(e, asyncio.TimeoutError):
+        return LLMError(TIMEOUT)
+    if isinstance(e, errors.APIError):
+        code = e.code or 0
+        status = (e.status or "").upper()
+        if code == 429 or status == "RESOURCE_EXHAUSTED":
+            kind = RATE_LIMIT
+        elif code in (401, 403) or status in ("UNAUTHENTICATED", "PERMISSION_DENIED"):
+            kind = AUTH
+        elif code == 404 or status == "NOT_FOUND":
+            kind = MODEL_UNAVAILABLE
+        elif code >= 500 or status in ("UNAVAILABLE", "INTERNAL", "DEADLINE_EXCEEDED"):
+            kind = OVERLOADED
+        elif 400 <= code < 500:
+            kind = BAD_REQUEST
+        else:
+            kind = UNKNOWN
+        return LLMError(kind, code, _retry_after(e))
+
+    # Not from the SDK (tests, transport errors): best effort on the message
+    text = str(e).lower()
+    if "429" in text or "quota" in text or "resource exhausted" in text:
+        return LLMError(RATE_LIMIT)
+    if "503" in text or "overloaded" in text or "unavailable" in text:
+        return LLMError(OVERLOADED)
+    return LLMError(UNKNOWN)
@@ -0,0 +1,141 @@
+"""
+Per-conversation mailboxes: one user's messages are answered one turn at a time.
+
+WhatsApp users often send a burst ("Bonjou" / "mwen gen yon kesyon" / "konbyen
+li koute?"). Answered independently, the turns race on history and profile
+and cost one Gemini call each. Instead, each conversation gets a mailbox:
+
+  * a single task per mailbox processes messages in arrival order
+  * messages arriving within MAILBOX_DEBOUNCE_MS of the previous one (and
+    within MAILBOX_MAX_WAIT_MS of the first) are merged into one turn
+  * the reply goes to the caller(s) of the last message; earlier ones get
+    None, meaning "answered together with a later message"
+  * a retry of a message in the turn being answered joins that turn
+  * the mailbox is dropped as soon as it is empty, so idle ones cost nothing
+
+Mailboxes are per worker: RapidPro delivers one contact's messages in order to
+the same endpoint, and single-flight already covers retries across workers.
+"""
+import os
+import time
+import asyncio
+import logging
+from dataclasses import dataclass, field
+from app.core import metrics
+
+logger = logging.getLogger(__name__)
+
+MAILBOX_ENABLED = os.getenv("MAILBOX_ENABLED", "true").lower() == "true"
+MAILBOX_DEBOUNCE_MS = float(os.getenv("MAILBOX_DEBOUNCE_MS", "1000"))
+MAILBOX_MAX_WAIT_MS = float(os.getenv("MAILBOX_MAX_WAIT_MS", "3000"))
+MAILBOX_MAX_BATCH = int(os.getenv("MAILBOX_MAX_BATCH", "10"))
+
+
+@dataclass
+class _Letter:
+    text: str
+    handler: object  # async (merged_text) -> reply
+    future: asyncio.Future
+    arrived: float = field(default_factory=time.monotonic)
+
+
+class _Mailbox:
+    def __init__(self):
+        self.pending = []
+        self.task = None
+        self.in_flight = None  # (texts of the turn being answered, last text, reply future)
+
+
+class MailboxRouter:
+    def __init__(self):
+        self._boxes = {}  # conversation key -> _Mailbox
+
+    def __len__(self):
+        return len(self._boxes)
+
+    async def submit(self, key: str, text: str, handler):
+        """
+        Queues `text` for conversation `key`. `handler(merged_text)` produces the
+        reply (the last submitted handler is used for a merged turn). Returns the
+        reply, or None if the message was answered together with a later one.
+        """
+        if not MAILBOX_ENABLED:
+            return await handler(text)
+        metrics.incr("mailbox.messages")
+        box = self._boxes.get(key)
+        if box is None:
+            box = self._boxes[key] = _Mailbox()
+
+        if box.in_flight and text in box.in_flight[0]:
+            # Webhook retry of a message being answered right now
+            metrics.incr("mailbox.joined_in_flight")
+            _, last, reply = box.in_flight
+            return await asyncio.shield(reply) if text == last else None
+
+        letter = _Letter(text, handler, asyncio.get_running_loop().create_future())
+        box.pending.append(letter)
+        if box.task is None:
+            box.task = asyncio.create_task(self._run(key, box))
+        # The turn goes on even if this caller disconnects
+        return await asyncio.shield(letter.future)
+
+    async def _debounce(self, box: _Mailbox):
+        # Each arrival pushes the deadline back, up to MAILBOX_MAX_WAIT_MS after the first
+        while len(box.pending) < MAILBOX_MAX_BATCH:
+            deadline = min(box.pending[-1].arrived + MAILBOX_DEBOUNCE_MS / 1000,
+                           box.pending[0].arrived + MAILBOX_MAX_WAIT_MS / 1000)
+            delay = deadline - time.monotonic()
+            if delay <= 0:
+                return
+            await asyncio.sleep(delay)
+
+    async def _run(self, key: str, box: _Mailbox):
+        try:
+            while box.pending:
+                await self._debounce(box)
+                batch, box.pending = box.pending[:MAILBOX_MAX_BATCH], box.pending[MAILBOX_MAX_BATCH:]
+                await self._answer(box, batch)
+        finally:
+            box.task = None
+            if box.pending:
+                # Only on cancellation (shutdown): don't leave callers hanging
+                for letter in box.pending:
+                    if not letter.future.done():
+                        letter.future.cancel()
+            if self._boxes.get(key) is box:
+                del self._boxes[key]
+
+    async def _answer(self, box: _Mailbox, batch: list):
+        # Retries inside the burst collapse into one line
+        texts = list(dict.fromkeys(letter.text for letter in batch))
+        last = batch[-1]
+        reply = asyncio.get_running_loop().create_future()
+        box.in_flight = (set(texts), last.text, reply)
+        metrics.incr("mailbox.turns")
+        if len(batch) > 1:
+            metrics.incr("mailbox.merged", len(batch) - 1)  # LLM turns saved
+            logger.info(f"📬 Merged {len(batch)} messages into one turn")
+        try:
+            result = await last.handler("\n".join(texts))
+            reply.set_result(result)
+        except asyncio.CancelledError:
+            reply.cancel()
+            for letter in batch:
+                letter.future.cancel()
+            raise
+        except Exception as e:
+            reply.set_exception(e)
+            reply.exception()  # retrieved: joiners may be gone
+        finally:
+            box.in_flight = None
+        for letter in batch:
+            if letter.future.done():
+                continue
+            if reply.exception() is not None:
+                letter.future.set_exception(reply.exception())
+                letter.future.exception()  # same: the caller may have left
+            else:
+                letter.future.set_result(reply.result() if letter.text == last.text else None)
+
+
+chat_mailboxes = MailboxRouter()
@@ -0,0 +1,152 @@
+"""
+Single-flight: concurrent calls with the same key share one execution.
+
+Webhook senders (RapidPro, WuzAPI) retry when we are slow, so the same user
+message can arrive two or three times while the first reply is still being
+generated. Duplicates wait for the first call and get its result instead of
+calling Gemini again and writing history twice.
+
+  * In a worker: the first caller's work runs as a task, later callers await it.
+  * Across workers: the leader holds a Valkey lock (sf:lock:<key>, holding its
+    token) and hands its result over through sf:result:<key>:<token> plus a
+    publish on sf:done:<key>:<token>. A duplicate follows the token it found on
+    the lock, so it only ever gets the reply of a call that was still in flight
+    when it arrived: once the lock is gone, the same text is a new message
+    ("ok", "1") and gets its own reply. If the leader fails or dies, its lock
+    goes away without a result and a waiting duplicate takes over.
+
+If Valkey is down, coalescing is per worker only. Results must be JSON-serializable.
+"""
+import os
+import json
+import time
+import uuid
+import asyncio
+import logging
+from app.core import metrics
+from app.services import cache
+
+logger = logging.getLogger(__name__)
+
+SINGLEFLIGHT_ENABLED = os.getenv("SINGLEFLIGHT_ENABLED", "true").lower() == "true"
+# Must outlive the slowest reply (tool turns included), or a duplicate takes over
+SINGLEFLIGHT_LOCK_SECONDS = float(os.getenv("SINGLEFLIGHT_LOCK_SECONDS", "120"))
+SINGLEFLIGHT_WAIT_SECONDS = float(os.getenv("SINGLEFLIGHT_WAIT_SECONDS", "120"))
+# Only duplicates that joined the call while it ran can read the result
+SINGLEFLIGHT_RESULT_TTL = int(os.getenv("SINGLEFLIGHT_RESULT_TTL", "10"))
+
+# Takes the lock; returns nil if we got it, else the current leader's token
+_ACQUIRE = """
+local leader = redis.call('get', KEYS[1])
+if leader then return leader end
+redis.call('set', KEYS[1], ARGV[1], 'PX', ARGV[2])
+return false
+"""
+
+# Delete the lock only if it's still ours (it may have expired and been retaken)
+_RELEASE = """
+if redis.call('get', KEYS[1]) == ARGV[1] then return redis.call('del', KEYS[1]) end
+return 0
+"""
+
+_MISSING = object()
+
+
+class SingleFlight:
+    def __init__(self, namespace: str = "sf"):
+        self.namespace = namespace
+        self._calls = {}  # key -> asyncio.Task (this worker)
+
+    async def do(self, key: str, fn):
+        """Returns `await fn()`, shared with every concurrent caller using `key`."""
+        if not SINGLEFLIGHT_ENABLED:
+            return await fn()
+        task = self._calls.get(key)
+        if task is not None:
+            metrics.incr("singleflight.joined_local")
+        else:
+            # A task, so one caller disconnecting doesn't cancel the others' reply
+            task = asyncio.create_task(self._lead(key, fn))
+            self._calls[key] = task
+            task.add_done_callback(lambda t: self._done(key, t))
+        return await asyncio.shield(task)
+
+    def _done(self, key: str, task: asyncio.Task):
+        if self._calls.get(key) is task:
+            del self._calls[key]
+        if not task.cancelled():
+            task.exception()  # retrieved: no "never retrieved" warning if every caller left
+
+    def _keys(self, key: str, token: str):
+        """Lock, result and channel of the call led by `token`."""
+        return (f"{self.namespace}:lock:{key}", f"{self.namespace}:result:{key}:{token}",
+                f"{self.namespace}:done:{key}:{token}")
+
+    async def _lead(self, key: str, fn):
+        deadline = time.monotonic() + SINGLEFLIGHT_WAIT_SECONDS
+        token = uuid.uuid4().hex
+        lock_key, result_key, channel = self._keys(key, token)
+        while True:
+            try:
+                r = await cache.get_redis()
+                leader = await r.eval(_ACQUIRE, 1, lock_key, token, int(SINGLEFLIGHT_LOCK_SECONDS * 1000))
+            except Exception as e:
+                logger.warning(f"⚠️ Single-flight without Valkey: {e}")
+                return await fn()
+            if leader is None:
+                break
+            result = await self._follow(r, leader.decode(), *self._keys(key, leader.decode()), deadline)
+            if result is not _MISSING:
+                metrics.incr("singleflight.joined_remote")
+                return result
+            if time.monotonic() >= deadline:
+                # Waited long enough for someone else: answer this one ourselves
+                metrics.incr("singleflight.wait_timeout")
+                return await fn()
+            # Leader gone without a result: try to take over
+            metrics.incr("singleflight.takeover")
+
+        metrics.incr("singleflight.leader")
+        payload = None
+        try:
+            result = await fn()
+            payload = json.dumps(result)
+            return result
+        finally:
+            try:
+                if payload is not None:
+                    await r.setex(result_key, SINGLEFLIGHT_RESULT_TTL, payload)
+                await r.eval(_RELEASE, 1, lock_key, token)
+                # Wakes the duplicates; an empty message means "no result, one of you takes over"
+                await r.publish(channel, payload or "")
+            except Exception as e:
+                logger.warning(f"⚠️ Could not share single-flight result: {e}")  # the lock expires on its own
+
+    async def _follow(self, r, leader, lock_key, result_key, channel, deadline):
+        """Waits for `leader`'s result; _MISSING if its lock went away without one."""
+        pubsub = r.pubsub()
+        try:
+            await pubsub.subscribe(channel)
+            while time.monotonic() < deadline:
+                # Checked after subscribing, so a result can't slip between the two
+                value = await r.get(result_key)
+                if value is not None:
+                    return json.loads(value)
+                if await r.get(lock_key) != leader.encode():
+                    return _MISSING
+                message = await pubsub.get_message(ignore_subscribe_messages=True, timeout=1.0)
+                if message is not None:
+                    return json.loads(message["data"]) if message["data"] else _MISSING
+            return _MISSING
+        except Exception as e:
+            logger.warning(f"⚠️ Single-flight wait failed: {e}")
+            return _MISSING
+        finally:
+            try:
+                await pubsub.unsubscribe(channel)
+                await pubsub.aclose()
+            except Exception:
+                pass
+
+
+chat_flight = SingleFlight()
@@ -0,0 +1,132 @@
+"""
+Rolling per-user conversation summary, updated in the background.
+
+When a reply's history doesn't fit PROMPT_HISTORY_TOKENS, or the history fetch
+hit HISTORY_MAX_MESSAGES (so older turns exist), the manager calls
+summary_updater.request(user_id). A worker task then folds the messages that
+fell out of the window the manager sends (newest HISTORY_MAX_MESSAGES that fit
+the budget) and aren't summarized yet into chat_summaries, using the system key
+pool. The chat request never waits on it.
+
+To keep the extra Gemini calls down, a user is looked at most once per
+SUMMARY_MIN_INTERVAL_SECONDS and only summarized once SUMMARY_MIN_MESSAGES
+messages have fallen out of the window.
+"""
+import os
+import time
+import asyncio
+import logging
+from app.core import metrics
+from app.core.config import get_system_api_keys
+from app.database.repository import get_unsummarized_messages, save_summary
+from app.database.write_behind import usage_writer
+from app.services.llm_engine import generate_response_core
+from app.services.admission import admission, LOW
+from app.services.tokens import fit_history, history_budget, count_tokens, HISTORY_MAX_MESSAGES
+
+logger = logging.getLogger(__name__)
+
+SUMMARY_ENABLED = os.getenv("SUMMARY_ENABLED", "true").lower() == "true"
+SUMMARY_MODEL = os.getenv("SUMMARY_MODEL", "gemini-3-flash-preview")
+SUMMARY_MAX_TOKENS = int(os.getenv("SUMMARY_MAX_TOKENS", "300"))
+SUMMARY_MIN_MESSAGES = int(os.getenv("SUMMARY_MIN_MESSAGES", "6"))
+SUMMARY_MIN_INTERVAL_SECONDS = float(os.getenv("SUMMARY_MIN_INTERVAL_SECONDS", "60"))
+SUMMARY_FETCH_LIMIT = int(os.getenv("SUMMARY_FETCH_LIMIT", "100"))
+SUMMARY_QUEUE_MAX = int(os.getenv("SUMMARY_QUEUE_MAX", "1000"))
+
+SUMMARY_PROMPT = f"""
+You maintain a short running summary of a WhatsApp conversation between a user
+and an AI assistant, so the assistant can remember older turns.
+Merge the new messages into the existing summary. Keep facts, decisions, open
+questions, and what the user wants; drop greetings and small talk.
+Write in the language the user writes in. At most {SUMMARY_MAX_TOKENS} tokens.
+Reply with the updated summary only.
+"""
+
+
+class SummaryUpdater:
+    def __init__(self):
+        self._queue = None
+        self._queued = set()
+        self._last_checked = {}  # user_id -> monotonic time of the last look
+        self._task = None
+        self.running = False
+
+    async def start(self):
+        if self.running or not SUMMARY_ENABLED:
+            return
+        self._queue = asyncio.Queue(maxsize=SUMMARY_QUEUE_MAX)
+        self._task = asyncio.create_task(self._run())
+        self.running = True
+
+    async def stop(self):
+        if not self.running:
+            return
+        self.running = False
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        self._task = None
+
+    def request(self, user_id: str):
+        """Non-blocking: queues `user_id` unless it's queued or was looked at recently."""
+        if not self.running or user_id in self._queued:
+            return
+        now = time.monotonic()
+        if now - self._last_checked.get(user_id, -SUMMARY_MIN_INTERVAL_SECONDS) < SUMMARY_MIN_INTERVAL_SECONDS:
+            return
+        try:
+            self._queue.put_nowait(user_id)
+        except asyncio.QueueFull:
+            metrics.incr("summary.dropped")
+            return
+        self._queued.add(user_id)
+        self._last_checked[user_id] = now
+        if len(self._last_checked) > SUMMARY_QUEUE_MAX * 10:
+            cutoff = now - SUMMARY_MIN_INTERVAL_SECONDS
+            self._last_checked = {u: t for u, t in self._last_checked.items() if t > cutoff}
+
+    async def _run(self):
+        while True:
+            user_id = await self._queue.get()
+            self._queued.discard(user_id)
+            try:
+                await self.update(user_id)
+            except Exception as e:
+                metrics.incr("summary.error")
+                logger.warning(f"⚠️ Summary update failed for {user_id}: {e}")
+
+    async def update(self, user_id: str) -> bool:
+        """Folds unsummarized messages the manager no longer sends into the summary. True if it changed."""
+        summary, messages = await get_unsummarized_messages(user_id, SUMMARY_FETCH_LIMIT)
+        # Same window as the manager: short messages still fall out after HISTORY_MAX_MESSAGES
+        _, fold = fit_history(messages, history_budget(summary), max_messages=HISTORY_MAX_MESSAGES)
+        if len(fold) < SUMMARY_MIN_MESSAGES:
+            return False
+
+        transcript = "\n".join(f"{m['role']}: {m['content']}" for m in fold)
+        calls = []
+        # Background work: lowest class, and it can wait
+        async with admission.slot(LOW):
+            response = await generate_response_core(
+                SUMMARY_PROMPT,
+                [],
+                f"Existing summary:\n{summary or '(none)'}\n\nNew messages:\n{transcript}",
+                [],
+                get_system_api_keys(),
+                model=SUMMARY_MODEL,
+                usage=calls
+            )
+        await usage_writer.record(user_id, None, calls, kind="summary")
+        new_summary = (response.text or "").strip()
+        if not new_summary:
+            return False
+        await save_summary(user_id, new_summary, fold[-1]["created_at"])
+        metrics.incr("summary.updated")
+        logger.info(f"🧾 Summary for {user_id}: +{len(fold)} messages, {count_tokens(new_summary)} tokens")
+        return True
+
+
+summary_updater = SummaryUpdater()
@@ -0,0 +1,75 @@
+"""
+Token counting and the history budget.
+
+Counts with tiktoken (cl100k_base) when its encoding file is available; on
+offline boxes where it can't be downloaded we fall back to Gemini's rule of
+thumb (~4 characters per token). Neither is Gemini's exact tokenizer, but
+both are close enough to keep prompt size flat.
+"""
+import os
+import logging
+
+logger = logging.getLogger(__name__)
+
+TOKEN_ENCODING = os.getenv("TOKEN_ENCODING", "cl100k_base")
+# History (and its summary) must fit in this many tokens; older turns are summarized
+PROMPT_HISTORY_TOKENS = int(os.getenv("PROMPT_HISTORY_TOKENS", "1500"))
+# Messages fetched per request before the budget trims them (matches the Valkey ring)
+HISTORY_MAX_MESSAGES = int(os.getenv("HISTORY_MAX_MESSAGES", "20"))
+MESSAGE_OVERHEAD_TOKENS = 4  # role + separators
+
+_encoder = None
+_encoder_failed = False
+
+
+def warm():
+    """Loads the encoding (may download it once). Call at startup, off the event loop."""
+    _get_encoder()
+
+
+def _get_encoder():
+    global _encoder, _encoder_failed
+    if _encoder is None and not _encoder_failed:
+        try:
+            import tiktoken
+            _encoder = tiktoken.get_encoding(TOKEN_ENCODING)
+        except Exception as e:
+            _encoder_failed = True
+            logger.warning(f"⚠️ tiktoken encoding unavailable, estimating tokens from length: {e}")
+    return _encoder
+
+
+def count_tokens(text: str) -> int:
+    if not text:
+        return 0
+    encoder = _get_encoder()
+    if encoder is not None:
+        return len(encoder.encode(text, disallowed_special=()))
+    return (len(text) + 3) // 4
+
+
+def message_tokens(message: dict) -> int:
+    return count_tokens(message.get("content", "")) + MESSAGE_OVERHEAD_TOKENS
+
+
+def history_budget(summary: str = None) -> int:
+    """Tokens left for verbatim history once the summary is in."""
+    return max(PROMPT_HISTORY_TOKENS - count_tokens(summary), 0)
+
+
+def fit_history(history: list, budget: int, max_messages: int = None):
+    """
+    Keeps the newest messages that fit in `budget` tokens (and, if given, at
+    most `max_messages` of them), chronological order preserved.
+    Returns (kept, dropped) where dropped is the older remainder.
+    """
+    used = 0
+    start = len(history)
+    stop = max(len(history) - max_messages, 0) if max_messages is not None else 0
+    for i in range(len(history) - 1, stop - 1, -1):
+        cost = message_tokens(history[i])
+        if used + cost > budget:
+            break
+        used += cost
+        start = i
+    return history[start:], history[:start]
@@ -0,0 +1,134 @@
+"""
+get_history benchmark: flat chat_sessions (user_id index) vs the monthly
+partitioned layout with the (user_id, created_at DESC) keyset index.
+
+Builds both tables inside a scratch schema (bench_chat) of DATABASE_URL,
+loads the same skewed data set into each (a few heavy users own most rows,
+like our real WhatsApp traffic), then times the last-10 lookup.
+
+Usage:
+    python scripts/bench_chat_history.py --rows 10000000 --users 100000
+    python scripts/bench_chat_history.py --reuse      # skip loading
+    python scripts/bench_chat_history.py --drop       # remove bench_chat
+"""
+import argparse
+import asyncio
+import os
+import random
+import statistics
+import sys
+import time
+from datetime import date
+
+# Add parent dir to path
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import asyncpg
+from app.database.connection import DATABASE_URL
+from app.database.schema import create_chat_sessions_table, ensure_chat_partitions, _month_start
+
+SCHEMA = "bench_chat"
+
+LEGACY_QUERY = """
+    SELECT role, content FROM (
+        SELECT role, content, created_at FROM chat_sessions_flat
+        WHERE user_id = $1
+        ORDER BY created_at DESC
+        LIMIT $2
+    ) sub ORDER BY created_at ASC
+"""
+KEYSET_QUERY = """
+    SELECT role, content FROM chat_sessions
+    WHERE user_id = $1
+    ORDER BY created_at DESC
+    LIMIT $2
+"""
+
+
+async def load(conn, rows: int, users: int, months: int):
+    await conn.execute(f"DROP SCHEMA IF EXISTS {SCHEMA} CASCADE")
+    await conn.execute(f"CREATE SCHEMA {SCHEMA}")
+    await conn.execute(f"SET search_path TO {SCHEMA}")
+
+    await conn.execute("""
+        CREATE TABLE chat_sessions_flat (
+            user_id TEXT, role TEXT, content TEXT, created_at TIMESTAMP DEFAULT NOW()
+        )
+    """)
+    await create_chat_sessions_table(conn)
+    await ensure_chat_partitions(conn, since=_month_start(date.today(), -months))
+
+    # Skewed ownership: user index = users * random()^3 -> heavy head, long tail
+    print(f"📥 Loading {rows:,} rows into each table...")
+    t = time.perf_counter()
+    await conn.execute(f"""
+        CREATE UNLOGGED TABLE seed AS
+        SELECT 'u' || floor({users} * power(random(), 3))::int AS user_id,
+               CASE WHEN g % 2 = 0 THEN 'user' ELSE 'assistant' END AS role,
+               repeat('x', 40 + (g % 200)) AS content,
+               NOW() - random() * INTERVAL '{months * 30} days' AS created_at
+        FROM generate_series(1, {rows}) g
+    """)
+    await conn.execute("INSERT INTO chat_sessions_flat SELECT * FROM seed")
+    await conn.execute("CREATE INDEX idx_chat_user ON chat_sessions_flat(user_id)")
+    await conn.execute("INSERT INTO chat_sessions (user_id, role, content, created_at) SELECT * FROM seed")
+    await conn.execute("DROP TABLE seed")
+    await conn.execute("ANALYZE chat_sessions_flat")
+    await conn.execute("ANALYZE chat_sessions")
+    print(f"   ↳ done in {time.perf_counter() - t:.0f}s")
+
+
+async def timed(conn, query, user_ids, limit):
+    samples = []
+    for uid in user_ids:
+        t = time.perf_counter()
+        await conn.fetch(query, uid, limit)
+        samples.append((time.perf_counter() - t) * 1000)
+    samples.sort()
+    return statistics.median(samples), samples[int(len(samples) * 0.99) - 1]
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rows", type=int, default=10_000_000)
+    parser.add_argument("--users", type=int, default=100_000)
+    parser.add_argument("--months", type=int, default=12)
+    parser.add_argument("--lookups", type=int, default=500)
+    parser.add_argument("--limit", type=int, default=10)
+    parser.add_argument("--reuse", action="store_true", help="Reuse previously loaded data")
+    parser.add_argument("--drop", action="store_true", help="Drop the scratch schema and exit")
+    args = parser.parse_args()
+
+    conn = await asyncpg.connect(DATABASE_URL)
+    try:
+        if args.drop:
+            await conn.execute(f"DROP SCHEMA IF EXISTS {SCHEMA} CASCADE")
+            print(f"🗑️ {SCHEMA} dropped.")
+            return
+        if not args.reuse:
+            await load(conn, args.rows, args.users, args.months)
+        await conn.execute(f"SET search_path TO {SCHEMA}")
+
+        heavy = [r["user_id"] for r in await conn.fetch(
+            "SELECT user_id FROM chat_sessions_flat GROUP BY user_id ORDER BY count(*) DESC LIMIT 20"
+        )]
+        sample = [f"u{random.randrange(args.users)}" for _ in range(args.lookups)]
+
+        print(f"\n⏱️ last-{args.limit} lookups (ms)")
+        for label, users in (("random users", sample), ("heaviest 20 users", heavy * (args.lookups // 20))):
+            old_p50, old_p99 = await timed(conn, LEGACY_QUERY, users, args.limit)
+            new_p50, new_p99 = await timed(conn, KEYSET_QUERY, users, args.limit)
+            print(f"  {label:<18} flat p50={old_p50:.3f} p99={old_p99:.3f} | "
+                  f"partitioned p50={new_p50:.3f} p99={new_p99:.3f}")
+
+        for label, query in (("flat", LEGACY_QUERY), ("partitioned", KEYSET_QUERY)):
+            plan = await conn.fetch(f"EXPLAIN (ANALYZE, BUFFERS) {query}", heavy[0], args.limit)
+            print(f"\n📋 {label} plan for heaviest user:")
+            for line in plan[:8]:
+                print("   " + line[0])
+    finally:
+        await conn.close()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,134 @@
+"""
+Per-request latency with and without the genai.Client cache.
+
+Serves the fake Gemini from bench_llm_concurrency.py over HTTPS (self-signed
+cert, trusted through SSL_CERT_FILE) and sends the same requests through:
+  * "uncached": a new genai.Client per request, closed afterwards (pre-cache engine)
+  * "cached":   app.services.llm_engine._call_llm_safe_rotation (client_cache)
+
+Reports p50/p99 per request and how many TLS connections the server saw.
+
+Usage:
+    python scripts/bench_genai_client_cache.py --requests 300 --concurrency 4 --latency-ms 20
+"""
+import argparse
+import asyncio
+import datetime
+import gc
+import ipaddress
+import os
+import ssl
+import statistics
+import sys
+import tempfile
+import time
+
+# Add parent dir to path
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from bench_llm_concurrency import start_fake_gemini, build_messages
+
+
+def self_signed_cert(directory: str):
+    from cryptography import x509
+    from cryptography.hazmat.primitives import hashes, serialization
+    from cryptography.hazmat.primitives.asymmetric import ec
+    from cryptography.x509.oid import NameOID
+
+    key = ec.generate_private_key(ec.SECP256R1())
+    name = x509.Name([x509.NameAttribute(NameOID.COMMON_NAME, "127.0.0.1")])
+    now = datetime.datetime.now(datetime.timezone.utc)
+    cert = (
+        x509.CertificateBuilder()
+        .subject_name(name).issuer_name(name)
+        .public_key(key.public_key())
+        .serial_number(x509.random_serial_number())
+        .not_valid_before(now - datetime.timedelta(minutes=1))
+        .not_valid_after(now + datetime.timedelta(days=1))
+        .add_extension(x509.SubjectAlternativeName([x509.IPAddress(ipaddress.ip_address("127.0.0.1"))]), critical=False)
+        .add_extension(x509.BasicConstraints(ca=True, path_length=None), critical=True)
+        .sign(key, hashes.SHA256())
+    )
+    cert_path, key_path = os.path.join(directory, "cert.pem"), os.path.join(directory, "key.pem")
+    with open(cert_path, "wb") as f:
+        f.write(cert.public_bytes(serialization.Encoding.PEM))
+    with open(key_path, "wb") as f:
+        f.write(key.private_bytes(serialization.Encoding.PEM, serialization.PrivateFormat.PKCS8,
+                                  serialization.NoEncryption()))
+    return cert_path, key_path
+
+
+async def uncached_call(messages, model, key):
+    # The engine before the cache: build, call, close for every request
+    from google import genai
+    from google.genai import types
+    config = types.GenerateContentConfig(system_instruction=messages[0].parts[0].text)
+    client = await asyncio.to_thread(genai.Client, api_key=key)
+    try:
+        return await client.aio.models.generate_content(model=model, contents=messages[1:], config=config)
+    finally:
+        await client.aio.aclose()
+
+
+async def cached_call(messages, model, key):
+    from app.services.llm_engine import _call_llm_safe_rotation
+    return await _call_llm_safe_rotation(messages, None, model, [key])
+
+
+async def run(label, fn, total, concurrency, model, connections):
+    messages = build_messages()
+    sem = asyncio.Semaphore(concurrency)
+    samples = []
+
+    async def one():
+        async with sem:
+            t = time.perf_counter()
+            await fn(messages, model, "bench-key")
+            samples.append((time.perf_counter() - t) * 1000)
+
+    connections.clear()
+    await fn(messages, model, "bench-key")  # warm-up (imports, first client)
+    gc.collect()  # don't bill one mode for the other's garbage
+    start = time.perf_counter()
+    await asyncio.gather(*[one() for _ in range(total)])
+    elapsed = time.perf_counter() - start
+    samples.sort()
+    p50 = statistics.median(samples)
+    p99 = samples[max(int(len(samples) * 0.99) - 1, 0)]
+    print(f"{label:>9}: p50={p50:.1f}ms p99={p99:.1f}ms | {total / elapsed:.0f} req/s | "
+          f"{len(connections)} TLS connections")
+    return p50, p99
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--requests", type=int, default=300)
+    parser.add_argument("--concurrency", type=int, default=4)
+    parser.add_argument("--latency-ms", type=int, default=20)
+    parser.add_argument("--port", type=int, default=18443)
+    parser.add_argument("--model", default="gemini-3-flash-preview")
+    args = parser.parse_args()
+
+    tmp = tempfile.mkdtemp(prefix="bench_tls_")
+    cert_path, key_path = self_signed_cert(tmp)
+    server_ctx = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
+    server_ctx.load_cert_chain(cert_path, key_path)
+    os.environ["SSL_CERT_FILE"] = cert_path  # the SDK builds its client SSL context from this
+    os.environ["GOOGLE_GEMINI_BASE_URL"] = f"https://127.0.0.1:{args.port}"
+
+    connections = set()
+    server_loop = start_fake_gemini(args.port, args.latency_ms, ssl_context=server_ctx, connections=connections)
+    print(f"🧪 Fake Gemini (TLS) on :{args.port}, {args.latency_ms}ms per call, "
+          f"{args.requests} requests, concurrency {args.concurrency}")
+    try:
+        before = await run("uncached", uncached_call, args.requests, args.concurrency, args.model, connections)
+        after = await run("cached", cached_call, args.requests, args.concurrency, args.model, connections)
+        print(f"⚡ p50 {before[0] / after[0]:.1f}x, p99 {before[1] / after[1]:.1f}x faster")
+    finally:
+        from app.services.genai_clients import client_cache
+        await client_cache.close_all()
+        server_loop.call_soon_threadsafe(server_loop.stop)
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,123 @@
+"""
+Concurrent throughput benchmark for the LLM engine.
+
+Starts a local fake Gemini server (fixed latency per call) and fires N
+concurrent requests through:
+  * "before": the legacy path (sync client.models.generate_content inside an async def)
+  * "after":  app.services.llm_engine._call_llm_safe_rotation (client.aio)
+
+Usage:
+    python scripts/bench_llm_concurrency.py --requests 200 --latency-ms 500
+"""
+import argparse
+import asyncio
+import os
+import sys
+import time
+
+# Add parent dir to path
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from aiohttp import web
+
+FAKE_RESPONSE = {
+    "candidates": [{
+        "content": {"role": "model", "parts": [{"text": "pong"}]},
+        "finishReason": "STOP"
+    }],
+    "usageMetadata": {"promptTokenCount": 4, "candidatesTokenCount": 1, "totalTokenCount": 5}
+}
+
+
+def start_fake_gemini(port: int, latency_ms: int, ssl_context=None, connections: set = None):
+    """
+    Runs the fake server on its own thread + event loop, so the blocking
+    legacy client cannot starve it (that would deadlock the benchmark).
+    Pass an ssl_context to serve HTTPS; `connections` collects the transport of each
+    client connection (to count handshakes).
+    """
+    import threading
+
+    async def generate(request):
+        if connections is not None:
+            connections.add(request.transport)
+        await asyncio.sleep(latency_ms / 1000)
+        return web.json_response(FAKE_RESPONSE)
+
+    loop = asyncio.new_event_loop()
+    ready = threading.Event()
+
+    async def serve():
+        app = web.Application()
+        app.router.add_post("/{version}/models/{model}:generateContent", generate)
+        runner = web.AppRunner(app)
+        await runner.setup()
+        await web.TCPSite(runner, "127.0.0.1", port, ssl_context=ssl_context).start()
+        ready.set()
+
+    def target():
+        asyncio.set_event_loop(loop)
+        loop.run_until_complete(serve())
+        loop.run_forever()
+
+    threading.Thread(target=target, daemon=True).start()
+    ready.wait()
+    return loop
+
+
+def build_messages():
+    from google.genai import types
+    return [
+        types.Content(role="system", parts=[types.Part.from_text(text="You are a benchmark.")]),
+        types.Content(role="user", parts=[types.Part.from_text(text="ping")]),
+    ]
+
+
+async def legacy_call(messages, model, key):
+    # Reproduces the pre-async engine: a blocking SDK call inside a coroutine.
+    from google import genai
+    from google.genai import types
+    config = types.GenerateContentConfig(system_instruction=messages[0].parts[0].text)
+    client = genai.Client(api_key=key)
+    return client.models.generate_content(model=model, contents=messages[1:], config=config)
+
+
+async def async_call(messages, model, key):
+    from app.services.llm_engine import _call_llm_safe_rotation
+    return await _call_llm_safe_rotation(messages, None, model, [key])
+
+
+async def run(label, fn, total, model):
+    messages = build_messages()
+    start = time.perf_counter()
+    results = await asyncio.gather(*[fn(messages, model, "bench-key") for _ in range(total)], return_exceptions=True)
+    elapsed = time.perf_counter() - start
+    errors = sum(1 for r in results if isinstance(r, Exception))
+    print(f"{label:>7}: {total} requests in {elapsed:.2f}s -> {total / elapsed:.1f} req/s ({errors} errors)")
+    return elapsed
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--requests", type=int, default=100)
+    parser.add_argument("--latency-ms", type=int, default=200)
+    parser.add_argument("--port", type=int, default=18089)
+    parser.add_argument("--model", default="gemini-3-flash-preview")
+    parser.add_argument("--skip-legacy", action="store_true", help="Only run the async engine")
+    args = parser.parse_args()
+
+    os.environ["GOOGLE_GEMINI_BASE_URL"] = f"http://127.0.0.1:{args.port}"
+    server_loop = start_fake_gemini(args.port, args.latency_ms)
+    print(f"🧪 Fake Gemini on :{args.port} ({args.latency_ms}ms per call), {args.requests} concurrent requests")
+    try:
+        if not args.skip_legacy:
+            before = await run("before", legacy_call, args.requests, args.model)
+        after = await run("after", async_call, args.requests, args.model)
+        if not args.skip_legacy:
+            print(f"⚡ Speedup: {before / after:.1f}x")
+    finally:
+        server_loop.call_soon_threadsafe(server_loop.stop)
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
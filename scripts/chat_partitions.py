@@ -0,0 +1,138 @@
+"""
+chat_sessions partition management.
+
+    python scripts/chat_partitions.py migrate [--batch-days 7] [--drop-legacy]
+        Converts a flat (pre-v2.1) chat_sessions table into the monthly
+        partitioned layout while the service keeps running:
+          1. builds chat_sessions_new with partitions covering all existing data
+          2. backfills it in small per-window transactions (no long locks)
+          3. briefly blocks writers, copies the tail written during the
+             backfill, and swaps the table names in one transaction
+        The old table is kept as chat_sessions_legacy unless --drop-legacy.
+
+    python scripts/chat_partitions.py maintain [--detach-older-than MONTHS]
+        Pre-creates upcoming monthly partitions and optionally detaches
+        months older than the retention window. Run it from cron monthly.
+"""
+import argparse
+import asyncio
+import os
+import sys
+from datetime import timedelta
+
+# Add parent dir to path
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app.database.connection import get_db_connection
+from app.database.schema import (
+    is_partitioned, index_table, create_chat_sessions_table, ensure_chat_partitions, detach_old_chat_partitions
+)
+
+# Rows written this close to the backfill watermark are copied again under the
+# final lock, so an insert whose transaction straddled the watermark is not lost.
+WATERMARK_MARGIN = timedelta(minutes=1)
+
+
+async def migrate(conn, batch_days: int, drop_legacy: bool):
+    state = await is_partitioned(conn, "chat_sessions")
+    if state is None:
+        print("ℹ️ chat_sessions does not exist; init_db will create it partitioned.")
+        return
+    if state:
+        print("✅ chat_sessions is already partitioned.")
+        return
+
+    lo, hi = await conn.fetchrow("SELECT MIN(created_at), NOW()::timestamp FROM chat_sessions")
+    lo = lo or hi
+    watermark = hi - WATERMARK_MARGIN
+    print(f"📦 Legacy rows span {lo} -> {hi}")
+
+    # 1. New table, partitions named as their final names.
+    # The flat table's keyset index must not hold the new table's index name
+    # (migration v8 renames it; this covers a schema not migrated yet).
+    if await index_table(conn, "idx_chat_sessions_user_recent") == "chat_sessions":
+        await conn.execute(
+            "ALTER INDEX idx_chat_sessions_user_recent RENAME TO idx_chat_sessions_legacy_user_recent"
+        )
+    await create_chat_sessions_table(conn, table="chat_sessions_new", prefix="chat_sessions")
+    if await index_table(conn, "idx_chat_sessions_user_recent") != "chat_sessions_new":
+        print("❌ idx_chat_sessions_user_recent was not created on chat_sessions_new.")
+        sys.exit(1)
+    await ensure_chat_partitions(conn, table="chat_sessions_new", prefix="chat_sessions", since=lo.date())
+
+    # 2. Backfill in windows, each its own short transaction.
+    # Undated rows (created_at was nullable) land in the default partition.
+    status = await conn.execute("""
+        INSERT INTO chat_sessions_new (user_id, role, content, created_at)
+        SELECT user_id, role, content, 'epoch' FROM chat_sessions WHERE created_at IS NULL
+    """)
+    copied = int(status.split()[-1])
+    start = lo
+    while start < watermark:
+        end = min(start + timedelta(days=batch_days), watermark)
+        status = await conn.execute("""
+            INSERT INTO chat_sessions_new (user_id, role, content, created_at)
+            SELECT user_id, role, content, created_at FROM chat_sessions
+            WHERE created_at >= $1 AND created_at < $2
+            ORDER BY created_at
+        """, start, end)
+        copied += int(status.split()[-1])
+        print(f"   ↳ {start:%Y-%m-%d} .. {end:%Y-%m-%d}: {copied} rows copied")
+        start = end
+
+    # 3. Tail + swap. Readers are not blocked; writers wait for the duration of the copy of the tail.
+    async with conn.transaction():
+        await conn.execute("LOCK TABLE chat_sessions IN SHARE ROW EXCLUSIVE MODE")
+        status = await conn.execute("""
+            INSERT INTO chat_sessions_new (user_id, role, content, created_at)
+            SELECT user_id, role, content, created_at FROM chat_sessions
+            WHERE created_at >= $1
+            ORDER BY created_at
+        """, watermark)
+        print(f"   ↳ tail: {status.split()[-1]} rows")
+        await conn.execute("ALTER TABLE chat_sessions RENAME TO chat_sessions_legacy")
+        await conn.execute("ALTER INDEX IF EXISTS idx_chat_user RENAME TO idx_chat_legacy_user")
+        await conn.execute("ALTER TABLE chat_sessions_new RENAME TO chat_sessions")
+        await conn.execute("ALTER INDEX chat_sessions_new_pkey RENAME TO chat_sessions_pkey")
+        await conn.execute("ALTER SEQUENCE chat_sessions_new_id_seq RENAME TO chat_sessions_id_seq")
+
+    print("✅ chat_sessions is now partitioned (old data kept in chat_sessions_legacy).")
+    if drop_legacy:
+        await conn.execute("DROP TABLE chat_sessions_legacy")
+        print("🗑️ chat_sessions_legacy dropped.")
+
+
+async def maintain(conn, detach_older_than: int):
+    if not await is_partitioned(conn, "chat_sessions"):
+        print("❌ chat_sessions is not partitioned. Run 'migrate' first.")
+        sys.exit(1)
+    await ensure_chat_partitions(conn)
+    print("✅ Upcoming partitions ensured.")
+    if detach_older_than:
+        detached = await detach_old_chat_partitions(conn, detach_older_than)
+        for name in detached:
+            print(f"📤 Detached {name} (drop or archive it when ready)")
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    sub = parser.add_subparsers(dest="command", required=True)
+    m = sub.add_parser("migrate")
+    m.add_argument("--batch-days", type=int, default=7)
+    m.add_argument("--drop-legacy", action="store_true")
+    t = sub.add_parser("maintain")
+    t.add_argument("--detach-older-than", type=int, default=0, metavar="MONTHS")
+    args = parser.parse_args()
+
+    conn = await get_db_connection()
+    try:
+        if args.command == "migrate":
+            await migrate(conn, args.batch_days, args.drop_legacy)
+        else:
+            await maintain(conn, args.detach_older_than)
+    finally:
+        await conn.close()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
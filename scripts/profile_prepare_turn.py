@@ -0,0 +1,75 @@
+"""
+CPU cost of building one chat turn (persona, prompt, tools, cache key), without I/O.
+
+Runs app.personas.manager._prepare_turn N times with the conversation context
+(profile, token, history) served from memory, and reports CPU microseconds per
+request. --profile prints the top functions from cProfile.
+
+Usage:
+    python scripts/profile_prepare_turn.py --requests 20000
+    python scripts/profile_prepare_turn.py --requests 5000 --profile
+"""
+import argparse
+import asyncio
+import cProfile
+import os
+import pstats
+import sys
+import time
+from unittest.mock import patch
+
+# Add parent dir to path
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app.database.repository import ConversationContext
+
+PERSONA = {
+    "id": 1, "name": "Sarah", "owner_phone": None, "is_default": True, "allowed_tools": [],
+    "model_config": {"model": "gemini-3-flash-preview", "response_cache": {"ttl": 3600}},
+    "system_prompt": "You are Sarah, the AI Specialist at KonexPro.\n" * 20,
+}
+PROFILE = {"name": "Jean", "city": "Pòtoprens", "business": "Boulanjri", "plan": "basic",
+           "interests": ["WhatsApp", "peman", "MonCash"], "language": "kreyòl"}
+HISTORY = [{"role": "user" if i % 2 == 0 else "assistant", "content": f"Mesaj {i} " * 12} for i in range(20)]
+
+
+async def run(requests: int, profile: bool):
+    from app.personas import manager
+    from app.personas.registry import persona_registry
+
+    context = ConversationContext(profile=PROFILE, token=None, history=HISTORY, summary="Jean vle peye plan basic.")
+
+    async def load(*args, **kwargs):
+        return context
+
+    groups = ["Kreyol", "Premium"]
+    with patch.object(manager, "load_conversation_context", load), \
+         patch.object(persona_registry, "resolve", lambda *a, **k: PERSONA), \
+         patch.object(manager.summary_updater, "request", lambda *a: None):
+        for i in range(200):  # warm-up
+            await manager._prepare_turn("50912345678", "Konbyen plan an koute?", "tel:+50912345678", groups)
+        profiler = cProfile.Profile() if profile else None
+        if profiler:
+            profiler.enable()
+        started = time.process_time()
+        for i in range(requests):
+            await manager._prepare_turn("50912345678", f"Konbyen plan an koute? {i % 7}", "tel:+50912345678", groups)
+        cpu = time.process_time() - started
+        if profiler:
+            profiler.disable()
+
+    print(f"⚙️  {requests} turns: {cpu * 1e6 / requests:.1f} µs CPU per request")
+    if profiler:
+        pstats.Stats(profiler).sort_stats("cumulative").print_stats(15)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--requests", type=int, default=10000)
+    parser.add_argument("--profile", action="store_true")
+    args = parser.parse_args()
+    asyncio.run(run(args.requests, args.profile))
+
+
+if __name__ == "__main__":
+    main()
@@ -17,3 +17,32 @@ async def client():
         async with AsyncClient(transport=transport, base_url="http://test") as ac:
             yield ac
 
+
+@pytest.fixture(autouse=True)
+def no_history_cache():
+    # Unit tests must not share state through a Valkey that happens to be running
+    with patch("app.services.cache.HISTORY_CACHE_ENABLED", False):
+        yield
+
+
+@pytest.fixture(autouse=True)
+def fresh_client_cache():
+    # Tests patch genai.Client per test; a shared client cache would leak mocks between them
+    from app.services.genai_clients import ClientCache
+    with patch("app.services.llm_engine.client_cache", ClientCache()):
+        yield
+
+
+@pytest.fixture(autouse=True)
+def fresh_key_scheduler():
+    # Cooldowns marked by one test must not make the next one skip its keys
+    from app.services.key_scheduler import KeyScheduler
+    with patch("app.services.llm_engine.key_scheduler", KeyScheduler()):
+        yield
+
+
+@pytest.fixture(autouse=True)
+def no_singleflight():
+    # Like the history cache: a reply handed over through Valkey would answer the next test's "Hi"
+    with patch("app.services.singleflight.SINGLEFLIGHT_ENABLED", False):
+        yield
@@ -23,6 +23,18 @@ class FakeDatabaseService:
         self.chat_history[user_id].append({"role": role, "content": content})
         return True
         
+    async def load_conversation_context(self, user_id: str, phone_number: str, user_message: str = None,
+                                        history_limit: int = 10, persona_id: int = None):
+        from app.database.repository import ConversationContext
+        context = ConversationContext(
+            profile=dict(self.profiles.get(user_id, {})),
+            token=self.tokens.get(phone_number),
+            history=await self.get_history(user_id, history_limit),
+        )
+        if user_message is not None:
+            await self.save_message(user_id, "user", user_message)
+        return context
+
     async def get_profile(self, user_id: str):
         return self.profiles.get(user_id, {})
 
@@ -30,6 +42,13 @@ class FakeDatabaseService:
         if user_id not in self.profiles:
              self.profiles[user_id] = {}
         self.profiles[user_id].update(profile_data)
+
+    async def merge_profile(self, user_id: str, patch: dict, deep: bool = False, remove_keys: list = None):
+        profile = self.profiles.setdefault(user_id, {})
+        profile.update(patch)
+        for key in remove_keys or []:
+            profile.pop(key, None)
+        return dict(profile)
         
     async def record_payment(self, code, amount, currency, sender, raw_message):
         self.payments[code] = {
@@ -55,3 +74,38 @@ class FakeDatabaseService:
         
     async def check_health(self):
         return True
+
+def make_mock_genai_client(response=None, side_effect=None, stream_chunks=None):
+    """
+    Builds a MagicMock shaped like genai.Client whose async surface
+    (client.aio.models.generate_content) returns the given response.
+    generate_content_stream yields `stream_chunks` (or raises side_effect).
+    """
+    from unittest.mock import MagicMock, AsyncMock
+    client = MagicMock()
+    client.aio.models.generate_content = AsyncMock(return_value=response, side_effect=side_effect)
+
+    async def _stream():
+        for chunk in stream_chunks or []:
+            yield chunk
+
+    async def generate_content_stream(*args, **kwargs):
+        if side_effect is not None:
+            raise side_effect
+        return _stream()
+
+    client.aio.models.generate_content_stream = AsyncMock(side_effect=generate_content_stream)
+    client.aio.aclose = AsyncMock()
+    return client
+
+def fake_acquire(conn):
+    """
+    Stand-in for app.database.connection.acquire that always yields `conn`.
+    Usage: patch("app.database.repository.acquire", fake_acquire(conn_mock))
+    """
+    from contextlib import asynccontextmanager
+
+    @asynccontextmanager
+    async def _acquire():
+        yield conn
+    return _acquire
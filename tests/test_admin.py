@@ -3,6 +3,8 @@ import pytest
 from unittest.mock import AsyncMock, patch, MagicMock
 from app.personas.manager import process_chat_request
 from google.genai.types import GenerateContentResponse, Candidate, Content, Part, FunctionCall
+from tests.mocks import make_mock_genai_client
+from app.database.repository import ConversationContext
 
 def create_mock_response(text=None, tool_calls=None):
     parts = []
@@ -20,24 +22,22 @@ def create_mock_response(text=None, tool_calls=None):
 @pytest.mark.asyncio
 async def test_admin_recognition_di():
     # Patch dependencies
-    with patch("app.personas.manager.get_profile", return_value={}), \
-         patch("app.personas.manager.get_token", return_value=None), \
-         patch("app.personas.manager.get_history", return_value=[]), \
+    with patch("app.personas.manager.load_conversation_context", new_callable=AsyncMock, return_value=ConversationContext()), \
          patch("app.personas.manager.save_message", new_callable=AsyncMock), \
-         patch("app.personas.manager.save_profile", new_callable=AsyncMock), \
+         patch("app.personas.tools.merge_profile", new_callable=AsyncMock), \
          patch("app.personas.manager.get_api_keys", return_value=["AIzaMock"]), \
          patch("app.services.llm_engine.genai.Client") as MockClient:
          
          # Force Admin Env
          with patch.dict("os.environ", {"ADMIN_PHONES": "50912345678"}):
              
-             mock_instance = MockClient.return_value
-             mock_instance.models.generate_content.return_value = create_mock_response(text="Admin Hello")
+             mock_instance = make_mock_genai_client(create_mock_response(text="Admin Hello"))
+             MockClient.return_value = mock_instance
              
              await process_chat_request(None, "50912345678", "Hi", "whatsapp:509123456", [])
              
              # Assert System Prompt contained GOD MODE
-             call_args = mock_instance.models.generate_content.call_args
+             call_args = mock_instance.aio.models.generate_content.call_args
              # The first arg is 'contents' which includes system prompt usually?
              # No, using google-genai SDK, 'config' has system instruction
              # My generate_response_core extracts it from prompt logic
@@ -55,9 +55,7 @@ async def test_admin_recognition_di():
              
 @pytest.mark.asyncio
 async def test_admin_tool_execution():
-    with patch("app.personas.manager.get_profile", return_value={}), \
-         patch("app.personas.manager.get_token", return_value=None), \
-         patch("app.personas.manager.get_history", return_value=[]), \
+    with patch("app.personas.manager.load_conversation_context", new_callable=AsyncMock, return_value=ConversationContext()), \
          patch("app.personas.manager.save_message", new_callable=AsyncMock), \
          patch("app.services.llm_engine.genai.Client") as MockClient, \
          patch("app.personas.manager.get_api_keys", return_value=["AIzaMock"]), \
@@ -65,11 +63,18 @@ async def test_admin_tool_execution():
          
          with patch.dict("os.environ", {"ADMIN_PHONES": "50912345678"}):
              
-             mock_instance = MockClient.return_value
-             mock_instance.models.generate_content.return_value = create_mock_response(
-                 tool_calls=[{"name": "get_system_status", "args": {}}]
-             )
+             # Turn 1 asks for the tool, turn 2 answers from its result
+             client = make_mock_genai_client()
+             client.aio.models.generate_content.side_effect = [
+                 create_mock_response(tool_calls=[{"name": "get_system_status", "args": {}}]),
+                 create_mock_response(text="DB Status: OK")
+             ]
+             MockClient.return_value = client
              
              reply = await process_chat_request(None, "50912345678", "Status", "uid", [])
              
-             assert "DB Status: OK" in reply
+             assert reply == "DB Status: OK"
+             # The tool result went back to the model, not into the reply
+             tool_turn = client.aio.models.generate_content.call_args.kwargs["contents"][-1]
+             assert tool_turn.parts[0].function_response.name == "get_system_status"
+             assert tool_turn.parts[0].function_response.response["database"] == "OK"
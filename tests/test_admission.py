@@ -0,0 +1,177 @@
+import time
+import asyncio
+import pytest
+from unittest.mock import AsyncMock, patch
+from httpx import AsyncClient, ASGITransport
+from google.genai.types import GenerateContentResponse, Candidate, Content, Part
+from app.main import app
+from app.database.repository import ConversationContext
+from app.personas.manager import process_chat_request
+from app.core import metrics
+from app.services.admission import AdmissionController, Overloaded, priority_for, ADMISSION_BUSY_REPLY
+from tests.mocks import make_mock_genai_client
+
+WEIGHTS = {"premium": 6, "normal": 3, "low": 1}
+
+
+@pytest.fixture(autouse=True)
+def clean_metrics():
+    metrics.reset()
+    yield
+    metrics.reset()
+
+
+def test_priority_comes_from_groups():
+    assert priority_for(["Premium"]) == "premium"
+    assert priority_for(["Beta", "Kreyol"]) == "premium"
+    assert priority_for(["Kreyol"]) == "normal"
+    assert priority_for([], is_admin=True) == "premium"
+
+
+@pytest.mark.asyncio
+async def test_cap_and_premium_first():
+    controller = AdmissionController(limit=1, weights=WEIGHTS, deadlines={})
+    order = []
+
+    async def call(name, priority):
+        async with controller.slot(priority):
+            order.append(name)
+            await asyncio.sleep(0.01)
+
+    await controller.acquire("normal")  # the one slot is busy
+    tasks = [asyncio.create_task(call(n, p)) for n, p in
+             [("n1", "normal"), ("n2", "normal"), ("l1", "low"), ("p1", "premium")]]
+    await asyncio.sleep(0.01)
+    assert order == [] and controller.queued() == 4
+    controller.release()
+    await asyncio.gather(*tasks)
+
+    assert order[0] == "p1"
+    assert set(order) == {"n1", "n2", "l1", "p1"}
+    assert order.index("n1") < order.index("n2")  # FIFO within a class
+    assert controller.active == 0 and controller.queued() == 0
+
+
+@pytest.mark.asyncio
+async def test_shed_instead_of_waiting_past_the_deadline():
+    controller = AdmissionController(limit=1, weights=WEIGHTS, deadlines={"normal": 0.05})
+    await controller.acquire("premium")
+
+    # Expected wait already too long: refused without queueing
+    controller._hold = 10
+    with pytest.raises(Overloaded) as shed:
+        await controller.acquire("normal", controller.deadline("normal"))
+    assert shed.value.retry_after >= 1
+
+    # Looked fine, but the slot never freed up in time
+    controller._hold = 0.001
+    started = time.monotonic()
+    with pytest.raises(Overloaded):
+        await controller.acquire("normal", controller.deadline("normal"))
+    assert time.monotonic() - started < 0.5
+    assert controller.queued() == 0
+    assert metrics.get("admission.shed.normal") == 2
+
+
+@pytest.mark.asyncio
+async def test_routers_answer_fast_when_overloaded():
+    async with AsyncClient(transport=ASGITransport(app=app), base_url="http://test") as ac:
+        with patch("app.routers.webhooks.submit_chat_message", new_callable=AsyncMock,
+                   side_effect=Overloaded("normal", 3)):
+            chat = await ac.post("/chat", json={"text": "Hi", "user": "tel:+50912345678"})
+        with patch("app.routers.openai_compat.process_chat_request", new_callable=AsyncMock,
+                   side_effect=Overloaded("normal", 3)):
+            completion = await ac.post("/v1/chat/completions", json={"messages": [{"role": "user", "content": "Hi"}]})
+
+    assert chat.json() == {"text": ADMISSION_BUSY_REPLY, "intent": "BUSY"}
+    assert completion.status_code == 429
+    assert completion.headers["Retry-After"] == "3"
+
+
+@pytest.mark.asyncio
+async def test_shed_turn_leaves_no_user_message_behind():
+    controller = AdmissionController(limit=1, weights=WEIGHTS, deadlines={"normal": 0.05})
+    await controller.acquire("premium")  # the one slot is busy
+    controller._hold = 10
+    with patch("app.personas.manager.admission", controller), \
+         patch("app.personas.manager.load_conversation_context", new_callable=AsyncMock) as mock_load, \
+         patch("app.personas.manager.save_message", new_callable=AsyncMock) as mock_save:
+        with pytest.raises(Overloaded):
+            await process_chat_request(None, "509", "Hi", "user_1", ["Kreyol"])
+
+    # Shed before the message was persisted (no orphan user turn, no DB round trip)
+    mock_load.assert_not_awaited()
+    mock_save.assert_not_awaited()
+    assert controller.active == 1
+
+
+@pytest.mark.asyncio
+async def test_reserved_slot_is_used_by_the_first_call():
+    controller = AdmissionController(limit=1, weights=WEIGHTS, deadlines={"normal": 0.05})
+    client = make_mock_genai_client(GenerateContentResponse(
+        candidates=[Candidate(content=Content(parts=[Part(text="Bonjou")]))]
+    ))
+    with patch("app.personas.manager.admission", controller), \
+         patch("app.personas.manager.load_conversation_context", new_callable=AsyncMock,
+               return_value=ConversationContext()), \
+         patch("app.personas.manager.save_message", new_callable=AsyncMock), \
+         patch("app.personas.manager.get_api_keys", return_value=["AIzaMock"]), \
+         patch("app.services.llm_engine.genai.Client", return_value=client):
+        assert await process_chat_request(None, "509", "Hi", "user_1", []) == "Bonjou"
+
+    assert controller.active == 0
+    assert metrics.get("admission.admitted.normal") == 1
+
+
+@pytest.mark.asyncio
+async def test_stream_frees_its_slot_when_gemini_is_done_not_the_client():
+    from app.personas.manager import stream_chat_request
+    controller = AdmissionController(limit=1, weights=WEIGHTS, deadlines={"normal": 0.05})
+    chunks = [GenerateContentResponse(candidates=[Candidate(content=Content(parts=[Part(text=t)]))])
+              for t in ("Bon", "jou")]
+    with patch("app.personas.manager.admission", controller), \
+         patch("app.personas.manager.load_conversation_context", new_callable=AsyncMock,
+               return_value=ConversationContext()), \
+         patch("app.personas.manager.save_message", new_callable=AsyncMock), \
+         patch("app.personas.manager.get_api_keys", return_value=["AIzaMock"]), \
+         patch("app.services.llm_engine.genai.Client", return_value=make_mock_genai_client(stream_chunks=chunks)):
+        stream = stream_chat_request(None, "509", "Hi", "user_1", [])
+        assert await anext(stream) == "Bon"
+        # The client hasn't read the rest yet, but Gemini is done: the slot is free
+        await asyncio.sleep(0.01)
+        assert controller.active == 0
+        assert [p async for p in stream] == ["jou"]
+
+
+@pytest.mark.asyncio
+async def test_shed_stream_gets_429_before_any_byte():
+    with patch("app.routers.openai_compat.reserve_chat_turn", new_callable=AsyncMock,
+               side_effect=Overloaded("normal", 3)), \
+         patch("app.routers.openai_compat.stream_chat_request") as mock_stream:
+        async with AsyncClient(transport=ASGITransport(app=app), base_url="http://test") as ac:
+            response = await ac.post("/v1/chat/completions", json={
+                "messages": [{"role": "user", "content": "Hi"}], "user": "tel:+509", "stream": True
+            })
+
+    assert response.status_code == 429
+    assert response.headers["retry-after"] == "3"
+    mock_stream.assert_not_called()
+
+
+@pytest.mark.asyncio
+async def test_stream_response_releases_its_reservation():
+    controller = AdmissionController(limit=1, weights=WEIGHTS, deadlines={"normal": 0.05})
+
+    async def fake_stream(*args, reservation=None, **kwargs):
+        assert controller.active == 1  # taken before the 200
+        yield "Bonjou"
+
+    with patch("app.personas.manager.admission", controller), \
+         patch("app.routers.openai_compat.stream_chat_request", side_effect=fake_stream):
+        async with AsyncClient(transport=ASGITransport(app=app), base_url="http://test") as ac:
+            response = await ac.post("/v1/chat/completions", json={
+                "messages": [{"role": "user", "content": "Hi"}], "user": "tel:+509", "stream": True
+            })
+
+    assert response.status_code == 200 and "Bonjou" in response.text
+    assert controller.active == 0
@@ -0,0 +1,158 @@
+import json
+import pytest
+from unittest.mock import AsyncMock, patch
+from httpx import AsyncClient, ASGITransport
+from app.main import app
+from app.core.ratelimit import TokenBucket
+from app.database.repository import ConversationContext
+from app.services import llm_errors
+from app.services.admission import Overloaded, LOW
+from app.services.broadcast import BroadcastItem, _run_item, BROADCAST_KEY_RPM
+from app.services.key_scheduler import KeyScheduler
+from app.services.llm_engine import LLMUnavailable
+
+HEADERS = {"X-Broadcast-Secret": "s3cret"}
+JOB = {
+    "job_id": "promo-1",
+    "items": [
+        {"user": "tel:+50911111111", "text": "Nouvo pwomosyon!"},
+        {"user": "tel:+50922222222", "text": "Nouvo pwomosyon!"},
+        {"user": "tel:+50933333333", "text": "Nouvo pwomosyon!"},
+    ]
+}
+
+
+def _lines(response):
+    return [json.loads(line) for line in response.text.splitlines()]
+
+
+@pytest.fixture
+def broadcast_env():
+    with patch.dict("os.environ", {"BROADCAST_SECRET": "s3cret", "GOOGLE_API_KEY": "k1,k2"}), \
+         patch("app.services.broadcast.save_broadcast_result", new_callable=AsyncMock) as save:
+        yield save
+
+
+@pytest.mark.asyncio
+async def test_broadcast_streams_ndjson_and_resumes(broadcast_env):
+    # Item 0 finished in an earlier run of the same job
+    done = {0: {"item_index": 0, "user_urn": "tel:+50911111111", "status": "ok", "reply": "Mèsi!",
+                "error": None, "attempts": 1}}
+
+    async def reply(db, phone, text, urn, groups, persona_id=None, priority=None, save_user_message=True):
+        return f"Bonjou {phone}"
+
+    with patch("app.services.broadcast.get_broadcast_results", new_callable=AsyncMock, return_value=done), \
+         patch("app.services.broadcast.process_chat_request", side_effect=reply) as process:
+        async with AsyncClient(transport=ASGITransport(app=app), base_url="http://test") as ac:
+            response = await ac.post("/v1/broadcasts", json=JOB, headers=HEADERS)
+
+    assert response.headers["content-type"].startswith("application/x-ndjson")
+    lines = _lines(response)
+    assert lines[0] == {"index": 0, "user": "tel:+50911111111", "status": "ok", "text": "Mèsi!", "resumed": True}
+    assert sorted(l["text"] for l in lines[1:3]) == ["Bonjou +50922222222", "Bonjou +50933333333"]
+    assert lines[-1] == {"job_id": "promo-1", "done": True, "total": 3, "ok": 3, "failed": 0}
+    # Only the unfinished items hit the pipeline, as background work
+    assert process.call_count == 2
+    assert all(c.kwargs["priority"] == LOW for c in process.call_args_list)
+    assert broadcast_env.await_count == 2
+
+
+@pytest.mark.asyncio
+async def test_shed_items_are_retried(broadcast_env):
+    job = {"job_id": "promo-2", "items": JOB["items"][:1]}
+    with patch("app.services.broadcast.get_broadcast_results", new_callable=AsyncMock, return_value={}), \
+         patch("app.services.broadcast.process_chat_request", new_callable=AsyncMock,
+               side_effect=[Overloaded(LOW, 0), "Bonjou"]):
+        async with AsyncClient(transport=ASGITransport(app=app), base_url="http://test") as ac:
+            lines = _lines(await ac.post("/v1/broadcasts", json=job, headers=HEADERS))
+
+    assert lines[0]["status"] == "ok" and lines[0]["text"] == "Bonjou"
+    assert broadcast_env.await_args.kwargs["attempts"] == 2
+
+
+@pytest.mark.asyncio
+async def test_broadcast_needs_the_secret():
+    async with AsyncClient(transport=ASGITransport(app=app), base_url="http://test") as ac:
+        with patch.dict("os.environ", {"BROADCAST_SECRET": "s3cret"}):
+            wrong = await ac.post("/v1/broadcasts", json=JOB, headers={"X-Broadcast-Secret": "nope"})
+        with patch.dict("os.environ", {"BROADCAST_SECRET": ""}):
+            unset = await ac.post("/v1/broadcasts", json=JOB, headers={"X-Broadcast-Secret": ""})
+    assert wrong.status_code == unset.status_code == 403
+
+
+@pytest.mark.asyncio
+async def test_pace_follows_per_model_breakers(broadcast_env):
+    scheduler = KeyScheduler()
+    pace = TokenBucket(100, burst=10)
+    item = BroadcastItem(0, "tel:+50911111111", "Nouvo pwomosyon!")
+    with patch("app.services.broadcast.key_scheduler", scheduler), \
+         patch("app.services.cache.mark_key_failure", new_callable=AsyncMock), \
+         patch("app.services.broadcast.process_chat_request", new_callable=AsyncMock, return_value="Bonjou"):
+        await _run_item("promo-3", item, None, [], pace, ["k1", "k2"], ["gemini-x", "gemini-y"])
+        assert pace.rate == 2 * BROADCAST_KEY_RPM / 60
+
+        # A 429 on one model of the chain: the key still serves the fallback
+        await scheduler.trip("k1", "gemini-x", llm_errors.LLMError(llm_errors.RATE_LIMIT))
+        await _run_item("promo-3", item, None, [], pace, ["k1", "k2"], ["gemini-x", "gemini-y"])
+        assert pace.rate == 2 * BROADCAST_KEY_RPM / 60
+
+        # Both models rate-limited on k1: the job slows down to one key
+        await scheduler.trip("k1", "gemini-y", llm_errors.LLMError(llm_errors.RATE_LIMIT))
+        assert scheduler.is_ready("k1")  # no key-wide breaker
+        await _run_item("promo-3", item, None, [], pace, ["k1", "k2"], ["gemini-x", "gemini-y"])
+        assert pace.rate == BROADCAST_KEY_RPM / 60
+
+
+@pytest.mark.asyncio
+async def test_retry_does_not_save_the_campaign_text_twice(broadcast_env):
+    item = BroadcastItem(0, "tel:+50911111111", "Nouvo pwomosyon!")
+    with patch("app.services.broadcast.process_chat_request", new_callable=AsyncMock,
+               side_effect=[Overloaded(LOW, 0), LLMUnavailable("all keys down"), "Bonjou"]) as process, \
+         patch("app.services.broadcast.BROADCAST_RETRY_SECONDS", 0):
+        result = await _run_item("promo-4", item, None, [], TokenBucket(100, burst=10), ["k1"], ["gemini-x"])
+
+    assert result["status"] == "ok"
+    # Shed attempts saved nothing; after the failed Gemini attempt the message is in history
+    assert [c.kwargs["save_user_message"] for c in process.call_args_list] == [True, True, False]
+
+
+@pytest.mark.asyncio
+async def test_resumed_job_remembers_the_text_is_saved(broadcast_env):
+    item = BroadcastItem(0, "tel:+50911111111", "Nouvo pwomosyon!")
+    with patch("app.services.broadcast.process_chat_request", new_callable=AsyncMock,
+               side_effect=LLMUnavailable("all keys down")), \
+         patch("app.services.broadcast.BROADCAST_RETRY_SECONDS", 0), \
+         patch("app.services.broadcast.BROADCAST_MAX_ATTEMPTS", 1):
+        result = await _run_item("promo-5", item, None, [], TokenBucket(100, burst=10), ["k1"], ["gemini-x"])
+    assert result["status"] == "failed"
+    assert broadcast_env.await_args.kwargs["user_message_saved"] is True
+
+    # The job is POSTed again: the failed item is retried without saving its text twice
+    done = {0: {"item_index": 0, "user_urn": "tel:+50911111111", "status": "failed", "reply": None,
+                "error": "all keys down", "attempts": 1, "user_message_saved": True}}
+    job = {"job_id": "promo-5", "items": JOB["items"][:2]}
+    with patch("app.services.broadcast.get_broadcast_results", new_callable=AsyncMock, return_value=done), \
+         patch("app.services.broadcast.process_chat_request", new_callable=AsyncMock,
+               return_value="Bonjou") as process:
+        async with AsyncClient(transport=ASGITransport(app=app), base_url="http://test") as ac:
+            lines = _lines(await ac.post("/v1/broadcasts", json=job, headers=HEADERS))
+
+    assert lines[-1]["ok"] == 2
+    assert sorted((c.args[3], c.kwargs["save_user_message"]) for c in process.call_args_list) == [
+        ("tel:+50911111111", False), ("tel:+50922222222", True)
+    ]
+
+
+@pytest.mark.asyncio
+async def test_retried_turn_keeps_the_saved_message_out_of_history():
+    from app.personas.manager import _prepare_turn
+    saved = ConversationContext(history=[{"role": "assistant", "content": "Alo"},
+                                         {"role": "user", "content": "Nouvo pwomosyon!"}])
+    with patch("app.personas.manager.load_conversation_context", new_callable=AsyncMock,
+               return_value=saved) as load, \
+         patch("app.personas.manager.get_api_keys", return_value=["k1"]):
+        turn = await _prepare_turn("509", "Nouvo pwomosyon!", "tel:+509", [], save_user_message=False)
+
+    assert load.await_args.kwargs["user_message"] is None
+    assert turn.history == [{"role": "assistant", "content": "Alo"}]
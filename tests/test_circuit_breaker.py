@@ -0,0 +1,112 @@
+import pytest
+from unittest.mock import AsyncMock, patch
+from google.genai import errors
+from google.genai.types import GenerateContentResponse, Candidate, Content, Part
+from app.core import metrics
+from app.services import llm_errors
+from app.services.key_scheduler import KeyScheduler
+from app.services.llm_engine import generate_response_core, LLMUnavailable
+from tests.mocks import make_mock_genai_client
+
+
+def _quota_error(retry_delay="27s"):
+    return errors.APIError(429, {"error": {
+        "code": 429, "status": "RESOURCE_EXHAUSTED", "message": "Quota exceeded",
+        "details": [{"@type": "type.googleapis.com/google.rpc.RetryInfo", "retryDelay": retry_delay}]
+    }})
+
+
+def _client(model_replies):
+    """model_replies: model -> reply text, or an exception to raise."""
+    async def answer(model, **kwargs):
+        reply = model_replies[model]
+        if isinstance(reply, Exception):
+            raise reply
+        return GenerateContentResponse(candidates=[Candidate(content=Content(parts=[Part(text=reply)]))])
+    client = make_mock_genai_client()
+    client.aio.models.generate_content = AsyncMock(side_effect=answer)
+    return client
+
+
+@pytest.fixture
+def scheduler():
+    metrics.reset()
+    fresh = KeyScheduler()
+    with patch("app.services.llm_engine.key_scheduler", fresh), \
+         patch("app.services.cache.mark_key_failure", new_callable=AsyncMock), \
+         patch("app.services.cache.get_redis", new_callable=AsyncMock):
+        yield fresh
+    metrics.reset()
+
+
+def test_classify_api_errors():
+    quota = llm_errors.classify(_quota_error())
+    assert quota.kind == llm_errors.RATE_LIMIT and quota.retryable
+    assert quota.retry_after == 27
+    # RetryInfo wins over a shorter backoff, backoff wins once it's longer
+    assert quota.backoff(1) == 27
+    assert quota.backoff(3) == 60
+
+    assert llm_errors.classify(errors.APIError(403, {"error": {"status": "PERMISSION_DENIED"}})).key_wide
+    assert llm_errors.classify(errors.APIError(503, {"error": {"status": "UNAVAILABLE"}})).kind == llm_errors.OVERLOADED
+    bad = llm_errors.classify(errors.APIError(400, {"error": {"status": "INVALID_ARGUMENT"}}))
+    assert not bad.retryable and not bad.trips_breaker
+    # Non-SDK errors still get the old substring treatment
+    assert llm_errors.classify(Exception("429 Quota exceeded")).kind == llm_errors.RATE_LIMIT
+
+
+@pytest.mark.asyncio
+async def test_breaker_open_half_open_closed(scheduler):
+    error = llm_errors.LLMError(llm_errors.RATE_LIMIT)
+    assert scheduler.state("cbKey", "m") == "closed"
+
+    first = await scheduler.trip("cbKey", "m", error)
+    assert scheduler.state("cbKey", "m") == "open"
+    # Per model: the same key still serves another model
+    assert scheduler.state("cbKey", "other") == "closed"
+    assert await scheduler.trip("cbKey", "m", error) == first * 2
+
+    # Time's up: half-open, one probe at a time
+    scheduler._ready_at.clear()
+    assert scheduler.state("cbKey", "m") == "half_open"
+    with scheduler.track("cbKey", "m"):
+        assert scheduler.order(["cbKey"], "m") == []  # the probe is the only call let through
+        assert not scheduler.is_ready("cbKey", "m")
+    assert scheduler.state("cbKey", "m") == "closed"
+
+    # The probe succeeded, so the next failure starts the backoff over
+    assert await scheduler.trip("cbKey", "m", error) == first
+
+
+@pytest.mark.asyncio
+async def test_falls_back_when_primary_model_is_exhausted(scheduler):
+    clients = {
+        "cbFall1": _client({"pro": _quota_error("5s"), "flash": "from flash"}),
+        "cbFall2": _client({"pro": _quota_error("5s"), "flash": "from flash"}),
+    }
+    with patch("app.services.llm_engine.genai.Client", side_effect=lambda api_key: clients[api_key]):
+        response = await generate_response_core(
+            "System", [], "Hi", [], ["cbFall1", "cbFall2"], model="pro", fallback_models=["flash"]
+        )
+        assert response.text == "from flash"
+        assert metrics.get("llm.error.rate_limit") == 2
+        assert metrics.get("llm.fallback") == 1
+        assert metrics.get("llm.fallback.served") == 1
+        assert scheduler.state("cbFall1", "pro") == "open"
+        assert scheduler.state("cbFall1", "flash") == "closed"
+
+        # Every pro breaker is open: straight to flash, no call through them
+        response = await generate_response_core(
+            "System", [], "Hi", [], ["cbFall1", "cbFall2"], model="pro", fallback_models=["flash"]
+        )
+        assert response.text == "from flash"
+        pro_calls = [c for client in clients.values()
+                     for c in client.aio.models.generate_content.await_args_list if c.kwargs["model"] == "pro"]
+        assert len(pro_calls) == 2
+        assert metrics.get("llm.error.rate_limit") == 2
+
+        # No fallback configured: the caller sees LLMUnavailable
+        with pytest.raises(LLMUnavailable):
+            await generate_response_core(
+                "System", [], "Hi", [], ["cbFall1", "cbFall2"], model="pro", fallback_models=[]
+            )
@@ -0,0 +1,65 @@
+import pytest
+import time
+from unittest.mock import AsyncMock, MagicMock, patch
+from app.database import connection
+
+
+def make_conn(pid, ping_error=None):
+    conn = MagicMock()
+    conn.get_server_pid.return_value = pid
+    conn.is_closed.return_value = False
+    conn.execute = AsyncMock(side_effect=ping_error)
+    return conn
+
+
+@pytest.mark.asyncio
+async def test_acquire_reuses_pool_without_ping():
+    """Recently used connections are handed out without an extra round trip"""
+    conn = make_conn(101)
+    pool = MagicMock()
+    pool.acquire = AsyncMock(return_value=conn)
+    pool.release = AsyncMock()
+    
+    with patch.object(connection, "_pool", pool), patch.dict(connection._last_used, {connection._raw(conn): time.monotonic()}):
+        async with connection.acquire() as c:
+            assert c is conn
+        
+        conn.execute.assert_not_called()
+        pool.release.assert_awaited_once_with(conn)
+
+
+@pytest.mark.asyncio
+async def test_acquire_replaces_dead_idle_connection():
+    """An idle connection that fails its ping is terminated and swapped for a fresh one"""
+    dead = make_conn(201, ping_error=ConnectionResetError("gone"))
+    fresh = make_conn(202)
+    pool = MagicMock()
+    pool.acquire = AsyncMock(side_effect=[dead, fresh])
+    pool.release = AsyncMock()
+    
+    stale = time.monotonic() - connection.DB_POOL_PING_AFTER_SECONDS - 1
+    with patch.object(connection, "_pool", pool), patch.dict(connection._last_used, {connection._raw(dead): stale}):
+        async with connection.acquire() as c:
+            assert c is fresh
+        
+        dead.terminate.assert_called_once()
+        assert pool.release.await_count == 2
+
+
+@pytest.mark.asyncio
+async def test_last_used_goes_away_with_the_connection():
+    """Retired connections don't leave timestamps behind (nor hand them to a recycled pid)"""
+    import gc
+    conn = make_conn(301)
+    pool = MagicMock()
+    pool.acquire = AsyncMock(return_value=conn)
+    pool.release = AsyncMock()
+
+    with patch.object(connection, "_pool", pool):
+        async with connection.acquire():
+            pass
+        assert connection._raw(conn) in connection._last_used
+    before = len(connection._last_used)
+    del conn, pool
+    gc.collect()
+    assert len(connection._last_used) == before - 1
@@ -0,0 +1,82 @@
+import pytest
+from unittest.mock import AsyncMock, patch
+from google.genai import types
+from app.core import metrics
+from app.services.fake_llm import FakeBackend, FakeProfile
+from app.services.genai_clients import ClientCache
+from app.services.llm_backends import get_backend, GeminiBackend, LLMBackend
+from app.services.llm_engine import generate_response_core, generate_response_stream, LLMUnavailable
+
+FAST = dict(latency_ms=1, latency_sigma=0, chunk_ms=0, seed=7)
+
+
+def _use(backend):
+    return patch("app.services.llm_engine.client_cache", ClientCache(backend=backend))
+
+
+def test_backend_is_picked_by_name():
+    assert isinstance(get_backend("gemini"), GeminiBackend)
+    assert isinstance(get_backend("fake"), FakeBackend)
+    with pytest.raises(ValueError):
+        get_backend("openai")
+
+
+def test_incomplete_backend_fails_at_construction():
+    class Incomplete(LLMBackend):
+        name = "incomplete"
+
+    with pytest.raises(TypeError):
+        Incomplete()
+
+
+@pytest.mark.asyncio
+async def test_fake_answers_and_streams_with_usage():
+    backend = FakeBackend(FakeProfile(reply_tokens=20, chunk_tokens=5, **FAST))
+    with _use(backend):
+        calls = []
+        response = await generate_response_core("System", [], "Bonjou", [], ["fake1"], usage=calls)
+        chunks = [c async for c in generate_response_stream("System", [], "Bonjou", [], ["fake1"], usage=calls)]
+
+    assert response.text.startswith("[fake gemini-3-flash-preview] Bonjou")
+    assert len(response.text.split()) == 20
+    assert len(chunks) == 4
+    streamed = "".join(c.text for c in chunks)
+    assert streamed.startswith("[fake gemini-3-flash-preview] Bonjou") and len(streamed.split()) == 20
+    assert chunks[-1].usage_metadata is not None and chunks[0].usage_metadata is None
+    assert [u.output_tokens > 0 for u in calls] == [True, True]
+
+
+@pytest.mark.asyncio
+async def test_fake_calls_declared_tools_then_answers():
+    backend = FakeBackend(FakeProfile(tool_rate=1, **FAST))
+    declaration = types.FunctionDeclaration(
+        name="generate_payment_link", description="pay",
+        parameters=types.Schema(type=types.Type.OBJECT,
+                                properties={"plan_type": types.Schema(type=types.Type.STRING)},
+                                required=["plan_type"]))
+    tools = [types.Tool(function_declarations=[declaration])]
+    with _use(backend):
+        first = await generate_response_core("System", [], "Mwen vle peye", tools, ["fake1"])
+        call = first.candidates[0].content.parts[0].function_call
+        result = types.Part.from_function_response(name=call.name, response={"url": "https://x"})
+        second = await generate_response_core(
+            "System", [], "Mwen vle peye", tools, ["fake1"],
+            followup=[first.candidates[0].content, types.Content(role="user", parts=[result])])
+        # Tools declared but not allowed: text only
+        third = await generate_response_core("System", [], "Mwen vle peye", tools, ["fake1"], allow_tools=False)
+
+    assert call.name == "generate_payment_link" and call.args == {"plan_type": "basic"}
+    assert second.text.startswith("Done: generate_payment_link.")
+    assert third.text.startswith("[fake")
+
+
+@pytest.mark.asyncio
+async def test_fake_injects_gemini_errors():
+    metrics.reset()
+    backend = FakeBackend(FakeProfile(rate_429=1, **FAST))
+    with _use(backend), patch("app.services.cache.mark_key_failure", new_callable=AsyncMock):
+        with pytest.raises(LLMUnavailable):
+            await generate_response_core("System", [], "Hi", [], ["fake1", "fake2"], fallback_models=[])
+    # Classified like the real thing: a rate limit per key, breakers opened
+    assert metrics.get("llm.error.rate_limit") == 2
+    metrics.reset()
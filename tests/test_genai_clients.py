@@ -0,0 +1,58 @@
+import time
+import pytest
+from unittest.mock import patch
+from app.services.genai_clients import ClientCache
+from tests.mocks import make_mock_genai_client
+
+
+def client_factory():
+    return patch("app.services.llm_backends.genai.Client",
+                 side_effect=lambda api_key: make_mock_genai_client())
+
+
+@pytest.mark.asyncio
+async def test_one_client_per_key_is_reused():
+    cache = ClientCache()
+    with client_factory() as MockClient:
+        async with cache.lease("user-key") as c1:
+            pass
+        async with cache.lease("user-key") as c2:
+            pass
+    assert c1 is c2
+    assert MockClient.call_count == 1
+    c1.aio.aclose.assert_not_awaited()
+
+
+@pytest.mark.asyncio
+async def test_user_keys_are_lru_evicted_but_system_keys_stay():
+    cache = ClientCache(max_user_clients=2)
+    with client_factory(), patch.dict("os.environ", {"GOOGLE_API_KEY": "sys-1,sys-2"}):
+        clients = {}
+        for key in ["sys-1", "u1", "u2", "u1", "u3"]:
+            async with cache.lease(key) as c:
+                clients[key] = c
+
+    # u2 was least recently used when u3 arrived
+    clients["u2"].aio.aclose.assert_awaited_once()
+    clients["u1"].aio.aclose.assert_not_awaited()
+    clients["sys-1"].aio.aclose.assert_not_awaited()
+    assert len(cache) == 3
+
+
+@pytest.mark.asyncio
+async def test_idle_clients_expire_and_busy_ones_close_on_release():
+    cache = ClientCache(max_user_clients=1, idle_seconds=60)
+    with client_factory():
+        async with cache.lease("idle") as idle:
+            pass
+        # Pretend it was last used long ago
+        cache._users["idle"].last_used = time.monotonic() - 120
+        async with cache.lease("busy") as busy:
+            idle.aio.aclose.assert_awaited_once()
+            # Evicted by the LRU while a request still uses it -> closed on release
+            async with cache.lease("other"):
+                busy.aio.aclose.assert_not_awaited()
+        busy.aio.aclose.assert_awaited_once()
+
+        await cache.close_all()
+    assert len(cache) == 0
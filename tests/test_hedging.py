@@ -0,0 +1,80 @@
+import asyncio
+import pytest
+from unittest.mock import AsyncMock, patch
+from google.genai.types import GenerateContentResponse, Candidate, Content, Part
+from app.core import metrics
+from app.core.ratelimit import TokenBucket
+from app.services.llm_engine import generate_response_core
+from tests.mocks import make_mock_genai_client
+
+
+def _reply(text):
+    return GenerateContentResponse(candidates=[Candidate(content=Content(parts=[Part(text=text)]))])
+
+
+def _slow_client(text, delay, cancelled=None):
+    async def answer(*args, **kwargs):
+        try:
+            await asyncio.sleep(delay)
+        except asyncio.CancelledError:
+            if cancelled is not None:
+                cancelled.set()
+            raise
+        return _reply(text)
+    client = make_mock_genai_client()
+    client.aio.models.generate_content = AsyncMock(side_effect=answer)
+    return client
+
+
+@pytest.fixture(autouse=True)
+def hedge_settings():
+    metrics.reset()
+    with patch("app.services.llm_engine.LLM_HEDGE_DELAY_MS", 50), \
+         patch("app.services.llm_engine.LLM_HEDGE_MIN_DELAY_MS", 10), \
+         patch("app.services.llm_engine._hedge_bucket", TokenBucket(100)):
+        yield
+    metrics.reset()
+
+
+@pytest.mark.asyncio
+async def test_hedge_wins_and_cancels_slow_primary():
+    cancelled = asyncio.Event()
+    clients = {"Key1": _slow_client("slow", 5, cancelled), "Key2": _slow_client("fast", 0.01)}
+
+    with patch("app.services.llm_engine.genai.Client", side_effect=lambda api_key: clients[api_key]):
+        response = await asyncio.wait_for(
+            generate_response_core("System", [], "Hi", [], ["Key1", "Key2"], hedge=True), 2
+        )
+
+    assert response.text == "fast"
+    assert cancelled.is_set()
+    assert metrics.get("llm.hedge.fired") == 1
+    assert metrics.get("llm.hedge.won") == 1
+
+
+@pytest.mark.asyncio
+async def test_no_hedge_when_primary_is_fast_or_hedging_off():
+    clients = {"Key1": _slow_client("first", 0.001), "Key2": _slow_client("second", 0.001),
+               "Key3": _slow_client("slow", 0.1)}
+
+    with patch("app.services.llm_engine.genai.Client", side_effect=lambda api_key: clients[api_key]):
+        assert (await generate_response_core("System", [], "Hi", [], ["Key1", "Key2"], hedge=True)).text == "first"
+        assert (await generate_response_core("System", [], "Hi", [], ["Key3", "Key2"], hedge=False)).text == "slow"
+
+    assert clients["Key2"].aio.models.generate_content.await_count == 0
+    assert metrics.get("llm.hedge.eligible") == 0
+
+
+@pytest.mark.asyncio
+async def test_hedges_are_rate_limited():
+    clients = {"Key1": _slow_client("slow", 0.1), "Key2": _slow_client("fast", 0.001)}
+
+    with patch("app.services.llm_engine.genai.Client", side_effect=lambda api_key: clients[api_key]), \
+         patch("app.services.llm_engine._hedge_bucket", TokenBucket(0.001, burst=1)):
+        first = await generate_response_core("System", [], "Hi", [], ["Key1", "Key2"], hedge=True)
+        second = await generate_response_core("System", [], "Hi", [], ["Key1", "Key2"], hedge=True)
+
+    # Scheduler may put either key first; only one hedge is allowed through
+    assert metrics.get("llm.hedge.eligible") >= 1
+    assert metrics.get("llm.hedge.fired") == 1
+    assert metrics.get("llm.hedge.rate_limited") == metrics.get("llm.hedge.eligible") - 1
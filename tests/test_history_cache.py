@@ -0,0 +1,60 @@
+import pytest
+from unittest.mock import patch
+from app.services import cache
+
+
+@pytest.fixture
+async def valkey():
+    """Runs against the configured Valkey; skipped when none is reachable"""
+    if not await cache.check_health():
+        pytest.skip("Valkey not reachable")
+    with patch.object(cache, "HISTORY_CACHE_ENABLED", True), patch.object(cache, "HISTORY_CACHE_SIZE", 3):
+        r = await cache.get_redis()
+        await r.delete("hist:test_ring", "histw:test_ring")
+        yield r
+        await r.delete("hist:test_ring", "histw:test_ring")
+
+
+@pytest.mark.asyncio
+async def test_ring_buffer_lifecycle(valkey):
+    # Cold: write-through must not create a partial list
+    await cache.push_history("test_ring", "user", "lost")
+    assert await cache.get_cached_history("test_ring", 3) is None
+    await valkey.delete("histw:test_ring")  # grace period over
+    
+    # Warm-up with an empty conversation is still a hit
+    await cache.warm_history("test_ring", [])
+    assert await cache.get_cached_history("test_ring", 3) == []
+    
+    for i in range(5):
+        await cache.push_history("test_ring", "user", f"m{i}")
+    
+    # Capped at the last 3 turns, chronological
+    assert [m["content"] for m in await cache.get_cached_history("test_ring", 3)] == ["m2", "m3", "m4"]
+    assert [m["content"] for m in await cache.get_cached_history("test_ring", 2)] == ["m3", "m4"]
+    # Deeper than the ring -> caller must go to Postgres
+    assert await cache.get_cached_history("test_ring", 4) is None
+    assert await valkey.ttl("hist:test_ring") > 0
+
+
+@pytest.mark.asyncio
+async def test_oversized_message_evicts(valkey):
+    await cache.warm_history("test_ring", [{"role": "user", "content": "short"}])
+    with patch.object(cache, "HISTORY_CACHE_MAX_MESSAGE_BYTES", 50):
+        await cache.push_history("test_ring", "assistant", "x" * 100)
+    assert await cache.get_cached_history("test_ring", 3) is None
+
+
+@pytest.mark.asyncio
+async def test_save_during_cold_read_blocks_the_stale_warm(valkey):
+    # Cold read loads [a] from Postgres; meanwhile "b" is saved (list still cold)
+    snapshot = [{"role": "user", "content": "a"}]
+    await cache.push_history("test_ring", "assistant", "b")
+    await cache.warm_history("test_ring", snapshot)
+    # Not cached with "b" missing: the next read goes to Postgres again
+    assert await cache.get_cached_history("test_ring", 3) is None
+
+    # Once the write is old enough to be readable, warming works
+    await valkey.delete("histw:test_ring")
+    await cache.warm_history("test_ring", snapshot + [{"role": "assistant", "content": "b"}])
+    assert [m["content"] for m in await cache.get_cached_history("test_ring", 3)] == ["a", "b"]
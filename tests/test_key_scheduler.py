@@ -0,0 +1,79 @@
+import asyncio
+import pytest
+from unittest.mock import AsyncMock, patch
+from app.services import cache
+from app.services.key_scheduler import KeyScheduler
+from tests.mocks import make_mock_genai_client
+
+SYSTEM_KEYS = {"GOOGLE_API_KEY": "sysA,sysB,sysC"}
+
+
+def test_order_skips_cooling_keys_and_keeps_user_key_first():
+    scheduler = KeyScheduler()
+    with patch.dict("os.environ", SYSTEM_KEYS):
+        scheduler._note_cooldown(cache.key_id("sysA"), 9e12)
+        order = scheduler.order(["userKey", "sysA", "sysB", "sysC"])
+    assert order[0] == "userKey"
+    assert "sysA" not in order
+    assert sorted(order[1:]) == ["sysB", "sysC"]
+
+
+def test_order_spreads_system_keys_by_in_flight():
+    scheduler = KeyScheduler()
+    with patch.dict("os.environ", SYSTEM_KEYS):
+        with scheduler.track("sysA"), scheduler.track("sysB"):
+            assert scheduler.order(["sysA", "sysB", "sysC"])[0] == "sysC"
+        # Everything cooling: nothing to try, the caller falls back right away
+        scheduler._note_cooldown(cache.key_id("sysA"), 9e12)
+        scheduler._note_cooldown(cache.key_id("sysB"), 8e12)
+        assert scheduler.order(["sysA", "sysB"]) == []
+
+
+@pytest.mark.asyncio
+async def test_cooling_key_costs_no_round_trip():
+    """After a 429, the next request goes straight to a healthy key"""
+    from app.services.llm_engine import generate_response_core
+    from google.genai.types import GenerateContentResponse, Candidate, Content, Part
+    ok = GenerateContentResponse(candidates=[Candidate(content=Content(parts=[Part(text="ok")]))])
+
+    limited = make_mock_genai_client(side_effect=Exception("429 Resource exhausted"))
+    healthy = make_mock_genai_client(ok)
+    clients = {"Key1": limited, "Key2": healthy}
+
+    with patch("app.services.llm_engine.genai.Client", side_effect=lambda api_key: clients[api_key]), \
+         patch("app.services.cache.mark_key_failure", new_callable=AsyncMock), \
+         patch("app.services.cache.get_redis", new_callable=AsyncMock):
+        await generate_response_core("System", [], "Hi", [], ["Key1", "Key2"])
+        await generate_response_core("System", [], "Hi again", [], ["Key1", "Key2"])
+
+    assert limited.aio.models.generate_content.await_count == 1
+    assert healthy.aio.models.generate_content.await_count == 2
+
+
+@pytest.mark.asyncio
+async def test_cooldowns_propagate_between_workers():
+    if not await cache.check_health():
+        pytest.skip("Valkey not reachable")
+    a, b = KeyScheduler(), KeyScheduler()
+    await a.start()
+    await b.start()
+    try:
+        await asyncio.sleep(0.2)  # let both subscribe
+        await a.mark_failure("test-shared-key", 5)
+        for _ in range(100):
+            if not b.is_ready("test-shared-key"):
+                break
+            await asyncio.sleep(0.01)
+        assert not b.is_ready("test-shared-key")
+
+        # A worker starting later bootstraps from key_fail:*
+        c = KeyScheduler()
+        await c.start()
+        await asyncio.sleep(0.2)
+        assert not c.is_ready("test-shared-key")
+        await c.stop()
+    finally:
+        await a.stop()
+        await b.stop()
+        r = await cache.get_redis()
+        await r.delete(f"key_fail:{cache.key_id('test-shared-key')}")
@@ -0,0 +1,68 @@
+import asyncio
+import pytest
+from unittest.mock import patch
+from app.core import metrics
+from app.services.mailbox import MailboxRouter
+
+
+@pytest.fixture(autouse=True)
+def short_debounce():
+    metrics.reset()
+    with patch("app.services.mailbox.MAILBOX_DEBOUNCE_MS", 50), \
+         patch("app.services.mailbox.MAILBOX_MAX_WAIT_MS", 500):
+        yield
+    metrics.reset()
+
+
+def _recorder(calls, delay=0.0):
+    async def handler(text):
+        calls.append(("start", text))
+        await asyncio.sleep(delay)
+        calls.append(("end", text))
+        return f"reply to {text}"
+    return handler
+
+
+@pytest.mark.asyncio
+async def test_burst_is_answered_once_on_its_last_message():
+    router = MailboxRouter()
+    calls = []
+    tasks = []
+    for text in ["Bonjou", "mwen gen yon kesyon", "konbyen li koute?"]:
+        tasks.append(asyncio.create_task(router.submit("user_1", text, _recorder(calls))))
+        await asyncio.sleep(0.01)
+    replies = await asyncio.gather(*tasks)
+
+    merged = "Bonjou\nmwen gen yon kesyon\nkonbyen li koute?"
+    assert calls == [("start", merged), ("end", merged)]
+    assert replies == [None, None, f"reply to {merged}"]
+    assert metrics.get("mailbox.merged") == 2
+    assert len(router) == 0  # idle mailbox is gone
+
+
+@pytest.mark.asyncio
+async def test_turns_of_one_user_never_overlap():
+    router = MailboxRouter()
+    calls = []
+    first = asyncio.create_task(router.submit("user_1", "one", _recorder(calls, 0.1)))
+    await asyncio.sleep(0.08)  # "one" is being answered
+    second = await router.submit("user_1", "two", _recorder(calls))
+    other = await router.submit("user_2", "hi", _recorder([]))
+
+    assert await first == "reply to one"
+    assert second == "reply to two"
+    assert other == "reply to hi"
+    assert calls == [("start", "one"), ("end", "one"), ("start", "two"), ("end", "two")]
+
+
+@pytest.mark.asyncio
+async def test_retry_joins_the_turn_in_flight():
+    router = MailboxRouter()
+    calls = []
+    first = asyncio.create_task(router.submit("user_1", "Prix?", _recorder(calls, 0.1)))
+    await asyncio.sleep(0.08)
+    retry = await router.submit("user_1", "Prix?", _recorder(calls))
+
+    assert retry == await first == "reply to Prix?"
+    assert len(calls) == 2  # one start, one end
+    assert metrics.get("mailbox.joined_in_flight") == 1
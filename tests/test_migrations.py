@@ -0,0 +1,113 @@
+import pytest
+from contextlib import asynccontextmanager
+from unittest.mock import AsyncMock, MagicMock, patch
+from app.database import migrations
+from app.database.migrations import Migration, run_migrations
+
+
+def make_conn(version, partitions_ok=True):
+    conn = AsyncMock()
+    conn.fetchrow.return_value = {"version": version, "partitions_ok": partitions_ok}
+
+    async def fetchval(query, *args):
+        if "pg_try_advisory_lock" in query:
+            return True
+        return version  # COALESCE(MAX(version), 0) after taking the lock
+    conn.fetchval.side_effect = fetchval
+
+    @asynccontextmanager
+    async def transaction():
+        conn.in_transaction = True
+        yield
+        conn.in_transaction = False
+    conn.in_transaction = False
+    conn.transaction = MagicMock(side_effect=transaction)
+    return conn
+
+
+@pytest.mark.asyncio
+async def test_up_to_date_is_one_query_and_no_lock():
+    conn = make_conn(migrations.LATEST_VERSION)
+
+    assert await run_migrations(conn) == []
+
+    conn.fetchrow.assert_awaited_once()
+    conn.fetchval.assert_not_awaited()
+    conn.execute.assert_not_awaited()
+
+
+@pytest.mark.asyncio
+async def test_pending_migrations_run_in_order_under_lock():
+    conn = make_conn(1)
+    calls = []
+
+    async def tx_step(c):
+        calls.append(("v2", c.in_transaction))
+
+    async def concurrent_step(c):
+        calls.append(("v3", c.in_transaction))
+
+    fake = [
+        Migration(1, "baseline", AsyncMock()),
+        Migration(2, "tx", tx_step),
+        Migration(3, "index", concurrent_step, transactional=False),
+    ]
+    with patch.object(migrations, "MIGRATIONS", fake), \
+         patch.object(migrations, "LATEST_VERSION", 3), \
+         patch("app.database.migrations.is_partitioned", new_callable=AsyncMock, return_value=True), \
+         patch("app.database.migrations.ensure_chat_partitions", new_callable=AsyncMock) as mock_parts:
+        applied = await run_migrations(conn)
+
+    assert applied == [2, 3]
+    # Only the transactional migration runs inside a transaction (CONCURRENTLY can't)
+    assert calls == [("v2", True), ("v3", False)]
+    fake[0].apply.assert_not_awaited()
+    mock_parts.assert_awaited_once()
+
+    executed = [c.args[0] for c in conn.execute.call_args_list]
+    assert "pg_advisory_unlock" in executed[-1]
+    recorded = [c.args[1:] for c in conn.execute.call_args_list if "INSERT INTO schema_version" in c.args[0]]
+    assert recorded == [(2, "tx"), (3, "index")]
+
+
+@pytest.mark.asyncio
+async def test_late_partition_takes_its_rows_out_of_the_default():
+    from app.database.schema import ensure_chat_partitions
+    conn = make_conn(migrations.LATEST_VERSION)
+
+    async def fetchval(query, *args):
+        if "to_regclass($1) IS NULL" in query:
+            return args[0].endswith("m01")  # only January is missing
+        return True  # default exists and holds January rows
+    conn.fetchval.side_effect = fetchval
+    conn.execute.return_value = "INSERT 0 3"
+
+    with patch("app.database.schema.date") as mock_date:
+        from datetime import date
+        mock_date.today.return_value = date(2026, 12, 15)
+        mock_date.side_effect = lambda *a: date(*a)
+        await ensure_chat_partitions(conn, months_ahead=1)
+
+    statements = [c.args[0] for c in conn.execute.await_args_list]
+    assert len(statements) == 3
+    assert "LIKE chat_sessions" in statements[0] and "chat_sessions_y2027m01" in statements[0]
+    assert "DELETE FROM chat_sessions_default" in statements[1]
+    assert "ATTACH PARTITION chat_sessions_y2027m01 FOR VALUES FROM ('2027-01-01') TO ('2027-02-01')" in statements[2]
+    conn.transaction.assert_called_once()
+
+
+@pytest.mark.asyncio
+async def test_v8_moves_the_flat_keyset_index_off_the_partitioned_name():
+    conn = AsyncMock()
+    # Converted before the fix: the old index went to chat_sessions_legacy with the swap
+    with patch.object(migrations, "index_table", new_callable=AsyncMock, return_value="chat_sessions_legacy"), \
+         patch.object(migrations, "is_partitioned", new_callable=AsyncMock, return_value=True), \
+         patch.object(migrations, "create_partitioned_index_concurrently", new_callable=AsyncMock) as build:
+        await migrations._v8_chat_keyset_index_name(conn)
+
+    conn.execute.assert_awaited_once_with(
+        "ALTER INDEX idx_chat_sessions_user_recent RENAME TO idx_chat_sessions_legacy_user_recent;"
+    )
+    build.assert_awaited_once_with(
+        conn, "idx_chat_sessions_user_recent", "chat_sessions", "user_id, created_at DESC"
+    )
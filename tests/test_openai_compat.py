@@ -8,7 +8,11 @@ async def test_openai_completion_success():
     # Mock the internal manager to avoid DB/LLM calls
     # Use AsyncMock to return an awaitable
     with patch("app.routers.openai_compat.process_chat_request", new_callable=MagicMock) as mock_process:
+        from app.services.llm_engine import LLMUsage
+        
         async def async_return(*args, **kwargs):
+            kwargs["usage"].append(LLMUsage("gemini", "k", prompt_tokens=120, output_tokens=4))
+            kwargs["usage"].append(LLMUsage("gemini", "k", prompt_tokens=150, output_tokens=6))
             return "Hello from AI"
         
         mock_process.side_effect = async_return
@@ -28,3 +32,45 @@ async def test_openai_completion_success():
         data = response.json()
         assert data["object"] == "chat.completion"
         assert data["choices"][0]["message"]["content"] == "Hello from AI"
+        # Summed over every Gemini call behind the reply (tool turns included)
+        assert data["usage"]["prompt_tokens"] == 270
+        assert data["usage"]["completion_tokens"] == 10
+
+@pytest.mark.asyncio
+async def test_openai_completion_stream():
+    import json
+    
+    from app.services.llm_engine import LLMUsage
+    
+    async def fake_stream(*args, **kwargs):
+        for piece in ["Bon", "jou", "!"]:
+            yield piece
+        kwargs["usage"].append(LLMUsage("gemini", "k", prompt_tokens=42, output_tokens=3, thoughts_tokens=5))
+    
+    with patch("app.routers.openai_compat.stream_chat_request", side_effect=fake_stream) as mock_stream:
+        payload = {
+            "model": "konex-ai",
+            "messages": [{"role": "user", "content": "Hi there"}],
+            "user": "tel:+12345",
+            "stream": True,
+            "stream_options": {"include_usage": True}
+        }
+        
+        async with AsyncClient(transport=ASGITransport(app=app), base_url="http://test") as ac:
+            response = await ac.post("/v1/chat/completions", json=payload)
+    
+    assert response.status_code == 200
+    assert response.headers["content-type"].startswith("text/event-stream")
+    frames = [line[len("data: "):] for line in response.text.split("\n\n") if line]
+    assert frames[-1] == "[DONE]"
+    chunks = [json.loads(f) for f in frames[:-1]]
+    assert all(c["object"] == "chat.completion.chunk" for c in chunks)
+    assert chunks[0]["choices"][0]["delta"]["role"] == "assistant"
+    text = "".join(c["choices"][0]["delta"].get("content", "") for c in chunks if c["choices"])
+    assert text == "Bonjou!"
+    assert chunks[-2]["choices"][0]["finish_reason"] == "stop"
+    # Real Gemini token counts, reasoning included in completion like OpenAI does
+    assert chunks[-1]["usage"]["prompt_tokens"] == 42
+    assert chunks[-1]["usage"]["completion_tokens"] == 8
+    assert chunks[-1]["usage"]["total_tokens"] == 50
+    assert mock_stream.call_args.args[1:4] == ("+12345", "Hi there", "tel:+12345")
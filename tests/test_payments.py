@@ -24,18 +24,16 @@ async def test_db_payment_flow():
     from unittest.mock import patch, AsyncMock, MagicMock
     
     # Mocking Record
-    # db.get_db_connection is an async function, so the mock replacing it must be awaitable
-    # calling it returns a coroutine that yields the connection.
+    # Repository functions borrow a pooled connection via "async with acquire() as conn",
+    # so we swap acquire for a context manager yielding our mock connection.
+    from tests.mocks import fake_acquire
     
     msg_mock = AsyncMock() # The Connection object
-    msg_mock.execute.return_value = "UPDATE 1"
-    msg_mock.fetchrow.return_value = {"status": "PENDING", "amount": 500, "currency": "HTG", "claimed_by": None}
-    msg_mock.close.return_value = None
+    msg_mock.execute.return_value = "INSERT 0 1"
+    # claim_payment is one UPDATE ... RETURNING; the row carries the pre-update status
+    msg_mock.fetchrow.return_value = {"claimed": True, "claimed_amount": 500, "status": "PENDING", "claimed_by": None}
     
-    # When we await get_db_connection(), we get msg_mock
-    async_get_db = AsyncMock(return_value=msg_mock)
-    
-    with patch("app.database.repository.get_db_connection", side_effect=async_get_db):
+    with patch("app.database.repository.acquire", fake_acquire(msg_mock)):
         
         # 1. Record
         await record_payment("CODE123", 500, "HTG", "509111", "raw")
@@ -47,8 +45,45 @@ async def test_db_payment_flow():
         assert amt == 500.0
         
         # 3. Claim Fail (Already Claimed)
-        msg_mock.fetchrow.return_value = {"status": "CLAIMED", "amount": 500, "currency": "HTG", "claimed_by": "user_B"}
+        msg_mock.fetchrow.return_value = {"claimed": False, "claimed_amount": None, "status": "CLAIMED", "claimed_by": "user_B"}
         
         success, msg, amt = await claim_payment("CODE123", "user_A")
         assert success is False
         assert "used by someone else" in msg
+        
+        # 4. Unknown code
+        msg_mock.fetchrow.return_value = {"claimed": False, "claimed_amount": None, "status": None, "claimed_by": None}
+        success, msg, amt = await claim_payment("NOPE", "user_A")
+        assert success is False
+        assert "not found" in msg
+
+        # 5. Won the claim, but the payment has no amount: still a success
+        msg_mock.fetchrow.return_value = {"claimed": True, "claimed_amount": None, "status": "PENDING", "claimed_by": None}
+        success, msg, amt = await claim_payment("CODE456", "user_A")
+        assert success is True
+        assert amt == 0.0
+        assert msg_mock.fetchrow.await_count == 4
+
+@pytest.mark.asyncio
+async def test_claim_payments_bulk():
+    from app.database.repository import claim_payments_bulk
+    from unittest.mock import patch, AsyncMock
+    from tests.mocks import fake_acquire
+    
+    conn = AsyncMock()
+    conn.fetch.return_value = [
+        {"code": "A", "user_id": "u1", "claimed": True, "claimed_amount": 100, "status": "PENDING", "claimed_by": None},
+        {"code": "B", "user_id": "u2", "claimed": False, "claimed_amount": None, "status": "CLAIMED", "claimed_by": "u2"},
+        {"code": "C", "user_id": "u3", "claimed": False, "claimed_amount": None, "status": None, "claimed_by": None},
+    ]
+    
+    with patch("app.database.repository.acquire", fake_acquire(conn)):
+        results = await claim_payments_bulk([("A", "u1"), ("B", "u2"), ("C", "u3")])
+    
+    # One statement for the whole batch
+    conn.fetch.assert_awaited_once()
+    assert "unnest" in conn.fetch.call_args.args[0]
+    assert conn.fetch.call_args.args[1:] == (["A", "B", "C"], ["u1", "u2", "u3"])
+    assert results["A"] == (True, "Payment verified successfully!", 100.0)
+    assert "already used" in results["B"][1]
+    assert "not found" in results["C"][1]
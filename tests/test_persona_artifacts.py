@@ -0,0 +1,57 @@
+import pytest
+from unittest.mock import AsyncMock, patch
+from app.personas.compiled import PersonaArtifacts
+from app.personas.registry import PersonaRegistry
+
+PERSONA = {"id": 7, "name": "Boutik", "system_prompt": "You sell crafts.", "allowed_tools": ["update_profile"],
+           "model_config": {}, "owner_phone": None, "is_default": True}
+
+
+def test_artifact_is_compiled_once_and_filled_per_user():
+    artifacts = PersonaArtifacts()
+    first = artifacts.get(PERSONA, False, False)
+    assert artifacts.get(PERSONA, False, False) is first
+    assert artifacts.get(PERSONA, True, False) is not first
+    assert first.tool_names == ["update_profile"]
+
+    prompt = first.render(True, ["Kreyol"], {"name": "Jean", "city": "Jakmèl"}, "Jean asked about prices.")
+    assert prompt.startswith("You sell crafts.")
+    assert "* Status: ✅ SUBSCRIBER" in prompt
+    assert "* Groups: Kreyol" in prompt
+    assert "* Access Level: STANDARD" in prompt
+    assert '"city": "Jakmèl"' in prompt
+    assert "Jean asked about prices." in prompt
+    # Other user, same artifact: only the slots differ
+    other = first.render(False, [], None)
+    assert "* Status: ❌ LEAD" in other and "* Groups: None" in other and "* Known Profile: None" in other
+
+
+def test_admin_artifact_gets_god_mode():
+    artifact = PersonaArtifacts().get(PERSONA, False, True)
+    assert "GOD MODE" in artifact.render(True, ["Premium"], {"name": "Jean"})
+    declared = [f.name for t in artifact.tools if t.function_declarations for f in t.function_declarations]
+    assert "get_system_status" in declared
+
+
+def test_changed_persona_is_recompiled():
+    artifacts = PersonaArtifacts()
+    old = artifacts.get(PERSONA, False, False)
+    # The registry swaps in a new dict when the row changes
+    edited = dict(PERSONA, system_prompt="You sell paintings.", allowed_tools=[])
+    new = artifacts.get(edited, False, False)
+    assert new is not old
+    assert new.render(False, [], None).startswith("You sell paintings.")
+    assert new.tool_names == ["generate_payment_link", "update_profile"]
+
+
+@pytest.mark.asyncio
+async def test_registry_reload_invalidates_artifacts():
+    registry = PersonaRegistry()
+    with patch("app.personas.registry.load_personas", new_callable=AsyncMock, return_value=[PERSONA]), \
+         patch("app.personas.registry.persona_artifacts") as artifacts:
+        await registry.reload()
+        artifacts.invalidate.assert_called_once_with()
+
+        with patch("app.personas.registry.get_persona", new_callable=AsyncMock, return_value=PERSONA):
+            await registry.reload_one(7)
+        artifacts.invalidate.assert_called_with(7)
@@ -0,0 +1,88 @@
+import pytest
+from unittest.mock import AsyncMock, patch
+from app.personas.registry import PersonaRegistry
+from app.database.repository import ConversationContext
+from google.genai.types import GenerateContentResponse, Candidate, Content, Part
+from tests.mocks import make_mock_genai_client
+
+PERSONAS = [
+    {"id": 1, "name": "Sarah", "system_prompt": "You are Sarah.", "allowed_tools": [],
+     "model_config": {}, "owner_phone": None, "is_default": True},
+    {"id": 2, "name": "Boutik Jacmel", "system_prompt": "You sell crafts in Jacmel.",
+     "allowed_tools": ["update_profile"], "model_config": {"model": "gemini-2.0-flash"},
+     "owner_phone": "50937000001", "is_default": False},
+]
+
+
+@pytest.mark.asyncio
+async def test_lookups_are_served_from_memory():
+    registry = PersonaRegistry()
+    with patch("app.personas.registry.load_personas", new_callable=AsyncMock, return_value=PERSONAS) as mock_load:
+        await registry.reload()
+
+    mock_load.assert_awaited_once()
+    assert registry.get("2")["name"] == "Boutik Jacmel"
+    assert registry.for_owner("50937000001")["id"] == 2
+    assert registry.default()["id"] == 1
+    # Resolution order: explicit id > owner > default
+    assert registry.resolve("50937000001", persona_id=1)["id"] == 1
+    assert registry.resolve("50937000001")["id"] == 2
+    assert registry.resolve("50999999999")["id"] == 1
+
+
+@pytest.mark.asyncio
+async def test_notify_reloads_only_the_changed_row():
+    registry = PersonaRegistry()
+    with patch("app.personas.registry.load_personas", new_callable=AsyncMock, return_value=PERSONAS):
+        await registry.reload()
+
+    moved = dict(PERSONAS[1], owner_phone="50937000002")
+    with patch("app.personas.registry.get_persona", new_callable=AsyncMock, return_value=moved) as mock_get:
+        await registry.reload_one(2)
+    mock_get.assert_awaited_once_with(2)
+    assert registry.for_owner("50937000001") is None
+    assert registry.for_owner("50937000002")["id"] == 2
+
+    # DELETE -> row gone
+    with patch("app.personas.registry.get_persona", new_callable=AsyncMock, return_value=None):
+        await registry.reload_one(1)
+    assert registry.get(1) is None
+    assert registry.default() is None
+
+
+@pytest.mark.asyncio
+async def test_manager_uses_owner_persona():
+    registry = PersonaRegistry()
+    with patch("app.personas.registry.load_personas", new_callable=AsyncMock, return_value=PERSONAS):
+        await registry.reload()
+
+    from app.personas.manager import process_chat_request
+    with patch("app.personas.manager.persona_registry", registry), \
+         patch("app.personas.manager.load_conversation_context", new_callable=AsyncMock, return_value=ConversationContext()), \
+         patch("app.personas.manager.save_message", new_callable=AsyncMock), \
+         patch("app.personas.manager.get_api_keys", return_value=["AIzaMock"]), \
+         patch("app.services.llm_engine.genai.Client") as MockClient:
+
+        client = make_mock_genai_client(GenerateContentResponse(
+            candidates=[Candidate(content=Content(parts=[Part(text="Bonjou")]))]
+        ))
+        MockClient.return_value = client
+        await process_chat_request(None, "50937000001", "Hi", "user_1", [])
+
+    kwargs = client.aio.models.generate_content.call_args.kwargs
+    assert kwargs["model"] == "gemini-2.0-flash"
+    assert "crafts in Jacmel" in kwargs["config"].system_instruction
+    declared = [f.name for t in kwargs["config"].tools if t.function_declarations for f in t.function_declarations]
+    assert declared == ["update_profile"]
+
+
+@pytest.mark.asyncio
+async def test_notify_keeps_its_reload_task_alive():
+    import asyncio
+    registry = PersonaRegistry()
+    with patch("app.personas.registry.get_persona", new_callable=AsyncMock, return_value=PERSONAS[0]):
+        registry._on_notify(None, 0, "personas_changed", "1")
+        assert len(registry._reload_tasks) == 1
+        await asyncio.gather(*registry._reload_tasks)
+    assert registry.get(1)["name"] == "Sarah"
+    assert not registry._reload_tasks
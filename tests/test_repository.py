@@ -0,0 +1,147 @@
+import json
+import pytest
+from unittest.mock import AsyncMock, MagicMock, patch
+from tests.mocks import fake_acquire
+
+
+@pytest.mark.asyncio
+async def test_load_conversation_context_single_round_trip():
+    """Profile, token, history and persona come back from ONE statement that also inserts the user message"""
+    from app.database.repository import load_conversation_context
+    
+    conn = AsyncMock()
+    conn.fetchrow.return_value = {
+        # asyncpg returns json/jsonb as text
+        "profile": json.dumps({"city": "Jacmel"}),
+        "token": json.dumps({"phone_number": "509", "access_token": "AIzaUser"}),
+        "history": json.dumps([{"role": "user", "content": "Bonjou"}, {"role": "assistant", "content": "Alo!"}]),
+        "persona": None,
+        "summary": None,
+        "inserted": 1,
+    }
+    
+    with patch("app.database.repository.acquire", fake_acquire(conn)):
+        ctx = await load_conversation_context("whatsapp:509", "509", user_message="Kijan ou ye?", history_limit=5)
+    
+    conn.fetchrow.assert_awaited_once()
+    args = conn.fetchrow.call_args.args
+    assert "INSERT INTO chat_sessions" in args[0]
+    # History is fetched deep enough to warm the Valkey ring
+    from app.services.cache import HISTORY_CACHE_SIZE
+    assert args[1:] == ("whatsapp:509", "509", max(5, HISTORY_CACHE_SIZE), "Kijan ou ye?", None)
+    
+    assert ctx.profile == {"city": "Jacmel"}
+    assert ctx.token["access_token"] == "AIzaUser"
+    assert [m["role"] for m in ctx.history] == ["user", "assistant"]
+    assert ctx.persona is None
+
+
+@pytest.mark.asyncio
+async def test_load_conversation_context_new_user():
+    """A user with no rows anywhere gets empty defaults"""
+    from app.database.repository import load_conversation_context
+    
+    conn = AsyncMock()
+    conn.fetchrow.return_value = {"profile": None, "token": None, "history": "[]", "persona": None, "summary": None, "inserted": 0}
+    
+    with patch("app.database.repository.acquire", fake_acquire(conn)):
+        ctx = await load_conversation_context("whatsapp:1", "1")
+    
+    assert ctx.profile == {}
+    assert ctx.token is None
+    assert ctx.history == []
+
+
+@pytest.mark.asyncio
+async def test_get_history_returns_chronological_order():
+    """The keyset query walks newest-first; callers still get oldest-first"""
+    from app.database.repository import get_history
+    
+    conn = AsyncMock()
+    conn.fetch.return_value = [
+        {"role": "assistant", "content": "newest"},
+        {"role": "user", "content": "oldest"},
+    ]
+    
+    with patch("app.database.repository.acquire", fake_acquire(conn)):
+        history = await get_history("u1", limit=2)
+    
+    assert "ORDER BY created_at DESC" in conn.fetch.call_args.args[0]
+    assert [m["content"] for m in history] == ["oldest", "newest"]
+
+
+@pytest.mark.asyncio
+async def test_ensure_chat_partitions_creates_monthly_ranges():
+    from datetime import date
+    from app.database.schema import ensure_chat_partitions
+    
+    conn = AsyncMock()
+    conn.transaction = MagicMock()  # sync context manager factory, like asyncpg's
+    conn.fetchval.side_effect = lambda query, *args: "IS NULL" in query  # missing months, nothing stranded
+    with patch("app.database.schema.date") as mock_date:
+        mock_date.today.return_value = date(2026, 11, 15)
+        mock_date.side_effect = lambda *a, **k: date(*a, **k)
+        await ensure_chat_partitions(conn, since=date(2026, 10, 3), months_ahead=2)
+    
+    ddl = [c.args[0] for c in conn.execute.call_args_list]
+    assert len(ddl) == 4  # Oct, Nov, Dec, Jan
+    assert "chat_sessions_y2026m10" in ddl[0] and "FROM ('2026-10-01') TO ('2026-11-01')" in ddl[0]
+    assert "chat_sessions_y2027m01" in ddl[-1] and "TO ('2027-02-01')" in ddl[-1]
+
+
+@pytest.mark.asyncio
+async def test_history_cache_hit_skips_postgres_history():
+    """A warm Valkey ring serves history; the context statement then fetches none (LIMIT 0)"""
+    from app.database.repository import load_conversation_context, get_history
+    
+    cached = [{"role": "user", "content": "from valkey"}]
+    conn = AsyncMock()
+    conn.fetchrow.return_value = {"profile": None, "token": None, "history": "[]", "history_last_at": None,
+                                  "persona": None, "summary": None, "inserted": 1}
+    
+    with patch("app.database.repository.acquire", fake_acquire(conn)), \
+         patch("app.database.repository.get_cached_history", AsyncMock(return_value=cached)), \
+         patch("app.database.repository.warm_history", new_callable=AsyncMock) as mock_warm, \
+         patch("app.database.repository.push_history", new_callable=AsyncMock) as mock_push:
+        ctx = await load_conversation_context("u1", "509", user_message="hi")
+        assert await get_history("u1") == cached
+    
+    assert ctx.history == cached
+    assert conn.fetchrow.call_args.args[3] == 0
+    conn.fetch.assert_not_called()
+    mock_warm.assert_not_called()
+    mock_push.assert_awaited_once_with("u1", "user", "hi")
+
+
+@pytest.mark.asyncio
+async def test_history_cache_miss_warms_ring():
+    from app.database.repository import get_history
+    
+    conn = AsyncMock()
+    conn.fetch.return_value = [{"role": "assistant", "content": "b", "created_at": 2},
+                               {"role": "user", "content": "a", "created_at": 1}]
+    
+    with patch("app.database.repository.acquire", fake_acquire(conn)), \
+         patch("app.database.repository.get_cached_history", AsyncMock(return_value=None)), \
+         patch("app.database.repository.warm_history", new_callable=AsyncMock) as mock_warm:
+        history = await get_history("u1", limit=1)
+    
+    assert history == [{"role": "assistant", "content": "b"}]
+    mock_warm.assert_awaited_once_with("u1", [{"role": "user", "content": "a"}, {"role": "assistant", "content": "b"}])
+
+
+@pytest.mark.asyncio
+async def test_merge_profile_sends_only_the_patch():
+    """merge_profile is one upsert with jsonb || and returns the merged document"""
+    from app.database.repository import merge_profile
+    
+    conn = AsyncMock()
+    conn.fetchval.return_value = json.dumps({"name": "Jean", "city": "Jacmel"})
+    
+    with patch("app.database.repository.acquire", fake_acquire(conn)):
+        merged = await merge_profile("user_1", {"city": "Jacmel"}, remove_keys=["tmp"])
+    
+    assert merged == {"name": "Jean", "city": "Jacmel"}
+    args = conn.fetchval.call_args.args
+    assert "||" in args[0] and "ON CONFLICT" in args[0]
+    assert args[1:] == ("user_1", json.dumps({"city": "Jacmel"}), False, ["tmp"])
@@ -0,0 +1,70 @@
+import pytest
+from unittest.mock import AsyncMock, patch
+from app.core import metrics
+from app.services import cache
+from app.personas.registry import PersonaRegistry
+from app.personas.manager import process_chat_request, _response_cache_key
+from app.database.repository import ConversationContext
+from google.genai.types import GenerateContentResponse, Candidate, Content, Part
+from tests.mocks import make_mock_genai_client
+
+FAQ_PERSONA = {"id": 9901, "name": "FAQ", "system_prompt": "You answer pricing questions.",
+               "allowed_tools": [], "model_config": {"response_cache": {"ttl": 60}},
+               "owner_phone": None, "is_default": True}
+
+
+def test_normalize_message():
+    assert cache.normalize_message("  PRIX ?? ") == "prix"
+    assert cache.normalize_message("Kijan pou m peye?") == cache.normalize_message("kijan  pou m PEYE")
+    assert cache.normalize_message("Élève, ça va!") == "eleve ca va"
+
+
+def test_cache_key_bypass_and_fingerprint():
+    config = FAQ_PERSONA["model_config"]
+    base = {"subscriber": False, "groups": [], "tools": []}
+
+    key = _response_cache_key(FAQ_PERSONA, config, "Prix?", dict(base, profile={}), [])
+    assert key == _response_cache_key(FAQ_PERSONA, config, "prix", dict(base, profile={}), [])
+    # Different profile, different answer (e.g. the user's name)
+    assert key != _response_cache_key(FAQ_PERSONA, config, "prix", dict(base, profile={"name": "Jean"}), [])
+    # ...unless the persona says only some fields matter
+    narrow = {"response_cache": {"vary_on_profile": ["language"]}}
+    assert _response_cache_key(FAQ_PERSONA, narrow, "prix", dict(base, profile={"name": "Jean"}), []) == \
+        _response_cache_key(FAQ_PERSONA, narrow, "prix", dict(base, profile={"name": "Marie"}), [])
+
+    # Answering the bot's own question, or no opt-in: no cache
+    asked = [{"role": "assistant", "content": "Ou vle plan Pro a?"}]
+    assert _response_cache_key(FAQ_PERSONA, config, "wi", dict(base, profile={}), asked) is None
+    assert _response_cache_key(FAQ_PERSONA, {}, "prix", dict(base, profile={}), []) is None
+
+
+@pytest.mark.asyncio
+async def test_repeated_question_is_served_without_llm():
+    if not await cache.check_health():
+        pytest.skip("Valkey not reachable")
+    registry = PersonaRegistry()
+    with patch("app.personas.registry.load_personas", new_callable=AsyncMock, return_value=[FAQ_PERSONA]):
+        await registry.reload()
+
+    metrics.reset()
+    client = make_mock_genai_client(GenerateContentResponse(
+        candidates=[Candidate(content=Content(parts=[Part(text="Plan Pro a se 500 HTG.")]))]
+    ))
+    r = await cache.get_redis()
+    try:
+        with patch("app.personas.manager.persona_registry", registry), \
+             patch("app.personas.manager.load_conversation_context", new_callable=AsyncMock, return_value=ConversationContext()), \
+             patch("app.personas.manager.save_message", new_callable=AsyncMock) as mock_save, \
+             patch("app.personas.manager.get_api_keys", return_value=["AIzaMock"]), \
+             patch("app.services.llm_engine.genai.Client", return_value=client):
+            first = await process_chat_request(None, "50937000002", "Prix?", "user_a", [])
+            second = await process_chat_request(None, "50937000003", "  prix  ", "user_b", [])
+    finally:
+        async for key in r.scan_iter(match=f"resp:{FAQ_PERSONA['id']}:*"):
+            await r.delete(key)
+
+    assert first == second == "Plan Pro a se 500 HTG."
+    assert client.aio.models.generate_content.await_count == 1
+    assert metrics.get("response_cache.hit") == 1
+    # Cached replies still land in the conversation history
+    assert mock_save.await_args.args == ("user_b", "assistant", "Plan Pro a se 500 HTG.")
@@ -0,0 +1,95 @@
+import uuid
+import asyncio
+import pytest
+from unittest.mock import AsyncMock, patch
+from app.core import metrics
+from app.services import cache
+from app.services.singleflight import SingleFlight
+
+
+@pytest.fixture(autouse=True)
+def singleflight_on():
+    metrics.reset()
+    with patch("app.services.singleflight.SINGLEFLIGHT_ENABLED", True):
+        yield
+    metrics.reset()
+
+
+def _slow(result, delay=0.1, calls=None):
+    async def fn():
+        if calls is not None:
+            calls.append(1)
+        await asyncio.sleep(delay)
+        return result
+    return fn
+
+
+@pytest.mark.asyncio
+async def test_duplicates_in_one_worker_share_the_reply():
+    flight = SingleFlight()
+    calls = []
+    # No Valkey involved: coalescing in the worker still works
+    with patch("app.services.cache.get_redis", new_callable=AsyncMock, side_effect=ConnectionError("down")):
+        first = asyncio.create_task(flight.do("k", _slow("reply", calls=calls)))
+        await asyncio.sleep(0.01)
+        # The first caller going away must not cancel the duplicates' answer
+        first.cancel()
+        replies = await asyncio.gather(flight.do("k", _slow("other", calls=calls)),
+                                       flight.do("k", _slow("other", calls=calls)))
+
+    assert replies == ["reply", "reply"]
+    assert len(calls) == 1
+    assert metrics.get("singleflight.joined_local") == 2
+    assert flight._calls == {}
+
+
+@pytest.mark.asyncio
+async def test_duplicates_across_workers_get_the_leaders_reply():
+    if not await cache.check_health():
+        pytest.skip("Valkey not reachable")
+    a, b = SingleFlight(), SingleFlight()  # two workers
+    key = f"test-{uuid.uuid4().hex}"
+    calls = []
+    leader = asyncio.create_task(a.do(key, _slow({"text": "reply"}, 0.3, calls)))
+    await asyncio.sleep(0.05)
+    follower = await b.do(key, _slow({"text": "other"}, 0, calls))
+
+    assert await leader == follower == {"text": "reply"}
+    assert len(calls) == 1
+    assert metrics.get("singleflight.joined_remote") == 1
+
+
+@pytest.mark.asyncio
+async def test_duplicate_takes_over_when_the_leader_fails():
+    if not await cache.check_health():
+        pytest.skip("Valkey not reachable")
+    a, b = SingleFlight(), SingleFlight()
+    key = f"test-{uuid.uuid4().hex}"
+
+    async def boom():
+        await asyncio.sleep(0.2)
+        raise RuntimeError("Gemini down")
+
+    leader = asyncio.create_task(a.do(key, boom))
+    await asyncio.sleep(0.05)
+    reply = await b.do(key, _slow("retry answered", 0))
+
+    with pytest.raises(RuntimeError):
+        await leader
+    assert reply == "retry answered"
+    assert metrics.get("singleflight.takeover") == 1
+
+
+@pytest.mark.asyncio
+async def test_repeat_after_the_reply_is_a_new_message():
+    if not await cache.check_health():
+        pytest.skip("Valkey not reachable")
+    a, b = SingleFlight(), SingleFlight()
+    key = f"test-{uuid.uuid4().hex}"
+    calls = []
+    # The user really sends "ok" twice: the second one must not get the first reply
+    assert await a.do(key, _slow("first ok", 0, calls)) == "first ok"
+    assert await b.do(key, _slow("second ok", 0, calls)) == "second ok"
+    assert await a.do(key, _slow("third ok", 0, calls)) == "third ok"
+    assert len(calls) == 3
+    assert metrics.get("singleflight.joined_remote") == 0
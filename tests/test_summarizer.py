@@ -0,0 +1,114 @@
+import pytest
+from datetime import datetime, timedelta
+from unittest.mock import AsyncMock, MagicMock, patch
+from google.genai.types import GenerateContentResponse, Candidate, Content, Part
+from app.database.repository import ConversationContext
+from app.services import tokens
+from app.services.summarizer import SummaryUpdater
+from tests.mocks import make_mock_genai_client
+
+
+def _chat(n, words=60):
+    return [{"role": "user" if i % 2 == 0 else "assistant", "content": f"msg {i} " + "bla " * words}
+            for i in range(n)]
+
+
+def test_fit_history_keeps_newest_within_budget():
+    history = _chat(200)
+    kept, dropped = tokens.fit_history(history, 500)
+    assert kept == history[-len(kept):]
+    assert dropped == history[:len(dropped)]
+    assert sum(tokens.message_tokens(m) for m in kept) <= 500
+    # Summary takes its share of the budget
+    assert tokens.history_budget("word " * 100) < tokens.history_budget(None)
+
+
+@pytest.mark.asyncio
+async def test_prompt_stays_within_budget_and_requests_summary():
+    from app.personas.manager import process_chat_request
+    context = ConversationContext(history=_chat(20), summary="User runs a bakery in Jacmel.")
+    client = make_mock_genai_client(GenerateContentResponse(
+        candidates=[Candidate(content=Content(parts=[Part(text="Oke")]))]
+    ))
+    updater = MagicMock()
+    with patch("app.personas.manager.load_conversation_context", new_callable=AsyncMock, return_value=context), \
+         patch("app.personas.manager.save_message", new_callable=AsyncMock), \
+         patch("app.personas.manager.get_api_keys", return_value=["AIzaMock"]), \
+         patch("app.personas.manager.summary_updater", updater), \
+         patch("app.services.tokens.PROMPT_HISTORY_TOKENS", 400), \
+         patch("app.services.llm_engine.genai.Client", return_value=client):
+        await process_chat_request(None, "509", "E pri a?", "user_1", [])
+
+    kwargs = client.aio.models.generate_content.call_args.kwargs
+    history = kwargs["contents"][:-1]
+    assert 0 < len(history) < 20
+    assert history[-1].parts[0].text == context.history[-1]["content"]
+    assert "bakery in Jacmel" in kwargs["config"].system_instruction
+    updater.request.assert_called_once_with("user_1")
+
+
+@pytest.mark.asyncio
+async def test_update_folds_only_out_of_budget_messages():
+    start = datetime(2026, 1, 1)
+    messages = [dict(m, created_at=start + timedelta(minutes=i)) for i, m in enumerate(_chat(30))]
+    reply = GenerateContentResponse(candidates=[Candidate(content=Content(parts=[Part(text="Bakery owner, wants a price list.")]))])
+
+    with patch("app.services.summarizer.get_unsummarized_messages", new_callable=AsyncMock,
+               return_value=("Old summary", messages)), \
+         patch("app.services.summarizer.save_summary", new_callable=AsyncMock) as mock_save, \
+         patch("app.services.summarizer.generate_response_core", new_callable=AsyncMock, return_value=reply) as mock_llm, \
+         patch("app.services.tokens.PROMPT_HISTORY_TOKENS", 400):
+        assert await SummaryUpdater().update("user_1")
+        kept, fold = tokens.fit_history(messages, tokens.history_budget("Old summary"))
+
+    user_message = mock_llm.call_args.args[2]
+    assert "Old summary" in user_message
+    assert user_message.endswith(fold[-1]["content"])
+    assert kept[0]["content"] not in user_message
+    mock_save.assert_awaited_once_with("user_1", "Bakery owner, wants a price list.", fold[-1]["created_at"])
+
+
+@pytest.mark.asyncio
+async def test_update_waits_for_enough_messages():
+    messages = [dict(m, created_at=datetime(2026, 1, 1)) for m in _chat(3, words=2)]
+    with patch("app.services.summarizer.get_unsummarized_messages", new_callable=AsyncMock,
+               return_value=(None, messages)), \
+         patch("app.services.summarizer.generate_response_core", new_callable=AsyncMock) as mock_llm:
+        assert not await SummaryUpdater().update("user_1")
+    mock_llm.assert_not_awaited()
+
+
+@pytest.mark.asyncio
+async def test_short_messages_past_the_fetch_limit_are_summarized():
+    # 45 short WhatsApp turns: all of them fit the token budget, but the manager
+    # only ever sends the newest HISTORY_MAX_MESSAGES
+    from app.personas.manager import process_chat_request
+    history = _chat(tokens.HISTORY_MAX_MESSAGES, words=2)
+    client = make_mock_genai_client(GenerateContentResponse(
+        candidates=[Candidate(content=Content(parts=[Part(text="Oke")]))]
+    ))
+    updater = MagicMock()
+    with patch("app.personas.manager.load_conversation_context", new_callable=AsyncMock,
+               return_value=ConversationContext(history=history)), \
+         patch("app.personas.manager.save_message", new_callable=AsyncMock), \
+         patch("app.personas.manager.get_api_keys", return_value=["AIzaMock"]), \
+         patch("app.personas.manager.summary_updater", updater), \
+         patch("app.services.llm_engine.genai.Client", return_value=client):
+        await process_chat_request(None, "509", "Mesi", "user_1", [])
+    updater.request.assert_called_once_with("user_1")
+
+    start = datetime(2026, 1, 1)
+    messages = [dict(m, created_at=start + timedelta(minutes=i)) for i, m in enumerate(_chat(45, words=2))]
+    reply = GenerateContentResponse(candidates=[Candidate(content=Content(parts=[Part(text="Short chat.")]))])
+    with patch("app.services.summarizer.get_unsummarized_messages", new_callable=AsyncMock,
+               return_value=(None, messages)), \
+         patch("app.services.summarizer.save_summary", new_callable=AsyncMock) as mock_save, \
+         patch("app.services.summarizer.generate_response_core", new_callable=AsyncMock, return_value=reply) as mock_llm:
+        assert await SummaryUpdater().update("user_1")
+
+    # Everything older than the newest 20 is folded, nothing the manager still sends
+    folded = messages[:-tokens.HISTORY_MAX_MESSAGES]
+    user_message = mock_llm.call_args.args[2]
+    assert user_message.endswith(folded[-1]["content"])
+    assert f"msg {len(folded)} " not in user_message
+    mock_save.assert_awaited_once_with("user_1", "Short chat.", folded[-1]["created_at"])
@@ -0,0 +1,103 @@
+import time
+import asyncio
+import pytest
+from unittest.mock import AsyncMock, patch
+from google.genai import types
+from app.personas.tools import ToolRegistry, ToolContext
+from app.database.repository import ConversationContext
+from tests.mocks import make_mock_genai_client
+
+CTX = ToolContext("user_1", "509")
+
+
+def _call(name, **args):
+    return types.FunctionCall(name=name, args=args)
+
+
+def _response(*parts):
+    return types.GenerateContentResponse(candidates=[types.Candidate(content=types.Content(role="model", parts=list(parts)))])
+
+
+@pytest.mark.asyncio
+async def test_calls_run_concurrently_with_per_tool_timeouts():
+    registry = ToolRegistry()
+
+    @registry.register("lookup", "slow lookup", {"q": types.Schema(type=types.Type.STRING)})
+    async def lookup(args, ctx):
+        await asyncio.sleep(0.2)
+        return {"q": args["q"], "user": ctx.user_urn}
+
+    @registry.register("hang", "never answers", timeout=0.05)
+    async def hang(args, ctx):
+        await asyncio.sleep(10)
+
+    started = time.perf_counter()
+    parts = await registry.run_all(
+        [_call("lookup", q="a"), _call("lookup", q="b"), _call("hang"), _call("secret")],
+        CTX, allowed={"lookup", "hang"}
+    )
+    elapsed = time.perf_counter() - started
+
+    assert elapsed < 0.35  # not 0.4+: both lookups ran at once
+    results = [p.function_response.response for p in parts]
+    assert results[0] == {"q": "a", "user": "user_1"}
+    assert results[1]["q"] == "b"
+    assert "timed out" in results[2]["error"]
+    # Registered or not, a tool the turn didn't declare is refused
+    assert "Unknown tool" in results[3]["error"]
+
+
+@pytest.mark.asyncio
+async def test_tool_loop_stops_after_max_turns():
+    from app.personas.manager import process_chat_request
+
+    client = make_mock_genai_client(_response(types.Part(function_call=_call("update_profile", data={"a": 1}))))
+    with patch("app.personas.manager.load_conversation_context", new_callable=AsyncMock, return_value=ConversationContext()), \
+         patch("app.personas.manager.save_message", new_callable=AsyncMock), \
+         patch("app.personas.tools.merge_profile", new_callable=AsyncMock, return_value={"a": 1}), \
+         patch("app.personas.manager.get_api_keys", return_value=["AIzaMock"]), \
+         patch("app.personas.manager.TOOL_MAX_TURNS", 3), \
+         patch("app.services.llm_engine.genai.Client", return_value=client):
+        reply = await process_chat_request(None, "509", "Hi", "user_1", [])
+
+    calls = client.aio.models.generate_content.call_args_list
+    assert len(calls) == 3
+    assert reply == "..."
+    # Last turn can't call tools, and sees both earlier tool rounds
+    last = calls[-1].kwargs
+    assert last["config"].tool_config.function_calling_config.mode == types.FunctionCallingConfigMode.NONE
+    assert [c.role for c in last["contents"][-4:]] == ["model", "user", "model", "user"]
+
+
+@pytest.mark.asyncio
+async def test_stream_feeds_tool_results_back():
+    from app.personas.manager import stream_chat_request
+
+    turns = [
+        [_response(types.Part(text="Un moman...")),
+         _response(types.Part(function_call=_call("get_system_status")))],
+        [_response(types.Part(text="Tout bagay OK."))],
+    ]
+
+    async def stream(*args, **kwargs):
+        chunks = turns.pop(0)
+        async def gen():
+            for c in chunks:
+                yield c
+        return gen()
+
+    client = make_mock_genai_client()
+    client.aio.models.generate_content_stream = AsyncMock(side_effect=stream)
+    with patch("app.personas.manager.load_conversation_context", new_callable=AsyncMock, return_value=ConversationContext()), \
+         patch("app.personas.manager.save_message", new_callable=AsyncMock) as mock_save, \
+         patch("app.personas.manager.get_api_keys", return_value=["AIzaMock"]), \
+         patch("app.database.connection.check_health", new_callable=AsyncMock, return_value=True), \
+         patch("app.services.cache.check_health", new_callable=AsyncMock, return_value=True), \
+         patch.dict("os.environ", {"ADMIN_PHONES": "509"}), \
+         patch("app.services.llm_engine.genai.Client", return_value=client):
+        pieces = [p async for p in stream_chat_request(None, "509", "Status?", "user_1", [])]
+
+    assert "".join(pieces) == "Un moman...\nTout bagay OK."
+    mock_save.assert_awaited_once_with("user_1", "assistant", "Un moman...\nTout bagay OK.")
+    tool_turn = client.aio.models.generate_content_stream.call_args.kwargs["contents"][-1]
+    assert tool_turn.parts[0].function_response.response == {"database": "OK", "cache": "OK"}
@@ -0,0 +1,87 @@
+import pytest
+import asyncio
+from unittest.mock import AsyncMock, patch
+from google.genai import types
+from app.database.repository import ConversationContext
+from app.database.write_behind import UsageWriter
+from app.services import cache
+from app.core import metrics
+from app.services.llm_engine import generate_response_core, generate_response_stream, LLMUsage
+from tests.mocks import make_mock_genai_client, fake_acquire
+from tests.test_write_behind import copy_conn
+
+
+def _response(*parts, prompt=0, output=0, thoughts=None):
+    return types.GenerateContentResponse(
+        candidates=[types.Candidate(content=types.Content(role="model", parts=list(parts)))],
+        usage_metadata=types.GenerateContentResponseUsageMetadata(
+            prompt_token_count=prompt, candidates_token_count=output, thoughts_token_count=thoughts
+        )
+    )
+
+
+@pytest.mark.asyncio
+async def test_engine_reports_usage_metadata():
+    client = make_mock_genai_client(
+        _response(types.Part(text="Alo"), prompt=812, output=9, thoughts=40),
+        stream_chunks=[_response(types.Part(text="A")), _response(types.Part(text="lo"), prompt=812, output=2)]
+    )
+    usage = []
+    with patch("app.services.llm_engine.genai.Client", return_value=client):
+        await generate_response_core("System", [], "Hi", [], ["Key1"], model="gemini-x", usage=usage)
+        [c async for c in generate_response_stream("System", [], "Hi", [], ["Key1"], usage=usage)]
+
+    assert [(u.prompt_tokens, u.output_tokens, u.thoughts_tokens) for u in usage] == [(812, 9, 40), (812, 2, 0)]
+    assert usage[0].model == "gemini-x"
+    assert usage[0].key_id == cache.key_id("Key1")  # hashed, never the key
+    assert usage[0].latency_ms >= 0
+
+
+@pytest.mark.asyncio
+async def test_every_tool_turn_lands_in_the_ledger():
+    from app.personas.manager import process_chat_request
+
+    client = make_mock_genai_client()
+    client.aio.models.generate_content.side_effect = [
+        _response(types.Part(function_call=types.FunctionCall(name="update_profile", args={"data": {}})),
+                  prompt=500, output=12),
+        _response(types.Part(text="Anrejistre!"), prompt=530, output=4),
+    ]
+    conn = copy_conn()
+    writer = UsageWriter()
+    with patch("app.database.write_behind.acquire", fake_acquire(conn)), \
+         patch("app.personas.manager.usage_writer", writer), \
+         patch("app.personas.manager.load_conversation_context", new_callable=AsyncMock, return_value=ConversationContext()), \
+         patch("app.personas.manager.save_message", new_callable=AsyncMock), \
+         patch("app.personas.tools.merge_profile", new_callable=AsyncMock, return_value={}), \
+         patch("app.personas.manager.get_api_keys", return_value=["AIzaMock"]), \
+         patch("app.services.llm_engine.genai.Client", return_value=client):
+        await writer.start()
+        usage = []
+        await process_chat_request(None, "509", "Save me", "user_1", [], usage=usage)
+        await writer.stop()
+
+    rows = [r for batch in conn.batches for r in batch]
+    assert [(r[1], r[3], r[6], r[7]) for r in rows] == [("user_1", "chat", 500, 12), ("user_1", "chat", 530, 4)]
+    assert [u.prompt_tokens for u in usage] == [500, 530]
+
+
+@pytest.mark.asyncio
+async def test_stalled_ledger_drops_rows_instead_of_blocking():
+    metrics.reset()
+    gate = asyncio.Event()  # COPY hangs until set
+    conn = copy_conn(gate)
+    writer = UsageWriter()
+    writer.max_pending = 3
+    with patch("app.database.write_behind.acquire", fake_acquire(conn)):
+        await writer.start()
+        usage = [LLMUsage("gemini-x", "k1", prompt_tokens=n) for n in range(10)]
+        # Returns right away although Postgres isn't taking anything
+        await asyncio.wait_for(writer.record("user_1", None, usage), timeout=1)
+        assert metrics.get("usage.dropped") > 0
+        gate.set()
+        await writer.stop()
+
+    rows = [r for batch in conn.batches for r in batch]
+    assert len(rows) + metrics.get("usage.dropped") == 10
+    metrics.reset()
@@ -0,0 +1,175 @@
+import asyncio
+import time
+import asyncpg
+import pytest
+from unittest.mock import AsyncMock, patch
+from tests.mocks import fake_acquire
+from app.database.write_behind import BatchWriter, ChatHistoryWriter
+
+
+def copy_conn(gate: asyncio.Event = None):
+    """Connection mock whose COPY optionally blocks until `gate` is set"""
+    conn = AsyncMock()
+    conn.batches = []
+    
+    async def copy(table, records, columns):
+        if gate is not None:
+            await gate.wait()
+        conn.batches.append(list(records))
+    conn.copy_records_to_table.side_effect = copy
+    return conn
+
+
+@pytest.mark.asyncio
+async def test_flushes_by_size_and_on_stop():
+    conn = copy_conn()
+    writer = BatchWriter("t", ("a",), max_batch=3, flush_interval=5, max_pending=100)
+    
+    with patch("app.database.write_behind.acquire", fake_acquire(conn)):
+        await writer.start()
+        for i in range(7):
+            await writer.put((i,))
+        # Full batches go out without waiting for the 5s interval
+        for _ in range(50):
+            if len(conn.batches) >= 2:
+                break
+            await asyncio.sleep(0.01)
+        assert [len(b) for b in conn.batches[:2]] == [3, 3]
+        
+        # The leftover row is flushed on shutdown
+        await writer.stop()
+    
+    assert sum(len(b) for b in conn.batches) == 7
+    assert conn.batches[-1] == [(6,)]
+
+
+@pytest.mark.asyncio
+async def test_backpressure_when_buffer_full():
+    gate = asyncio.Event()
+    conn = copy_conn(gate)
+    writer = BatchWriter("t", ("a",), max_batch=1, flush_interval=0.01, max_pending=2)
+    
+    with patch("app.database.write_behind.acquire", fake_acquire(conn)):
+        await writer.start()
+        await writer.put((1,))  # taken by the flusher, stuck in COPY
+        await asyncio.sleep(0.05)
+        await writer.put((2,))
+        await writer.put((3,))  # buffer now full
+        
+        blocked = asyncio.create_task(writer.put((4,)))
+        await asyncio.sleep(0.05)
+        assert not blocked.done()
+        
+        gate.set()
+        await asyncio.wait_for(blocked, 1)
+        await writer.stop()
+    
+    assert [r for b in conn.batches for r in b] == [(1,), (2,), (3,), (4,)]
+
+
+@pytest.mark.asyncio
+async def test_read_your_writes_before_flush():
+    """get_history sees messages that are still sitting in the buffer"""
+    from app.database import repository
+    
+    gate = asyncio.Event()
+    writer_conn = copy_conn(gate)
+    writer = ChatHistoryWriter()
+    writer.flush_interval = 0.01
+    
+    db_conn = AsyncMock()
+    db_conn.fetch.return_value = []  # nothing committed yet
+    
+    with patch("app.database.write_behind.acquire", fake_acquire(writer_conn)), \
+         patch("app.database.repository.acquire", fake_acquire(db_conn)), \
+         patch("app.database.repository.chat_writer", writer):
+        await writer.start()
+        await repository.save_message("u1", "user", "Bonjou")
+        await repository.save_message("u1", "assistant", "Alo!")
+        await repository.save_message("u2", "user", "other user")
+        
+        history = await repository.get_history("u1")
+        assert history == [{"role": "user", "content": "Bonjou"}, {"role": "assistant", "content": "Alo!"}]
+        
+        gate.set()
+        await writer.stop()
+    
+    assert writer.pending_for("u1") == []
+    assert writer_conn.batches[0][0][:3] == ("u1", "user", "Bonjou")
+
+
+def test_merge_skips_rows_already_committed():
+    from datetime import datetime, timedelta
+    t0 = datetime(2026, 1, 1, 12, 0, 0)
+    pending = [
+        ("u1", "user", "flushed meanwhile", t0),
+        ("u1", "assistant", "still buffered", t0 + timedelta(seconds=1)),
+    ]
+    history = [{"role": "user", "content": "flushed meanwhile"}]
+    
+    merged = ChatHistoryWriter.merge(history, t0, pending, limit=10)
+    
+    assert [m["content"] for m in merged] == ["flushed meanwhile", "still buffered"]
+
+
+def rejecting_conn():
+    """COPY always fails on the NUL byte; row-by-row INSERTs only refuse that row"""
+    conn = AsyncMock()
+    conn.inserted = []
+    conn.copy_records_to_table.side_effect = asyncpg.CharacterNotInRepertoireError("invalid byte sequence: 0x00")
+
+    async def execute(query, *row):
+        if "\x00" in row[2]:
+            raise asyncpg.CharacterNotInRepertoireError("invalid byte sequence: 0x00")
+        conn.inserted.append(row)
+    conn.execute.side_effect = execute
+    return conn
+
+
+@pytest.mark.asyncio
+async def test_bad_row_is_dropped_instead_of_stalling_the_writer():
+    conn = rejecting_conn()
+    writer = ChatHistoryWriter()
+    writer.flush_interval = 0.01
+    with patch("app.database.write_behind.acquire", fake_acquire(conn)), \
+         patch("app.database.write_behind.WRITE_BEHIND_COPY_ATTEMPTS", 1):
+        await writer.start()
+        await writer.save("u1", "user", "bonjou")
+        await writer.save("u1", "user", "a\x00b")
+        await writer.save("u1", "assistant", "alo")
+        for _ in range(100):
+            if len(conn.inserted) == 2:
+                break
+            await asyncio.sleep(0.01)
+        # Writes behind the bad row keep flowing
+        await writer.save("u1", "user", "mesi")
+        await writer.stop()
+
+    assert [r[2] for r in conn.inserted] == ["bonjou", "alo", "mesi"]
+    assert writer.pending_for("u1") == []
+
+
+@pytest.mark.asyncio
+async def test_stop_returns_even_if_every_copy_fails():
+    conn = rejecting_conn()
+    writer = ChatHistoryWriter()
+    with patch("app.database.write_behind.acquire", fake_acquire(conn)):
+        await writer.start()
+        await writer.save("u1", "user", "a\x00b")
+        await writer.save("u1", "user", "bonjou")
+        started = time.monotonic()
+        await writer.stop()
+    assert time.monotonic() - started < 1
+    assert [r[2] for r in conn.inserted] == ["bonjou"]
+
+
+@pytest.mark.asyncio
+async def test_stop_gives_up_when_postgres_hangs():
+    gate = asyncio.Event()  # never set: COPY hangs
+    writer = BatchWriter("t", ("a",))
+    with patch("app.database.write_behind.acquire", fake_acquire(copy_conn(gate))):
+        await writer.start()
+        await writer.put((1,))
+        started = time.monotonic()
+        await writer.stop(timeout=0.2)
+    assert time.monotonic() - started < 1